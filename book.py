@@ -0,0 +1,177 @@
+import argparse
+import glob
+import json
+import mmap
+import os
+import struct
+import sys
+import time
+
+from chess import BACKENDS, unpack_move
+from pgn import read_games
+
+
+# An opening book is a 16-byte header followed by fixed-width entries sorted by position
+# key, then move: the Zobrist key of the position (ChessGame.zobrist_key), the packed move
+# code played from it and its weight. Lookups binary-search the memory-mapped file, so
+# opening a book reads nothing but the header.
+BOOK_MAGIC = b"AZOB"
+BOOK_VERSION = 1
+BOOK_HEADER = struct.Struct("<4sHHQ")
+BOOK_ENTRY = struct.Struct("<QHH")
+MAX_WEIGHT = 65535
+
+# Points a move earns for every game it was played in, by the result for the side that
+# played it
+RESULT_POINTS = {1: 2, 0: 1, -1: 0}
+
+
+class OpeningBook:
+    def __init__(self, path):
+        with open(path, "rb") as book:
+            self.data = mmap.mmap(book.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, count = BOOK_HEADER.unpack_from(self.data)
+        if magic != BOOK_MAGIC or version != BOOK_VERSION:
+            raise ValueError(f"{path}: not a version {BOOK_VERSION} opening book")
+        if len(self.data) != BOOK_HEADER.size + count * BOOK_ENTRY.size:
+            raise ValueError(f"{path}: truncated opening book")
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def entry(self, index):
+        return BOOK_ENTRY.unpack_from(self.data, BOOK_HEADER.size + index * BOOK_ENTRY.size)
+
+    def lookup(self, key):
+        # (move code, weight) of every book move of the position with this Zobrist key
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.entry(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        moves = []
+        while low < self.count:
+            entry_key, code, weight = self.entry(low)
+            if entry_key != key:
+                break
+            moves.append((code, weight))
+            low += 1
+        return moves
+
+    def choose(self, game, rng):
+        # Book Move for the game's position, drawn with probability proportional to its
+        # weight from rng (a random.Random), or None once the game is out of book. Entries
+        # that are not legal here (a Zobrist collision) are left out.
+        legal = set(game.legal_move_codes())
+        moves = [(code, weight) for code, weight in self.lookup(game.zobrist_key) if code in legal]
+        if not moves:
+            return None
+        code = rng.choices([code for code, _ in moves], [weight for _, weight in moves])[0]
+        return unpack_move(code)
+
+
+def iter_book_games(paths):
+    # (moves, result, san, fen) of every game in PGN files and self-play JSON-lines files;
+    # directories contribute all their *.pgn and *.jsonl files. PGN moves are SAN strings,
+    # self-play moves UCI strings. fen is the starting position of the game (a PGN FEN
+    # tag), None for the standard start.
+    for path in paths:
+        if os.path.isdir(path):
+            files = sorted(glob.glob(os.path.join(path, "*.pgn")) + glob.glob(os.path.join(path, "*.jsonl")))
+        else:
+            files = [path]
+        for name in files:
+            if name.endswith(".pgn"):
+                with open(name, "rb") as games:
+                    for game in read_games(games):
+                        yield game.moves, game.result, True, game.headers.get("FEN")
+            else:
+                with open(name) as games:
+                    for line in games:
+                        record = json.loads(line)
+                        yield record["moves"], record["result"], False, record.get("fen")
+
+
+def build_book(paths, output, max_plies=16, min_games=2, backend="bitboard"):
+    # Count the moves played from every position of the first max_plies plies of the games,
+    # keep those played in at least min_games games and write them, weighted by their
+    # results, to a book file. A game only counts once all of its first max_plies plies
+    # (and its starting FEN) parse. Returns (games, skipped games, entries).
+    stats = {}
+    games = skipped = 0
+    for moves, result, san, fen in iter_book_games(paths):
+        score = {"1-0": 1, "0-1": -1}.get(result, 0)
+        game = BACKENDS[backend]()
+        played = []
+        try:
+            if fen:
+                game.load_fen(fen)
+            for notation in moves[:max_plies]:
+                move = game.parse_san(notation) if san else game.parse_move(notation)
+                played.append((game.zobrist_key, game.encode_move(move), game.turn))
+                game.push(move)
+        except ValueError:
+            skipped += 1
+            continue
+        games += 1
+        for key, code, turn in played:
+            counts = stats.setdefault((key, code), [0, 0])
+            counts[0] += 1
+            counts[1] += RESULT_POINTS[score if turn == "white" else -score]
+
+    entries = sorted((key, code, points) for (key, code), (count, points) in stats.items()
+                     if count >= min_games and points > 0)
+    scale = max(1, -(-max((points for _, _, points in entries), default=0) // MAX_WEIGHT))
+    with open(output + ".tmp", "wb") as book:
+        book.write(BOOK_HEADER.pack(BOOK_MAGIC, BOOK_VERSION, 0, len(entries)))
+        for key, code, points in entries:
+            book.write(BOOK_ENTRY.pack(key, code, max(1, points // scale)))
+    os.replace(output + ".tmp", output)
+    return games, skipped, len(entries)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build an opening book from games, or list the book moves of a position.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build", help="build a book from PGN files and self-play JSON-lines files")
+    build.add_argument("book", help="book file to write")
+    build.add_argument("games", nargs="+", help="PGN or JSON-lines files, or directories of them")
+    build.add_argument("--max-plies", type=int, default=16, help="plies of every game to use (default: 16)")
+    build.add_argument("--min-games", type=int, default=2,
+                       help="leave out moves played in fewer games (default: 2)")
+    build.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                       help="board representation to use (default: bitboard)")
+    probe = commands.add_parser("probe", help="list the book moves of a position")
+    probe.add_argument("book", help="book file")
+    probe.add_argument("--fen", help="position (default: start position)")
+    probe.add_argument("--moves", nargs="*", default=[], help="UCI moves played from the position")
+    args = parser.parse_args(argv)
+
+    if args.command == "build":
+        start = time.perf_counter()
+        games, skipped, entries = build_book(args.games, args.book, args.max_plies, args.min_games, args.backend)
+        print(f"{entries} book entries from {games} games ({skipped} skipped) in "
+              f"{time.perf_counter() - start:.3f}s; written to {args.book}")
+        return 0
+
+    game = BACKENDS["bitboard"]()
+    if args.fen:
+        game.load_fen(args.fen)
+    for move in args.moves:
+        game.push(move)
+    book = OpeningBook(args.book)
+    start = time.perf_counter()
+    moves = book.lookup(game.zobrist_key)
+    microseconds = (time.perf_counter() - start) * 1e6
+    total = sum(weight for _, weight in moves)
+    for code, weight in sorted(moves, key=lambda entry: -entry[1]):
+        print(f"{unpack_move(code).uci()}  weight {weight:>5}  ({weight / total:.1%})")
+    print(f"{len(moves)} book moves out of {len(book)} entries (lookup {microseconds:.0f} us)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,3 +1,295 @@
+import argparse
+import json
+import platform
+import random
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+
+PIECE_CODES = ("wp", "wn", "wb", "wr", "wq", "wk", "bp", "bn", "bb", "br", "bq", "bk")
+FILES = "abcdefgh"
+START_FEN = "rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1"
+
+# Everything unmake_move needs to restore the position before a make_move
+UndoRecord = namedtuple("UndoRecord", [
+    "move", "piece", "captured_piece", "captured_position", "en_passant_target",
+    "castling_rights", "white_king_position", "black_king_position", "zobrist_key", "status",
+    "halfmove_clock",
+])
+
+# Everything the game asks about one position, generated once by get_status: whether the
+# side to move is in check, its legal destinations by source square, its legal moves as
+# Move objects and as packed codes in the same order, and the game result (None while
+# the game goes on)
+PositionStatus = namedtuple("PositionStatus", ["in_check", "moves", "legal_moves", "move_codes", "result"])
+
+# Board squares of a Snapshot are bytes indexing this tuple
+SNAPSHOT_PIECES = ("  ",) + PIECE_CODES
+SNAPSHOT_BYTES = {piece: index for index, piece in enumerate(SNAPSHOT_PIECES)}
+
+
+class Snapshot(namedtuple("Snapshot", [
+        "board", "turn", "castling_rights", "en_passant_target", "halfmove_clock", "fullmove_number",
+        "zobrist_key", "history"])):
+    # Immutable copy of a position, from ChessGame.snapshot. board holds the 64 squares as
+    # bytes, castling_rights is the get_castling_rights tuple and history the Zobrist keys of
+    # the repetition window: the positions since the last capture or pawn move, the only
+    # ones a later position can repeat. Its size does not depend on the length of the game.
+    __slots__ = ()
+
+# Starting corner of each rook, with the castling side it belongs to
+ROOK_CORNERS = {
+    (7, 0): ("white", "left"), (7, 7): ("white", "right"),
+    (0, 0): ("black", "left"), (0, 7): ("black", "right"),
+}
+
+# Zobrist keys, drawn from a fixed seed so hashes are the same in every process and run.
+# The empty square maps to zeros so set_piece can XOR old and new pieces without branching.
+_zobrist_random = random.Random(0x5EED)
+ZOBRIST_PIECES = {
+    piece: tuple(_zobrist_random.getrandbits(64) for _ in range(64))
+    for piece in PIECE_CODES
+}
+ZOBRIST_PIECES["  "] = (0,) * 64
+ZOBRIST_BLACK_TO_MOVE = _zobrist_random.getrandbits(64)
+# White left, white right, black left, black right castling
+ZOBRIST_CASTLING = tuple(_zobrist_random.getrandbits(64) for _ in range(4))
+# Indexed by the column of the en passant target
+ZOBRIST_EN_PASSANT = tuple(_zobrist_random.getrandbits(64) for _ in range(8))
+
+# Static evaluation: material plus piece-square bonuses in centipawns, for white as seen on
+# the board (row 0 is black's back rank). Black uses the same tables mirrored.
+PIECE_VALUES = {"p": 100, "n": 320, "b": 330, "r": 500, "q": 900, "k": 0}
+PIECE_SQUARE_TABLES = {
+    "p": (
+         0,   0,   0,   0,   0,   0,   0,   0,
+        50,  50,  50,  50,  50,  50,  50,  50,
+        10,  10,  20,  30,  30,  20,  10,  10,
+         5,   5,  10,  25,  25,  10,   5,   5,
+         0,   0,   0,  20,  20,   0,   0,   0,
+         5,  -5, -10,   0,   0, -10,  -5,   5,
+         5,  10,  10, -20, -20,  10,  10,   5,
+         0,   0,   0,   0,   0,   0,   0,   0,
+    ),
+    "n": (
+       -50, -40, -30, -30, -30, -30, -40, -50,
+       -40, -20,   0,   0,   0,   0, -20, -40,
+       -30,   0,  10,  15,  15,  10,   0, -30,
+       -30,   5,  15,  20,  20,  15,   5, -30,
+       -30,   0,  15,  20,  20,  15,   0, -30,
+       -30,   5,  10,  15,  15,  10,   5, -30,
+       -40, -20,   0,   5,   5,   0, -20, -40,
+       -50, -40, -30, -30, -30, -30, -40, -50,
+    ),
+    "b": (
+       -20, -10, -10, -10, -10, -10, -10, -20,
+       -10,   0,   0,   0,   0,   0,   0, -10,
+       -10,   0,   5,  10,  10,   5,   0, -10,
+       -10,   5,   5,  10,  10,   5,   5, -10,
+       -10,   0,  10,  10,  10,  10,   0, -10,
+       -10,  10,  10,  10,  10,  10,  10, -10,
+       -10,   5,   0,   0,   0,   0,   5, -10,
+       -20, -10, -10, -10, -10, -10, -10, -20,
+    ),
+    "r": (
+         0,   0,   0,   0,   0,   0,   0,   0,
+         5,  10,  10,  10,  10,  10,  10,   5,
+        -5,   0,   0,   0,   0,   0,   0,  -5,
+        -5,   0,   0,   0,   0,   0,   0,  -5,
+        -5,   0,   0,   0,   0,   0,   0,  -5,
+        -5,   0,   0,   0,   0,   0,   0,  -5,
+        -5,   0,   0,   0,   0,   0,   0,  -5,
+         0,   0,   0,   5,   5,   0,   0,   0,
+    ),
+    "q": (
+       -20, -10, -10,  -5,  -5, -10, -10, -20,
+       -10,   0,   0,   0,   0,   0,   0, -10,
+       -10,   0,   5,   5,   5,   5,   0, -10,
+        -5,   0,   5,   5,   5,   5,   0,  -5,
+         0,   0,   5,   5,   5,   5,   0,  -5,
+       -10,   5,   5,   5,   5,   5,   0, -10,
+       -10,   0,   5,   0,   0,   0,   0, -10,
+       -20, -10, -10,  -5,  -5, -10, -10, -20,
+    ),
+    "k": (
+       -30, -40, -40, -50, -50, -40, -40, -30,
+       -30, -40, -40, -50, -50, -40, -40, -30,
+       -30, -40, -40, -50, -50, -40, -40, -30,
+       -30, -40, -40, -50, -50, -40, -40, -30,
+       -20, -30, -30, -40, -40, -30, -30, -20,
+       -10, -20, -20, -20, -20, -20, -20, -10,
+        20,  20,   0,   0,   0,   0,  20,  20,
+        20,  30,  10,   0,   0,  10,  30,  20,
+    ),
+}
+# Piece values for exchanges, where the king is worth more than anything it could capture
+SEE_PIECE_VALUES = dict(PIECE_VALUES, k=20000)
+
+# Signed value of every piece on every square number (positive for white), so set_piece
+# can update the evaluation with one lookup per piece
+PIECE_SQUARE_VALUES = {"  ": (0,) * 64}
+for _kind, _table in PIECE_SQUARE_TABLES.items():
+    PIECE_SQUARE_VALUES["w" + _kind] = tuple(PIECE_VALUES[_kind] + bonus for bonus in _table)
+    PIECE_SQUARE_VALUES["b" + _kind] = tuple(-PIECE_VALUES[_kind] - _table[square ^ 56] for square in range(64))
+
+# (piece, row, col) that must be in place for each FEN castling right
+CASTLING_SQUARES = {
+    "K": (("wk", 7, 4), ("wr", 7, 7)),
+    "Q": (("wk", 7, 4), ("wr", 7, 0)),
+    "k": (("bk", 0, 4), ("br", 0, 7)),
+    "q": (("bk", 0, 4), ("br", 0, 0)),
+}
+
+# Well-formed FENs with impossible castling rights or en passant squares, and the FEN
+# load_fen reads each of them as
+FEN_CHECKS = [
+    ("4k3/8/8/8/8/8/8/3K4 w KQ - 0 1", "4k3/8/8/8/8/8/8/3K4 w - - 0 1"),
+    ("4k3/8/8/8/8/8/8/4K3 w K - 0 1", "4k3/8/8/8/8/8/8/4K3 w - - 0 1"),
+    ("r3k2r/8/8/8/8/8/8/R3K1R1 w KQkq - 0 1", "r3k2r/8/8/8/8/8/8/R3K1R1 w Qkq - 0 1"),
+    ("4k3/8/8/3nP3/8/8/8/4K3 w - d6 0 1", "4k3/8/8/3nP3/8/8/8/4K3 w - - 0 1"),
+    ("4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1", "4k3/8/8/8/3Pp3/8/8/4K3 b - d3 0 1"),
+    ("4k3/8/8/8/3Pp3/3N4/8/4K3 b - d3 0 1", "4k3/8/8/8/3Pp3/3N4/8/4K3 b - - 0 1"),
+]
+
+# Reference positions with their known perft node counts for depths 1, 2, 3, ...
+PERFT_POSITIONS = [
+    ("startpos", START_FEN,
+     [20, 400, 8902, 197281, 4865609]),
+    ("kiwipete", "r3k2r/p1ppqpb1/bn2pnp1/3PN3/1p2P3/2N2Q1p/PPPBBPPP/R3K2R w KQkq - 0 1",
+     [48, 2039, 97862, 4085603]),
+    ("position3", "8/2p5/3p4/KP5r/1R3p1k/8/4P1P1/8 w - - 0 1",
+     [14, 191, 2812, 43238, 674624]),
+    ("position4", "r3k2r/Pppp1ppp/1b3nbN/nP6/BBP1P3/q4N2/Pp1P2PP/R2Q1RK1 w kq - 0 1",
+     [6, 264, 9467, 422333]),
+    ("position5", "rnbq1k1r/pp1Pbppp/2p5/8/2B5/8/PPP1NnPP/RNBQK2R w KQ - 1 8",
+     [44, 1486, 62379, 2103487]),
+    ("position6", "r4rk1/1pp1qppp/p1np1n2/2b1p1B1/2B1P1b1/P1NP1N2/1PP1QPPP/R4RK1 w - - 0 10",
+     [46, 2079, 89890, 3894594]),
+]
+
+
+def square_name(row, col):
+    # Algebraic name of a board square, e.g. (6, 4) -> "e2"
+    return FILES[col] + str(8 - row)
+
+
+def parse_square(name):
+    # (row, col) of an algebraic square name, e.g. "e2" -> (6, 4)
+    return 8 - int(name[1]), FILES.index(name[0])
+
+
+def move_to_uci(move):
+    # UCI notation of a move tuple, e.g. ((6, 4), (4, 4)) -> "e2e4"
+    notation = square_name(*move[0]) + square_name(*move[1])
+    if len(move) > 2 and move[2]:
+        notation += move[2]
+    return notation
+
+
+class IllegalMoveError(ValueError):
+    # Raised by the programmatic game API for malformed, illegal or ambiguous moves
+    pass
+
+
+class Move(namedtuple("Move", ["src", "dest", "promotion"], defaults=[None])):
+    # A move as ((src_row, src_col), (dest_row, dest_col), promotion), laid out like the
+    # tuples make_move takes. promotion is "q", "r", "b" or "n" when a pawn reaches the
+    # last row and None otherwise.
+    __slots__ = ()
+
+    @classmethod
+    def from_uci(cls, notation):
+        # Move from UCI notation, e.g. "e2e4" or "e7e8q"
+        if (len(notation) not in (4, 5) or notation[0] not in FILES or notation[2] not in FILES
+                or notation[1] not in "12345678" or notation[3] not in "12345678"
+                or (len(notation) == 5 and notation[4] not in "qrbn")):
+            raise IllegalMoveError(f"Invalid UCI move: {notation!r}")
+        return cls(parse_square(notation[0:2]), parse_square(notation[2:4]), notation[4:] or None)
+
+    def uci(self):
+        return move_to_uci(self)
+
+
+# Packed 16-bit moves: from-square in bits 0-5, to-square in bits 6-11, the promotion piece
+# (an index into PROMOTION_PIECES) in bits 12-13 and one of the MOVE_* flags in bits 14-15.
+# Squares are numbered row * 8 + col.
+PROMOTION_PIECES = "nbrq"
+MOVE_NORMAL, MOVE_PROMOTION, MOVE_EN_PASSANT, MOVE_CASTLING = range(4)
+
+
+def pack_move(src, dest, promotion=None, flag=MOVE_NORMAL):
+    # 16-bit code of a move between (row, col) squares
+    code = src[0] * 8 + src[1] | (dest[0] * 8 + dest[1]) << 6
+    if promotion:
+        return code | PROMOTION_PIECES.index(promotion) << 12 | MOVE_PROMOTION << 14
+    return code | flag << 14
+
+
+def unpack_move(code):
+    # Move of a packed 16-bit move code
+    promotion = PROMOTION_PIECES[code >> 12 & 3] if code >> 14 == MOVE_PROMOTION else None
+    return Move(divmod(code & 63, 8), divmod(code >> 6 & 63, 8), promotion)
+
+
+# Move tables, built once at import and only ever read, so every game (and every forked
+# worker process) shares them. They are indexed by square number row * 8 + col and
+# list (row, col) target squares.
+
+# (row, col) tuple for every square number
+SQUARES = tuple(divmod(square, 8) for square in range(64))
+
+KNIGHT_OFFSETS = (
+    (-2, -1), (-2, 1), (2, -1), (2, 1),
+    (-1, -2), (-1, 2), (1, -2), (1, 2)
+)
+KING_OFFSETS = (
+    (-1, -1), (-1, 0), (-1, 1),
+    (0, -1),           (0, 1),
+    (1, -1),  (1, 0),  (1, 1)
+)
+ROOK_DIRECTIONS = ((1, 0), (0, 1), (-1, 0), (0, -1))
+BISHOP_DIRECTIONS = ((1, 1), (1, -1), (-1, -1), (-1, 1))
+
+
+def _build_targets(offsets):
+    # For every square, the squares one jump of each offset away that are still on the board
+    return tuple(
+        tuple((row + d_row, col + d_col) for d_row, d_col in offsets if 0 <= row + d_row < 8 and 0 <= col + d_col < 8)
+        for row, col in SQUARES
+    )
+
+
+def _build_rays(directions):
+    # For every square, one tuple per direction with the squares along it, nearest first
+    rays = []
+    for row, col in SQUARES:
+        square_rays = []
+        for d_row, d_col in directions:
+            ray = []
+            new_row, new_col = row + d_row, col + d_col
+            while 0 <= new_row < 8 and 0 <= new_col < 8:
+                ray.append((new_row, new_col))
+                new_row += d_row
+                new_col += d_col
+            square_rays.append(tuple(ray))
+        rays.append(tuple(square_rays))
+    return tuple(rays)
+
+
+KNIGHT_TARGETS = _build_targets(KNIGHT_OFFSETS)
+KING_TARGETS = _build_targets(KING_OFFSETS)
+# Squares a pawn of each color attacks from every square
+PAWN_CAPTURES = {
+    "w": _build_targets(((-1, -1), (-1, 1))),
+    "b": _build_targets(((1, -1), (1, 1))),
+}
+ROOK_RAYS = _build_rays(ROOK_DIRECTIONS)
+BISHOP_RAYS = _build_rays(BISHOP_DIRECTIONS)
+QUEEN_RAYS = tuple(rook_rays + bishop_rays for rook_rays, bishop_rays in zip(ROOK_RAYS, BISHOP_RAYS))
+
+
 class ChessGame:
     def __init__(self):
         # Initialize a simple chess board with w for white pieces and b for black pieces
@@ -23,10 +315,28 @@ class ChessGame:
         self.black_king_moved = False
         self.white_rook_moved = {"left": False, "right": False}
         self.black_rook_moved = {"left": False, "right": False}
-        
-        
-        # Add a list to store board positions
+
+        # Plies since the last capture or pawn move, and the number of the current full move
+        self.halfmove_clock = 0
+        self.fullmove_number = 1
+
+        # Material and piece-square score for white, kept up to date by set_piece
+        self.evaluation = self.compute_evaluation()
+
+        # Zobrist keys of every position reached, and how often each one occurred
         self.position_history = []
+        self.position_counts = {}
+        self.zobrist_key = self.compute_zobrist_key()
+        self.update_position_history()
+
+        # Number of pieces of each color attacking every square, kept up to date by set_piece
+        self.reset_attack_counts()
+
+        # One UndoRecord per move played with make_move, most recent last
+        self.undo_stack = []
+
+        # PositionStatus of the current position, None until get_status generates it
+        self.status = None
 
     def print_board(self):
         print(" ")
@@ -40,17 +350,238 @@ class ChessGame:
         print("    0   1   2   3   4   5   6   7")  
         print(" ")
         
+    def load_fen(self, fen):
+        # Set up the position from a FEN string. The castling, en passant and move counter
+        # fields may be left out, as in EPD. Every field is checked before the game is
+        # changed, so a ValueError leaves the current position as it was. Castling rights
+        # without the king and rook on their starting squares, and an en passant square no
+        # pawn can have just passed, are well-formed but impossible, and are dropped.
+        fields = fen.split()
+        if len(fields) < 2 or len(fields) > 6 or fields[1] not in ("w", "b"):
+            raise ValueError(f"Invalid FEN: {fen!r}")
+        placement, turn = fields[0], fields[1]
+        castling = fields[2] if len(fields) > 2 else "-"
+        en_passant = fields[3] if len(fields) > 3 else "-"
+        try:
+            halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+            fullmove_number = int(fields[5]) if len(fields) > 5 else 1
+        except ValueError:
+            raise ValueError(f"Invalid FEN move counters: {' '.join(fields[4:])}") from None
+        if halfmove_clock < 0 or fullmove_number < 0:
+            raise ValueError(f"Invalid FEN move counters: {' '.join(fields[4:])}")
+
+        rows = placement.split("/")
+        if len(rows) != 8:
+            raise ValueError(f"Invalid FEN piece placement: {placement}")
+        board = []
+        for rank in rows:
+            pieces = []
+            for char in rank:
+                if char in "12345678":
+                    pieces.extend(["  "] * int(char))
+                elif char in "KQRBNPkqrbnp":
+                    pieces.append(("w" if char.isupper() else "b") + char.lower())
+                else:
+                    raise ValueError(f"Invalid FEN piece {char!r} in rank {rank}")
+            if len(pieces) != 8:
+                raise ValueError(f"Invalid FEN rank: {rank}")
+            board.append(pieces)
+        kings = {}
+        for row, pieces in enumerate(board):
+            for col, piece in enumerate(pieces):
+                if piece in ("wk", "bk"):
+                    kings.setdefault(piece, []).append((row, col))
+        if len(kings.get("wk", ())) != 1 or len(kings.get("bk", ())) != 1:
+            raise ValueError(f"Invalid FEN piece placement: {placement} needs one king per side")
+
+        if castling != "-" and (not castling or any(char not in "KQkq" for char in castling)
+                                or len(set(castling)) != len(castling)):
+            raise ValueError(f"Invalid FEN castling rights: {castling}")
+        # The en passant target is behind a pawn that just moved two squares
+        if en_passant != "-" and (len(en_passant) != 2 or en_passant[0] not in FILES
+                                  or en_passant[1] != ("6" if turn == "w" else "3")):
+            raise ValueError(f"Invalid FEN en passant square: {en_passant}")
+
+        castling = "".join(right for right in castling if right in CASTLING_SQUARES and all(
+            board[row][col] == piece for piece, row, col in CASTLING_SQUARES[right]))
+        if en_passant != "-":
+            row, col = parse_square(en_passant)
+            # The pawn stands one square past the target, the target and the square it
+            # came from are empty
+            pawn_row, start_row = (row + 1, row - 1) if turn == "w" else (row - 1, row + 1)
+            if board[pawn_row][col] != ("bp" if turn == "w" else "wp") or \
+                    board[row][col] != "  " or board[start_row][col] != "  ":
+                en_passant = "-"
+
+        for row, pieces in enumerate(board):
+            for col, piece in enumerate(pieces):
+                self.set_piece(row, col, piece)
+        self.white_king_position = kings["wk"][0]
+        self.black_king_position = kings["bk"][0]
+
+        self.turn = "white" if turn == "w" else "black"
+
+        # A side without any castling rights is treated as if its king had moved
+        self.white_rook_moved = {"left": "Q" not in castling, "right": "K" not in castling}
+        self.black_rook_moved = {"left": "q" not in castling, "right": "k" not in castling}
+        self.white_king_moved = "K" not in castling and "Q" not in castling
+        self.black_king_moved = "k" not in castling and "q" not in castling
+
+        self.en_passant_target = None if en_passant == "-" else parse_square(en_passant)
+        self.halfmove_clock = halfmove_clock
+        self.fullmove_number = max(fullmove_number, 1)
+
+        self.undo_stack = []
+        self.status = None
+        self.position_history = []
+        self.position_counts = {}
+        self.zobrist_key = self.compute_zobrist_key()
+        self.update_position_history()
+
+    def to_fen(self):
+        # FEN string of the current position, the inverse of load_fen
+        ranks = []
+        for row in self.board:
+            rank, empty = "", 0
+            for piece in row:
+                if piece == "  ":
+                    empty += 1
+                    continue
+                if empty:
+                    rank += str(empty)
+                    empty = 0
+                rank += piece[1].upper() if piece[0] == "w" else piece[1]
+            ranks.append(rank + (str(empty) if empty else ""))
+
+        castling = ""
+        if not self.white_king_moved:
+            castling += ("K" if not self.white_rook_moved["right"] else "") + \
+                        ("Q" if not self.white_rook_moved["left"] else "")
+        if not self.black_king_moved:
+            castling += ("k" if not self.black_rook_moved["right"] else "") + \
+                        ("q" if not self.black_rook_moved["left"] else "")
+        en_passant = square_name(*self.en_passant_target) if self.en_passant_target else "-"
+        return (f"{'/'.join(ranks)} {'w' if self.turn == 'white' else 'b'} {castling or '-'} {en_passant} "
+                f"{self.halfmove_clock} {self.fullmove_number}")
+
+    def repetition_window(self):
+        # Zobrist keys of the positions since the last capture or pawn move, oldest first and
+        # ending with the current one. Earlier positions can never occur again.
+        return self.position_history[-(self.halfmove_clock + 1):]
+
+    def snapshot(self):
+        return Snapshot(
+            bytes(SNAPSHOT_BYTES[piece] for row in self.board for piece in row), self.turn,
+            self.get_castling_rights(), self.en_passant_target, self.halfmove_clock, self.fullmove_number,
+            self.zobrist_key, tuple(self.repetition_window()),
+        )
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        # New game in the position of a Snapshot. Moves played before the snapshot cannot be
+        # taken back, but repetitions of positions in its window still count.
+        game = cls.__new__(cls)
+        game.restore(snapshot)
+        return game
+
+    def restore(self, snapshot):
+        # Set up the position of a Snapshot, dropping the undo stack
+        self.board = [[SNAPSHOT_PIECES[code] for code in snapshot.board[row * 8:row * 8 + 8]] for row in range(8)]
+        self.turn = snapshot.turn
+        self.white_rook_moved, self.black_rook_moved = {}, {}
+        self.set_castling_rights(snapshot.castling_rights)
+        self.en_passant_target = snapshot.en_passant_target
+        self.halfmove_clock = snapshot.halfmove_clock
+        self.fullmove_number = snapshot.fullmove_number
+        self.white_king_position = self.black_king_position = None
+        for square, code in enumerate(snapshot.board):
+            if SNAPSHOT_PIECES[code][1] == "k":
+                if SNAPSHOT_PIECES[code] == "wk":
+                    self.white_king_position = divmod(square, 8)
+                else:
+                    self.black_king_position = divmod(square, 8)
+        self.evaluation = self.compute_evaluation()
+        self.zobrist_key = snapshot.zobrist_key
+        self.position_history = list(snapshot.history)
+        self.position_counts = {}
+        for key in self.position_history:
+            self.position_counts[key] = self.position_counts.get(key, 0) + 1
+        self.reset_attack_counts()
+        self.undo_stack = []
+        self.status = None
+
+    def clone(self):
+        # Independent copy of the game in its current position, at a cost that does not grow
+        # with the number of moves played: only the repetition window of the history is
+        # copied, and like from_snapshot the copy cannot take back earlier moves
+        game = self.__class__.__new__(self.__class__)
+        game.__dict__.update(self.__dict__)
+        game.board = [row[:] for row in self.board]
+        game.white_rook_moved = dict(self.white_rook_moved)
+        game.black_rook_moved = dict(self.black_rook_moved)
+        game.position_history = self.repetition_window()
+        game.position_counts = {}
+        for key in game.position_history:
+            game.position_counts[key] = game.position_counts.get(key, 0) + 1
+        self.copy_board_maps(game)
+        game.undo_stack = []
+        return game
+
+    def copy_board_maps(self, game):
+        # Give a clone its own copy of the structures derived from the board
+        game.attack_counts = {color: [row[:] for row in rows] for color, rows in self.attack_counts.items()}
+
     def get_board_state(self):
         # Convert the current board state to a tuple of tuples (immutable)
         return tuple(tuple(row) for row in self.board)
 
+    def compute_evaluation(self):
+        # Material and piece-square score for white, summed over the whole board
+        return sum(PIECE_SQUARE_VALUES[self.board[row][col]][row * 8 + col] for row in range(8) for col in range(8))
+
+    def evaluate(self):
+        # Static evaluation in centipawns for the side to move
+        return self.evaluation if self.turn == "white" else -self.evaluation
+
+    def compute_zobrist_key(self):
+        # Hash the whole position from scratch; make_move keeps self.zobrist_key up to date incrementally
+        key = 0
+        for row in range(8):
+            for col in range(8):
+                key ^= ZOBRIST_PIECES[self.board[row][col]][row * 8 + col]
+        if self.turn == "black":
+            key ^= ZOBRIST_BLACK_TO_MOVE
+        return key ^ self.get_rights_key()
+
+    def get_rights_key(self):
+        # Zobrist component for the castling rights and the en passant square
+        key = 0
+        if not self.white_king_moved:
+            if not self.white_rook_moved["left"]:
+                key ^= ZOBRIST_CASTLING[0]
+            if not self.white_rook_moved["right"]:
+                key ^= ZOBRIST_CASTLING[1]
+        if not self.black_king_moved:
+            if not self.black_rook_moved["left"]:
+                key ^= ZOBRIST_CASTLING[2]
+            if not self.black_rook_moved["right"]:
+                key ^= ZOBRIST_CASTLING[3]
+
+        # The en passant square only changes the position if a pawn can actually capture there
+        if self.en_passant_target:
+            row, col = self.en_passant_target
+            pawn_row, pawn = (4, "bp") if row == 5 else (3, "wp")
+            if (col > 0 and self.board[pawn_row][col - 1] == pawn) or (col < 7 and self.board[pawn_row][col + 1] == pawn):
+                key ^= ZOBRIST_EN_PASSANT[col]
+        return key
+
     def update_position_history(self):
-        # Add the current board state to the position history
-        self.position_history.append(self.get_board_state())
+        # Record the current position for threefold repetition checks
+        self.position_history.append(self.zobrist_key)
+        self.position_counts[self.zobrist_key] = self.position_counts.get(self.zobrist_key, 0) + 1
 
     def is_threefold_repetition(self):
-        current_state = self.get_board_state()
-        return self.position_history.count(current_state) >= 3
+        return self.position_counts.get(self.zobrist_key, 0) >= 3
 
     def is_valid_position(self, row, col):
         # Check if the row and column are within bounds of the 8x8 board
@@ -69,149 +600,230 @@ class ChessGame:
             return True
         return False
 
+    def set_piece(self, row, col, piece):
+        # Every board write goes through here so alternative board backends can stay in sync
+        old_piece = self.board[row][col]
+        self.zobrist_key ^= ZOBRIST_PIECES[old_piece][row * 8 + col] ^ ZOBRIST_PIECES[piece][row * 8 + col]
+        self.evaluation += PIECE_SQUARE_VALUES[piece][row * 8 + col] - PIECE_SQUARE_VALUES[old_piece][row * 8 + col]
+        self.board[row][col] = piece
+        self.update_attack_counts(row, col, old_piece, piece)
+
+    def reset_attack_counts(self):
+        # Rebuild the attack maps from scratch: attack_counts[color][row][col] is the number
+        # of that color's pieces attacking (or defending) the square
+        self.attack_counts = {"w": [[0] * 8 for _ in range(8)], "b": [[0] * 8 for _ in range(8)]}
+        for row in range(8):
+            for col in range(8):
+                if self.board[row][col] != "  ":
+                    self.add_attacks(row, col, self.board[row][col], 1)
+
+    def add_attacks(self, row, col, piece, delta):
+        # Add delta to the count of every square the piece on (row, col) attacks
+        counts = self.attack_counts[piece[0]]
+        square = row * 8 + col
+        kind = piece[1]
+        if kind == "p":
+            targets = PAWN_CAPTURES[piece[0]][square]
+        elif kind == "n":
+            targets = KNIGHT_TARGETS[square]
+        elif kind == "k":
+            targets = KING_TARGETS[square]
+        else:
+            rays = ROOK_RAYS[square] if kind == "r" else BISHOP_RAYS[square] if kind == "b" else QUEEN_RAYS[square]
+            board = self.board
+            for ray in rays:
+                for target_row, target_col in ray:
+                    counts[target_row][target_col] += delta
+                    if board[target_row][target_col] != "  ":
+                        break
+            return
+        for target_row, target_col in targets:
+            counts[target_row][target_col] += delta
+
+    def update_attack_counts(self, row, col, old_piece, piece):
+        # Keep the attack maps in step with one square changing from old_piece to piece.
+        # Only squares other than (row, col) are read, so this works before or after the write.
+        if old_piece != "  ":
+            self.add_attacks(row, col, old_piece, -1)
+
+        # When the square empties or fills, sliders whose rays run through it now see
+        # further along that ray, or stop short at it
+        if (old_piece == "  ") != (piece == "  "):
+            delta = 1 if piece == "  " else -1
+            board = self.board
+            square = row * 8 + col
+            for rays, sliders in ((ROOK_RAYS[square], "rq"), (BISHOP_RAYS[square], "bq")):
+                for index in range(4):
+                    # Directions come in opposite pairs two apart in the ray tables
+                    for behind_row, behind_col in rays[(index + 2) % 4]:
+                        behind = board[behind_row][behind_col]
+                        if behind != "  ":
+                            if behind[1] in sliders:
+                                counts = self.attack_counts[behind[0]]
+                                for target_row, target_col in rays[index]:
+                                    counts[target_row][target_col] += delta
+                                    if board[target_row][target_col] != "  ":
+                                        break
+                            break
+
+        if piece != "  ":
+            self.add_attacks(row, col, piece, 1)
+
     def get_legal_moves_for_pawn(self, row, col, piece):
         moves = set()
         direction = -1 if piece == "wp" else 1  # White pawns move up, black pawns move down
         
         # Regular forward move
-        if self.is_valid_position(row + direction, col) and not self.is_piece_at_position(row + direction, col):
+        if 0 <= row + direction < 8 and self.board[row + direction][col] == "  ":
             moves.add((row + direction, col))
             # Double forward move on the first turn
             if (piece == "wp" and row == 6) or (piece == "bp" and row == 1):
-                if not self.is_piece_at_position(row + 2 * direction, col):
+                if self.board[row + 2 * direction][col] == "  ":
                     moves.add((row + 2 * direction, col))
         
         # Capturing diagonally
-        for diag_col in [col - 1, col + 1]:
-            if self.is_valid_position(row + direction, diag_col):
-                if self.is_piece_at_position(row + direction, diag_col):
-                    if piece == "wp" and self.board[row + direction][diag_col].startswith('b'):
-                        moves.add((row + direction, diag_col))
-                    elif piece == "bp" and self.board[row + direction][diag_col].startswith('w'):
-                        moves.add((row + direction, diag_col))
+        enemy_color = "b" if piece == "wp" else "w"
+        captures = PAWN_CAPTURES[piece[0]][row * 8 + col]
+        for target_row, target_col in captures:
+            if self.board[target_row][target_col][0] == enemy_color:
+                moves.add((target_row, target_col))
         
         # En passant
-        if self.en_passant_target:
-            if self.en_passant_target == (row + direction, col - 1) or self.en_passant_target == (row + direction, col + 1):
-                moves.add(self.en_passant_target)
+        if self.en_passant_target in captures:
+            moves.add(self.en_passant_target)
 
         return moves
 
-    def get_legal_moves_for_king(self, row, col, piece):
+    def get_step_moves(self, targets, color):
+        # Moves of a knight or king: every target square that is empty or holds an enemy piece
+        board = self.board
+        return {(row, col) for row, col in targets if board[row][col][0] != color}
+
+    def get_sliding_moves(self, rays, color):
+        # Moves of a sliding piece: walk each ray until the edge, an own piece, or a capture
         moves = set()
-        directions = [
-            (-1, 0), (1, 0), (0, -1), (0, 1),  # Vertical and horizontal
-            (-1, -1), (-1, 1), (1, -1), (1, 1)  # Diagonals
-        ]
-        
-        for d_row, d_col in directions:
-            new_row, new_col = row + d_row, col + d_col
-            if self.is_valid_position(new_row, new_col):
-                if not self.is_piece_at_position(new_row, new_col) or not self.is_own_piece(new_row, new_col):
-                    moves.add((new_row, new_col))
+        board = self.board
+        for ray in rays:
+            for row, col in ray:
+                target = board[row][col]
+                if target == "  ":  # Empty square
+                    moves.add((row, col))
+                else:
+                    if target[0] != color:  # Capture opponent's piece
+                        moves.add((row, col))
+                    break
+        return moves
+
+    def get_legal_moves_for_king(self, row, col, piece):
+        moves = self.get_step_moves(KING_TARGETS[row * 8 + col], piece[0])
         
         # Add castling moves
         moves.update(self.get_castling_moves())
         
         return moves
-    
-    
-    def get_legal_moves_for_queen(self, row, col, piece):
-        moves = set()
-        
-        # Directions: vertical, horizontal, and diagonal movements
-        directions = [
-            (-1, 0), (1, 0), (0, -1), (0, 1),  # Vertical and horizontal
-            (-1, -1), (-1, 1), (1, -1), (1, 1)  # Diagonals
-        ]
-        
-        for d_row, d_col in directions:
-            new_row, new_col = row + d_row, col + d_col
-            # Keep moving in the same direction until blocked or reaching the edge
-            while self.is_valid_position(new_row, new_col):
-                if not self.is_piece_at_position(new_row, new_col):  # Empty square
-                    moves.add((new_row, new_col))
-                elif not self.is_own_piece(new_row, new_col):  # Capture opponent's piece
-                    moves.add((new_row, new_col))
-                    break
-                else:
-                    break  # Blocked by own piece
-                new_row += d_row
-                new_col += d_col
 
-        return moves
+    def get_legal_moves_for_queen(self, row, col, piece):
+        return self.get_sliding_moves(QUEEN_RAYS[row * 8 + col], piece[0])
     
     def get_legal_moves_for_bishop(self, row, col, piece):
-        moves = set()
-        # Directions: Diagonal movements
-        directions = [
-            (-1, -1), (-1, 1), (1, -1), (1, 1)  # Diagonals
-        ]
-        
-        for d_row, d_col in directions:
-            new_row, new_col = row + d_row, col + d_col
-            while self.is_valid_position(new_row, new_col):
-                if not self.is_piece_at_position(new_row, new_col):
-                    moves.add((new_row, new_col))
-                elif not self.is_own_piece(new_row, new_col):
-                    moves.add((new_row, new_col))
-                    break
-                else:
-                    break
-                new_row += d_row
-                new_col += d_col
-        
-        return moves
-    
-    
+        return self.get_sliding_moves(BISHOP_RAYS[row * 8 + col], piece[0])
+
     def get_legal_moves_for_knight(self, row, col, piece):
-        moves = set()
-        # Possible knight moves (L-shaped)
-        knight_moves = [
-            (-2, -1), (-2, 1), (2, -1), (2, 1),  # Vertical L-shapes
-            (-1, -2), (-1, 2), (1, -2), (1, 2)   # Horizontal L-shapes
-        ]
-        
-        for d_row, d_col in knight_moves:
-            new_row, new_col = row + d_row, col + d_col
-            if self.is_valid_position(new_row, new_col):
-                if not self.is_piece_at_position(new_row, new_col) or not self.is_own_piece(new_row, new_col):
-                    moves.add((new_row, new_col))
-        
-        return moves
-    
-    
+        return self.get_step_moves(KNIGHT_TARGETS[row * 8 + col], piece[0])
+
     def get_legal_moves_for_rook(self, row, col, piece):
-        moves = set()
-        # Directions: Vertical and horizontal movements
-        directions = [
-            (-1, 0), (1, 0), (0, -1), (0, 1)  # Vertical and horizontal
-        ]
-        
-        for d_row, d_col in directions:
-            new_row, new_col = row + d_row, col + d_col
-            while self.is_valid_position(new_row, new_col):
-                if not self.is_piece_at_position(new_row, new_col):
-                    moves.add((new_row, new_col))
-                elif not self.is_own_piece(new_row, new_col):
-                    moves.add((new_row, new_col))
-                    break
-                else:
-                    break
-                new_row += d_row
-                new_col += d_col
-        
-        return moves
+        return self.get_sliding_moves(ROOK_RAYS[row * 8 + col], piece[0])
+
+    def get_check_and_pin_info(self, color=None):
+        # Look outward from the king of the given color (by default the side to move) once and return
+        # (number of pieces giving check, squares that resolve a single check, {pinned square: squares it may move to})
+        color = color or self.turn
+        own_color = "w" if color == "white" else "b"
+        enemy_color = "b" if own_color == "w" else "w"
+        king_row, king_col = self.white_king_position if color == "white" else self.black_king_position
+        king_square = king_row * 8 + king_col
+        board = self.board
+        checkers = 0
+        evasions = set()
+        pins = {}
+
+        # The attack map tells whether there is any check at all before looking for the checkers
+        if self.attack_counts[enemy_color][king_row][king_col]:
+            # Knight checks
+            for target_row, target_col in KNIGHT_TARGETS[king_square]:
+                if board[target_row][target_col] == enemy_color + "n":
+                    checkers += 1
+                    evasions.add((target_row, target_col))
+
+            # Pawn checks come from the squares a pawn of our color would capture on
+            for target_row, target_col in PAWN_CAPTURES[own_color][king_square]:
+                if board[target_row][target_col] == enemy_color + "p":
+                    checkers += 1
+                    evasions.add((target_row, target_col))
+
+        # Sliding checks and pins along the eight lines through the king
+        for rays, sliders in ((ROOK_RAYS[king_square], "rq"), (BISHOP_RAYS[king_square], "bq")):
+            for ray in rays:
+                pinned = None
+                for index, (target_row, target_col) in enumerate(ray):
+                    piece = board[target_row][target_col]
+                    if piece == "  ":
+                        continue
+                    if piece[0] == own_color:
+                        # A second own piece on the line shields the first one
+                        if pinned:
+                            break
+                        pinned = (target_row, target_col)
+                    else:
+                        if piece[1] in sliders:
+                            if pinned:
+                                pins[pinned] = set(ray[:index + 1])
+                            else:
+                                checkers += 1
+                                evasions.update(ray[:index + 1])
+                        break
+
+        return checkers, evasions, pins
+
+    def get_legal_king_moves(self, row, col, piece):
+        enemy_color = "b" if piece.startswith('w') else "w"
+        enemy_counts = self.attack_counts[enemy_color]
+        in_check = enemy_counts[row][col] > 0
+        legal_moves = set()
+        for dest_row, dest_col in self.get_legal_moves_for_king(row, col, piece):
+            if enemy_counts[dest_row][dest_col]:
+                continue
+            # The king shields the square behind it from a slider checking along that line,
+            # so the attack map does not show that square as attacked yet
+            if in_check and self.is_behind_king(row, col, dest_row, dest_col, enemy_color):
+                continue
+            legal_moves.add((dest_row, dest_col))
+        return legal_moves
 
+    def is_behind_king(self, king_row, king_col, dest_row, dest_col, enemy_color):
+        # Whether an enemy slider looks at the king from the far side of dest along one line
+        d_row, d_col = king_row - dest_row, king_col - dest_col
+        sliders = "rq" if d_row == 0 or d_col == 0 else "bq"
+        new_row, new_col = king_row + d_row, king_col + d_col
+        while 0 <= new_row < 8 and 0 <= new_col < 8:
+            piece = self.board[new_row][new_col]
+            if piece != "  ":
+                return piece[0] == enemy_color and piece[1] in sliders
+            new_row += d_row
+            new_col += d_col
+        return False
 
-    def get_legal_moves(self, row, col):
+    def get_legal_moves(self, row, col, check_info=None):
+        # check_info is the result of get_check_and_pin_info for the piece's color; callers
+        # generating moves for several pieces pass it in so it is only computed once
         piece = self.board[row][col]
         pseudo_legal_moves = set()
 
+        if piece == "wk" or piece == "bk":
+            return self.get_legal_king_moves(row, col, piece)
+
         if piece == "wp" or piece == "bp":
             pseudo_legal_moves = self.get_legal_moves_for_pawn(row, col, piece)
-        elif piece == "wk" or piece == "bk":
-            pseudo_legal_moves = self.get_legal_moves_for_king(row, col, piece)
         elif piece == "wq" or piece == "bq":
             pseudo_legal_moves = self.get_legal_moves_for_queen(row, col, piece)
         elif piece == "wr" or piece == "br":
@@ -221,133 +833,333 @@ class ChessGame:
         elif piece == "wn" or piece == "bn":
             pseudo_legal_moves = self.get_legal_moves_for_knight(row, col, piece)
 
-        # Filter out moves that would put the king in check
-        legal_moves = set()
-        for move in pseudo_legal_moves:
-            if self.is_move_safe(row, col, move[0], move[1]):
-                legal_moves.add(move)
+        if check_info is None:
+            check_info = self.get_check_and_pin_info("white" if piece.startswith('w') else "black")
+        checkers, evasions, pins = check_info
 
-        return legal_moves
-    
-    def is_move_safe(self, src_row, src_col, dest_row, dest_col):
-        # Save the current state
-        piece = self.board[src_row][src_col]
-        captured_piece = self.board[dest_row][dest_col]
-        original_king_pos = self.white_king_position if piece.startswith('w') else self.black_king_position
+        # In double check only the king can move
+        if checkers > 1:
+            return set()
 
-        # Make the move
-        self.board[dest_row][dest_col] = piece
-        self.board[src_row][src_col] = "  "
+        # En passant removes two pieces from the board, so it gets a full safety check
+        en_passant = None
+        if piece[1] == "p" and self.en_passant_target in pseudo_legal_moves:
+            en_passant = self.en_passant_target
+            pseudo_legal_moves.discard(en_passant)
 
-        # Update king position if king is moved
-        if piece in ["wk", "bk"]:
-            if piece == "wk":
-                self.white_king_position = (dest_row, dest_col)
-            else:
-                self.black_king_position = (dest_row, dest_col)
+        # Pinned pieces stay on the pin line, and a check must be captured or blocked
+        legal_moves = pseudo_legal_moves
+        if (row, col) in pins:
+            legal_moves &= pins[(row, col)]
+        if checkers:
+            legal_moves &= evasions
 
-        # Check if the king is in check after the move
-        king_in_check = self.is_king_in_check()
+        if en_passant and self.is_move_safe(row, col, en_passant[0], en_passant[1]):
+            legal_moves.add(en_passant)
 
-        # Undo the move
-        self.board[src_row][src_col] = piece
-        self.board[dest_row][dest_col] = captured_piece
-        if piece in ["wk", "bk"]:
-            if piece == "wk":
-                self.white_king_position = original_king_pos
-            else:
-                self.black_king_position = original_king_pos
+        return legal_moves
+    
+    def is_move_safe(self, src_row, src_col, dest_row, dest_col):
+        # Play the move in place, see whether it leaves the mover's king in check, then take it back
+        color = "white" if self.board[src_row][src_col].startswith('w') else "black"
+        self.make_move(((src_row, src_col), (dest_row, dest_col)))
+        king_in_check = self.is_king_in_check(color)
+        self.unmake_move()
 
         # Return True if the move is safe (doesn't put or leave the king in check)
         return not king_in_check
 
-
-
-    def move_piece(self, src_row, src_col, dest_row, dest_col):
-        if not self.is_valid_position(src_row, src_col) or not self.is_valid_position(dest_row, dest_col):
-            print("Invalid position. Try again.")
-            return False
-
+    def get_castling_rights(self):
+        # All castling flags as one tuple, in the order stored by UndoRecord
+        return (
+            self.white_king_moved, self.black_king_moved,
+            self.white_rook_moved["left"], self.white_rook_moved["right"],
+            self.black_rook_moved["left"], self.black_rook_moved["right"],
+        )
+
+    def set_castling_rights(self, castling_rights):
+        (self.white_king_moved, self.black_king_moved,
+         self.white_rook_moved["left"], self.white_rook_moved["right"],
+         self.black_rook_moved["left"], self.black_rook_moved["right"]) = castling_rights
+
+    def make_move(self, move):
+        # Play move = ((src_row, src_col), (dest_row, dest_col)[, promotion]) without any
+        # legality checks and push an UndoRecord so unmake_move can take it back exactly
+        (src_row, src_col), (dest_row, dest_col) = move[0], move[1]
         piece = self.board[src_row][src_col]
-        
-        if piece == "  ":
-            print("No piece at the source position. Try again.")
-            return False
-        
-        if (self.turn == "white" and not piece.startswith('w')) or (self.turn == "black" and not piece.startswith('b')):
-            print(f"It's {self.turn}'s turn. You can only move your own pieces.")
-            return False
+        captured_piece = self.board[dest_row][dest_col]
+        captured_position = (dest_row, dest_col)
 
-        legal_moves = self.get_legal_moves(src_row, src_col)
-        if (dest_row, dest_col) not in legal_moves:
-            print("Illegal move. Try again.")
-            return False
+        # En passant: the captured pawn sits beside the moving pawn, not on the destination
+        if piece[1] == "p" and captured_piece == "  " and (dest_row, dest_col) == self.en_passant_target:
+            captured_position = (src_row, dest_col)
+            captured_piece = self.board[src_row][dest_col]
+
+        self.undo_stack.append(UndoRecord(
+            move, piece, captured_piece, captured_position, self.en_passant_target,
+            self.get_castling_rights(), self.white_king_position, self.black_king_position,
+            self.zobrist_key, self.status, self.halfmove_clock,
+        ))
+        self.zobrist_key ^= self.get_rights_key()
+        self.status = None
 
         # Perform the move
-        captured_piece = self.board[dest_row][dest_col]
-        self.board[dest_row][dest_col] = piece
-        self.board[src_row][src_col] = "  "
+        if captured_position != (dest_row, dest_col):
+            self.set_piece(captured_position[0], captured_position[1], "  ")
+        self.set_piece(src_row, src_col, "  ")
+
+        # Handle promotion, defaulting to a queen when no piece is given
+        if piece[1] == "p" and dest_row in (0, 7):
+            self.set_piece(dest_row, dest_col, piece[0] + (move[2] if len(move) > 2 and move[2] else "q"))
+        else:
+            self.set_piece(dest_row, dest_col, piece)
 
         # Handle castling
-        if piece in ["wk", "bk"] and abs(dest_col - src_col) == 2:
+        if piece[1] == "k" and abs(dest_col - src_col) == 2:
             # Kingside castling
             if dest_col > src_col:
                 rook_src_col, rook_dest_col = 7, 5
             # Queenside castling
             else:
                 rook_src_col, rook_dest_col = 0, 3
-            
-            rook = self.board[src_row][rook_src_col]
-            self.board[src_row][rook_dest_col] = rook
-            self.board[src_row][rook_src_col] = "  "
+            self.set_piece(src_row, rook_dest_col, self.board[src_row][rook_src_col])
+            self.set_piece(src_row, rook_src_col, "  ")
 
-        # Update king position
+        # Update king position and castling eligibility
         if piece == "wk":
             self.white_king_position = (dest_row, dest_col)
-        elif piece == "bk":
-            self.black_king_position = (dest_row, dest_col)
-
-        # Update castling eligibility
-        if piece == "wk":
             self.white_king_moved = True
         elif piece == "bk":
+            self.black_king_position = (dest_row, dest_col)
             self.black_king_moved = True
-        elif piece == "wr":
-            if src_col == 0:
-                self.white_rook_moved["left"] = True
-            elif src_col == 7:
-                self.white_rook_moved["right"] = True
-        elif piece == "br":
-            if src_col == 0:
-                self.black_rook_moved["left"] = True
-            elif src_col == 7:
-                self.black_rook_moved["right"] = True
-
-        # Handle en passant capture
-        if self.en_passant_target and (dest_row, dest_col) == self.en_passant_target:
-            if piece == "wp":
-                self.board[dest_row + 1][dest_col] = "  "  # Remove black pawn
-            elif piece == "bp":
-                self.board[dest_row - 1][dest_col] = "  "  # Remove white pawn
+
+        # Anything leaving or landing on a rook's starting corner ends castling on that side,
+        # which also covers a rook being captured at home
+        for corner in ((src_row, src_col), (dest_row, dest_col)):
+            if corner in ROOK_CORNERS:
+                color, side = ROOK_CORNERS[corner]
+                (self.white_rook_moved if color == "white" else self.black_rook_moved)[side] = True
 
         # Set up en passant target
-        if piece in ["wp", "bp"] and abs(dest_row - src_row) == 2:
-            self.en_passant_target = (int((src_row + dest_row) / 2), src_col)
+        if piece[1] == "p" and abs(dest_row - src_row) == 2:
+            self.en_passant_target = ((src_row + dest_row) // 2, src_col)
         else:
             self.en_passant_target = None
 
-        # Handle promotion
-        if piece == "wp" and dest_row == 0:
-            self.promote_pawn(dest_row, dest_col, "w")
-        elif piece == "bp" and dest_row == 7:
-            self.promote_pawn(dest_row, dest_col, "b")
+        # Update the move counters and switch turns
+        if piece[1] == "p" or captured_piece != "  ":
+            self.halfmove_clock = 0
+        else:
+            self.halfmove_clock += 1
+        if self.turn == "black":
+            self.fullmove_number += 1
+        self.turn = "black" if self.turn == "white" else "white"
 
-        # Update position history for threefold repetition check
+        self.zobrist_key ^= self.get_rights_key() ^ ZOBRIST_BLACK_TO_MOVE
         self.update_position_history()
 
-        # Switch turns
+    def unmake_move(self):
+        # Take back the last move played with make_move
+        record = self.undo_stack.pop()
+        (src_row, src_col), (dest_row, dest_col) = record.move[0], record.move[1]
+
+        # Forget the position being left
+        self.position_history.pop()
+        if self.position_counts[self.zobrist_key] == 1:
+            del self.position_counts[self.zobrist_key]
+        else:
+            self.position_counts[self.zobrist_key] -= 1
+
+        # Put the castling rook back
+        if record.piece[1] == "k" and abs(dest_col - src_col) == 2:
+            rook_src_col, rook_dest_col = (7, 5) if dest_col > src_col else (0, 3)
+            self.set_piece(src_row, rook_src_col, self.board[src_row][rook_dest_col])
+            self.set_piece(src_row, rook_dest_col, "  ")
+
+        # Put the moving piece back (as a pawn if it promoted) and restore any captured piece
+        self.set_piece(src_row, src_col, record.piece)
+        if record.captured_position == (dest_row, dest_col):
+            self.set_piece(dest_row, dest_col, record.captured_piece)
+        else:
+            self.set_piece(dest_row, dest_col, "  ")
+            self.set_piece(record.captured_position[0], record.captured_position[1], record.captured_piece)
+
+        self.en_passant_target = record.en_passant_target
+        self.set_castling_rights(record.castling_rights)
+        self.white_king_position = record.white_king_position
+        self.black_king_position = record.black_king_position
         self.turn = "black" if self.turn == "white" else "white"
+        if self.turn == "black":
+            self.fullmove_number -= 1
+        self.halfmove_clock = record.halfmove_clock
+        self.zobrist_key = record.zobrist_key
+        self.status = record.status
+
+    def parse_move(self, move):
+        # Move object for a UCI string, a packed move code, a Move or a make_move style tuple
+        if isinstance(move, str):
+            return Move.from_uci(move)
+        if isinstance(move, Move):
+            return move
+        if isinstance(move, int):
+            return unpack_move(move)
+        try:
+            (src_row, src_col), (dest_row, dest_col), *promotion = move
+            return Move((int(src_row), int(src_col)), (int(dest_row), int(dest_col)), *promotion)
+        except (TypeError, ValueError):
+            raise IllegalMoveError(f"Invalid move: {move!r}") from None
+
+    def validate_move(self, move):
+        # Raise IllegalMoveError unless move is legal for the side to move in this position
+        (src_row, src_col), (dest_row, dest_col), promotion = move
+        if not self.is_valid_position(src_row, src_col) or not self.is_valid_position(dest_row, dest_col):
+            raise IllegalMoveError("Invalid position.")
 
+        piece = self.board[src_row][src_col]
+        if piece == "  ":
+            raise IllegalMoveError("No piece at the source position.")
+        if not self.is_own_piece(src_row, src_col):
+            raise IllegalMoveError(f"It's {self.turn}'s turn. You can only move your own pieces.")
+        if (dest_row, dest_col) not in self.get_status().moves.get((src_row, src_col), ()):
+            raise IllegalMoveError(f"Illegal move: {move_to_uci(move)}.")
+
+        if piece[1] == "p" and dest_row in (0, 7):
+            if promotion not in ("q", "r", "b", "n"):
+                raise IllegalMoveError(f"Promotion piece (q, r, b or n) required for {move_to_uci(move)}.")
+        elif promotion is not None:
+            raise IllegalMoveError(f"Only a pawn reaching the last row can promote: {move_to_uci(move)}.")
+
+    def push(self, move):
+        # Play a move given as a UCI string, Move or move tuple. Raises IllegalMoveError
+        # (leaving the position untouched) instead of printing, and returns the Move played.
+        move = self.parse_move(move)
+        self.validate_move(move)
+        self.make_move(move)
+        return move
+
+    def pop(self):
+        # Take back the last move and return it
+        if not self.undo_stack:
+            raise IndexError("pop from a game with no moves played")
+        move = self.undo_stack[-1].move
+        self.unmake_move()
+        return Move(*move)
+
+    def get_status(self):
+        # PositionStatus of the current position. It is generated on first use and kept
+        # until the next make_move, unmake_move or load_fen, so every status query below
+        # shares one round of move generation.
+        if self.status is None:
+            moves = self.generate_all_moves()
+            legal_moves = []
+            move_codes = array("H")
+            # Moves come out by source square, then destination square, then promotion piece.
+            # This runs at every search node, so Moves are built with tuple.__new__ (skipping
+            # the namedtuple constructor) and only pawns and kings can carry a flag.
+            new_move = tuple.__new__
+            for src, dests in moves.items():
+                piece = self.board[src[0]][src[1]]
+                src_square = src[0] * 8 + src[1]
+                for dest in sorted(dests):
+                    code = src_square | (dest[0] * 8 + dest[1]) << 6
+                    if piece[1] == "p" and dest[0] in (0, 7):
+                        for promotion in "qrbn":
+                            legal_moves.append(new_move(Move, (src, dest, promotion)))
+                            move_codes.append(code | PROMOTION_PIECES.index(promotion) << 12 | MOVE_PROMOTION << 14)
+                    else:
+                        legal_moves.append(new_move(Move, (src, dest, None)))
+                        if piece[1] in "pk":
+                            code |= self.get_move_flag(piece, src, dest) << 14
+                        move_codes.append(code)
+
+            in_check = self.is_king_in_check()
+            if not legal_moves:
+                result = ("0-1" if self.turn == "white" else "1-0") if in_check else "1/2-1/2"
+            elif self.is_threefold_repetition():
+                result = "1/2-1/2"
+            else:
+                result = None
+            self.status = PositionStatus(in_check, moves, tuple(legal_moves), move_codes, result)
+        return self.status
+
+    def get_move_flag(self, piece, src, dest):
+        # MOVE_* flag of a piece moving from src to dest in this position
+        if piece[1] == "p":
+            if dest[0] in (0, 7):
+                return MOVE_PROMOTION
+            if dest == self.en_passant_target and src[1] != dest[1]:
+                return MOVE_EN_PASSANT
+        elif piece[1] == "k" and abs(dest[1] - src[1]) == 2:
+            return MOVE_CASTLING
+        return MOVE_NORMAL
+
+    def encode_move(self, move):
+        # Packed 16-bit code of a move (in any form push accepts) in this position
+        move = self.parse_move(move)
+        piece = self.board[move.src[0]][move.src[1]]
+        return pack_move(move.src, move.dest, move.promotion, self.get_move_flag(piece, move.src, move.dest))
+
+    def parse_san(self, san):
+        # Legal Move of a move in standard algebraic notation, e.g. "Nbd7", "exd6", "e8=Q+"
+        # or "O-O". Raises IllegalMoveError if it matches no legal move or more than one.
+        notation = san.rstrip("+#!?")
+        if notation in ("O-O", "0-0", "O-O-O", "0-0-0"):
+            row = 7 if self.turn == "white" else 0
+            dest = (row, 6 if len(notation) == 3 else 2)
+            candidates = [move for move in self.legal_moves()
+                          if move.src == (row, 4) and move.dest == dest and self.board[row][4][1] == "k"]
+        else:
+            promotion = None
+            if "=" in notation:
+                notation, promotion = notation.split("=", 1)
+                promotion = promotion.lower()
+            elif len(notation) > 2 and notation[-1] in "QRBN" and notation[-2] in "18":
+                notation, promotion = notation[:-1], notation[-1].lower()
+            piece = notation[0].lower() if notation[:1] in ("K", "Q", "R", "B", "N") else "p"
+            if piece != "p":
+                notation = notation[1:]
+            # Whatever precedes the destination square narrows down the source square
+            hint, dest_name = notation[:-2].replace("x", ""), notation[-2:]
+            if (len(dest_name) != 2 or dest_name[0] not in FILES or dest_name[1] not in "12345678"
+                    or any(char not in FILES and char not in "12345678" for char in hint)):
+                raise IllegalMoveError(f"Invalid SAN move: {san!r}")
+            dest = parse_square(dest_name)
+            candidates = [move for move in self.legal_moves()
+                          if move.dest == dest and move.promotion == promotion
+                          and self.board[move.src[0]][move.src[1]][1] == piece
+                          and all(char in square_name(*move.src) for char in hint)]
+        if len(candidates) != 1:
+            raise IllegalMoveError(f"{'Ambiguous' if candidates else 'Illegal'} SAN move: {san!r}")
+        return candidates[0]
+
+    def legal_moves(self):
+        # Every legal move in the position as a Move, with one Move per promotion piece
+        return self.get_status().legal_moves
+
+    def legal_move_codes(self):
+        # Every legal move as a packed 16-bit code, in the same order as legal_moves
+        return self.get_status().move_codes
+
+    def has_legal_moves(self):
+        return bool(self.get_status().legal_moves)
+
+    def result(self):
+        # "1-0", "0-1" or "1/2-1/2" once the game is over, None while it is still going
+        return self.get_status().result
+
+    def move_piece(self, src_row, src_col, dest_row, dest_col, promotion=None):
+        # Interactive wrapper around push: asks for the promotion piece when one is needed
+        # and prints why a move was rejected
+        move = Move((src_row, src_col), (dest_row, dest_col), promotion)
+        if (promotion is None and self.is_valid_position(src_row, src_col) and self.is_own_piece(src_row, src_col)
+                and self.board[src_row][src_col][1] == "p" and dest_row in (0, 7)
+                and (dest_row, dest_col) in self.get_status().moves.get((src_row, src_col), ())):
+            move = move._replace(promotion=self.promote_pawn(dest_row, dest_col, self.turn[0]))
+        try:
+            self.push(move)
+        except IllegalMoveError as error:
+            print(f"{error} Try again.")
+            return False
         return True
 
     def promote_pawn(self, row, col, color):
@@ -355,22 +1167,49 @@ class ChessGame:
         while True:
             choice = input(f"Promote pawn at {row}{col} to (q)ueen, (n)ight, (r)ook, or (b)ishop: ").lower()
             if choice in ["q", "n", "r", "b"]:
-                self.board[row][col] = color + choice
-                break
+                return choice
             else:
                 print("Invalid choice, please choose q, n, r, or b.")
                 
     def get_all_possible_moves(self):
+        return self.get_status().moves
+
+    def generate_all_moves(self):
+        # Legal destinations of every piece of the side to move, keyed by source square
         all_moves = {}
+        check_info = self.get_check_and_pin_info(self.turn)
         for row in range(8):
             for col in range(8):
                 piece = self.board[row][col]
                 if (self.turn == "white" and piece.startswith('w')) or (self.turn == "black" and piece.startswith('b')):
-                    legal_moves = self.get_legal_moves(row, col)
+                    legal_moves = self.get_legal_moves(row, col, check_info)
                     if legal_moves:
                         all_moves[(row, col)] = legal_moves
         return all_moves
 
+    def perft(self, depth):
+        # Count the leaf nodes of the legal move tree depth plies deep
+        if depth == 0:
+            return 1
+        moves = self.legal_moves()
+        if depth == 1:
+            return len(moves)
+        nodes = 0
+        for move in moves:
+            self.make_move(move)
+            nodes += self.perft(depth - 1)
+            self.unmake_move()
+        return nodes
+
+    def perft_divide(self, depth):
+        # Perft node counts split by root move, keyed by UCI move
+        counts = {}
+        for move in self.legal_moves():
+            self.make_move(move)
+            counts[move_to_uci(move)] = self.perft(depth - 1)
+            self.unmake_move()
+        return counts
+
     def display_possible_moves(self):
         all_moves = self.get_all_possible_moves()
         print(f"\nPossible moves for {self.turn.capitalize()}:")
@@ -380,88 +1219,17 @@ class ChessGame:
             print(f"Piece at {src_notation}: {', '.join(moves_notation)}")
                 
                 
-    def is_king_in_check(self):
-        king_position = self.white_king_position if self.turn == "white" else self.black_king_position
-        enemy_color = "b" if self.turn == "white" else "w"
-
-        # Check for knight threats
-        knight_moves = [
-            (-2, -1), (-2, 1), (2, -1), (2, 1),
-            (-1, -2), (-1, 2), (1, -2), (1, 2)
-        ]
-        for d_row, d_col in knight_moves:
-            new_row, new_col = king_position[0] + d_row, king_position[1] + d_col
-            if self.is_valid_position(new_row, new_col) and self.board[new_row][new_col] == enemy_color + "n":
-                return True
-
-        # Check for rook and queen threats (horizontal and vertical)
-        directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        for d_row, d_col in directions:
-            new_row, new_col = king_position[0] + d_row, king_position[1] + d_col
-            while self.is_valid_position(new_row, new_col):
-                piece = self.board[new_row][new_col]
-                if piece != "  ":
-                    if piece[0] == enemy_color and piece[1] in "rq":
-                        return True
-                    break
-                new_row += d_row
-                new_col += d_col
-
-        # Check for bishop and queen threats (diagonals)
-        directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-        for d_row, d_col in directions:
-            new_row, new_col = king_position[0] + d_row, king_position[1] + d_col
-            while self.is_valid_position(new_row, new_col):
-                piece = self.board[new_row][new_col]
-                if piece != "  ":
-                    if piece[0] == enemy_color:
-                        if piece[1] in "bq":
-                            return True
-                        if piece[1] == "p" and abs(new_row - king_position[0]) == 1:
-                            return True
-                    break
-                new_row += d_row
-                new_col += d_col
+    def is_king_in_check(self, color=None):
+        # Check the king of the given color, by default the side to move
+        color = color or self.turn
+        king_row, king_col = self.white_king_position if color == "white" else self.black_king_position
+        enemy_color = "b" if color == "white" else "w"
 
-        return False
+        return self.is_square_under_attack(king_row, king_col, enemy_color)
 
     def get_moves_out_of_check(self):
-        all_moves = self.get_all_possible_moves()
-        moves_out_of_check = {}
-
-        for src, moves in all_moves.items():
-            for move in moves:
-                # Simulate the move
-                piece = self.board[src[0]][src[1]]
-                captured_piece = self.board[move[0]][move[1]]
-                self.board[move[0]][move[1]] = piece
-                self.board[src[0]][src[1]] = "  "
-
-                # Update king position if king is moved
-                original_king_pos = None
-                if piece == "wk":
-                    original_king_pos = self.white_king_position
-                    self.white_king_position = move
-                elif piece == "bk":
-                    original_king_pos = self.black_king_position
-                    self.black_king_position = move
-
-                # Check if the king is still in check after the move
-                if not self.is_king_in_check():
-                    if src not in moves_out_of_check:
-                        moves_out_of_check[src] = set()
-                    moves_out_of_check[src].add(move)
-
-                # Undo the move
-                self.board[src[0]][src[1]] = piece
-                self.board[move[0]][move[1]] = captured_piece
-                if original_king_pos:
-                    if piece == "wk":
-                        self.white_king_position = original_king_pos
-                    else:
-                        self.black_king_position = original_king_pos
-
-        return moves_out_of_check
+        # Every legal move gets the king out of check
+        return self.get_status().moves
 
     def display_moves_out_of_check(self, moves):
         print(f"\nMoves to get out of check for {self.turn.capitalize()}:")
@@ -471,69 +1239,79 @@ class ChessGame:
             print(f"Piece at {src_notation}: {', '.join(moves_notation)}")
 
     def is_stalemate(self):
-        if self.is_king_in_check():
-            return False
-        
-        all_moves = self.get_all_possible_moves()
-        return len(all_moves) == 0
+        status = self.get_status()
+        return not status.in_check and not status.legal_moves
     
     def is_square_under_attack(self, row, col, attacking_color):
-        # Check for pawn attacks
-        pawn_direction = 1 if attacking_color == 'w' else -1
-        for d_col in [-1, 1]:
-            if self.is_valid_position(row + pawn_direction, col + d_col):
-                piece = self.board[row + pawn_direction][col + d_col]
-                if piece == attacking_color + 'p':
-                    return True
-
-        # Check for knight attacks
-        knight_moves = [
-            (-2, -1), (-2, 1), (2, -1), (2, 1),
-            (-1, -2), (-1, 2), (1, -2), (1, 2)
-        ]
-        for d_row, d_col in knight_moves:
-            new_row, new_col = row + d_row, col + d_col
-            if self.is_valid_position(new_row, new_col) and self.board[new_row][new_col] == attacking_color + 'n':
-                return True
-
-        # Check for king attacks
-        king_moves = [
-            (-1, -1), (-1, 0), (-1, 1),
-            (0, -1),           (0, 1),
-            (1, -1),  (1, 0),  (1, 1)
-        ]
-        for d_row, d_col in king_moves:
-            new_row, new_col = row + d_row, col + d_col
-            if self.is_valid_position(new_row, new_col) and self.board[new_row][new_col] == attacking_color + 'k':
-                return True
-
-        # Check for rook/queen attacks (horizontal and vertical)
-        rook_directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
-        for d_row, d_col in rook_directions:
-            new_row, new_col = row + d_row, col + d_col
-            while self.is_valid_position(new_row, new_col):
-                piece = self.board[new_row][new_col]
-                if piece != "  ":
-                    if piece[0] == attacking_color and piece[1] in "rq":
-                        return True
-                    break
-                new_row += d_row
-                new_col += d_col
-
-        # Check for bishop/queen attacks (diagonals)
-        bishop_directions = [(-1, -1), (-1, 1), (1, -1), (1, 1)]
-        for d_row, d_col in bishop_directions:
-            new_row, new_col = row + d_row, col + d_col
-            while self.is_valid_position(new_row, new_col):
-                piece = self.board[new_row][new_col]
-                if piece != "  ":
-                    if piece[0] == attacking_color and piece[1] in "bq":
-                        return True
+        return self.attack_counts[attacking_color][row][col] > 0
+
+    def get_square_attackers(self, row, col, attacking_color, removed=()):
+        # (value, row, col) of every attacking_color piece that hits (row, col), cheapest
+        # first. Pieces on removed squares neither attack nor block, so sliders lined up
+        # behind an attacker (x-rays) appear once that attacker is removed.
+        square = row * 8 + col
+        board = self.board
+        attackers = []
+        # A pawn attacks square from wherever a pawn of the other color on square would attack
+        pawn_targets = PAWN_CAPTURES["b" if attacking_color == "w" else "w"][square]
+        for targets, kind in ((pawn_targets, "p"), (KNIGHT_TARGETS[square], "n"), (KING_TARGETS[square], "k")):
+            for target_row, target_col in targets:
+                if board[target_row][target_col] == attacking_color + kind and (target_row, target_col) not in removed:
+                    attackers.append((SEE_PIECE_VALUES[kind], target_row, target_col))
+        for rays, sliders in ((ROOK_RAYS[square], "rq"), (BISHOP_RAYS[square], "bq")):
+            for ray in rays:
+                for ray_row, ray_col in ray:
+                    piece = board[ray_row][ray_col]
+                    if piece == "  " or (ray_row, ray_col) in removed:
+                        continue
+                    if piece[0] == attacking_color and piece[1] in sliders:
+                        attackers.append((SEE_PIECE_VALUES[piece[1]], ray_row, ray_col))
                     break
-                new_row += d_row
-                new_col += d_col
-
-        return False
+        attackers.sort()
+        return attackers
+
+    def see(self, move):
+        # Static exchange evaluation: material won (or lost, if negative) in centipawns by the
+        # side playing move once both sides have made every capture on its destination that
+        # pays off, cheapest attacker first. Pins and checks are not taken into account.
+        move = self.parse_move(move)
+        (src_row, src_col), (dest_row, dest_col) = move.src, move.dest
+        piece = self.board[src_row][src_col]
+        victim = self.board[dest_row][dest_col]
+        removed = {(src_row, src_col)}
+        if piece[1] == "p" and victim == "  " and src_col != dest_col:
+            # En passant
+            removed.add((src_row, dest_col))
+            victim = "bp" if piece[0] == "w" else "wp"
+        gain = SEE_PIECE_VALUES[victim[1]] if victim != "  " else 0
+        occupant = SEE_PIECE_VALUES[piece[1]]
+        if piece[1] == "p" and dest_row in (0, 7):
+            occupant = SEE_PIECE_VALUES[move.promotion or "q"]
+            gain += occupant - SEE_PIECE_VALUES["p"]
+
+        # gains[i] is the balance for the side making capture i if the exchange stopped there
+        gains = [gain]
+        color = "b" if piece[0] == "w" else "w"
+        while True:
+            attackers = self.get_square_attackers(dest_row, dest_col, color, removed)
+            if not attackers:
+                break
+            value, row, col = attackers[0]
+            other_color = "b" if color == "w" else "w"
+            # The king can only recapture if the square is not defended any more
+            if value == SEE_PIECE_VALUES["k"] and \
+                    self.get_square_attackers(dest_row, dest_col, other_color, removed | {(row, col)}):
+                break
+            gains.append(occupant - gains[-1])
+            occupant = value
+            removed.add((row, col))
+            color = other_color
+
+        # Either side may stop capturing when going on would cost it
+        while len(gains) > 1:
+            last = gains.pop()
+            gains[-1] = -max(-gains[-1], last)
+        return gains[0]
     
     
     def is_path_clear(self, start_col, end_col, row):
@@ -573,62 +1351,44 @@ class ChessGame:
         return castling_moves
     
     
-    def is_checkmate(self, color):
-        if not self.is_king_in_check():
+    def is_checkmate(self, color=None):
+        # Only the side to move can be checkmated
+        if color is not None and color != self.turn:
             return False
-        
-        # Check if any move can get the king out of check
-        for row in range(8):
-            for col in range(8):
-                piece = self.board[row][col]
-                if (color == 'white' and piece.startswith('w')) or (color == 'black' and piece.startswith('b')):
-                    legal_moves = self.get_legal_moves(row, col)
-                    if legal_moves:
-                        return False  # If there's any legal move, it's not checkmate
-        
-        return True  # No legal moves to escape check
+        status = self.get_status()
+        return status.in_check and not status.legal_moves
 
     def is_game_over(self):
-        if self.is_checkmate('white'):
-            print("Checkmate! Black wins!")
-            return True
-        elif self.is_checkmate('black'):
+        result = self.result()
+        if result is None:
+            return False
+        if result == "1-0":
             print("Checkmate! White wins!")
-            return True
-        elif self.is_stalemate():
-            print("Stalemate! The game is a draw.")
-            return True
-        elif self.is_threefold_repetition():
+        elif result == "0-1":
+            print("Checkmate! Black wins!")
+        elif self.has_legal_moves():
             print("Threefold repetition! The game is a draw.")
-            return True
-        return False
+        else:
+            print(f"Stalemate! {self.turn.capitalize()} has no legal moves. The game is a draw.")
+        return True
 
 
     def play(self):
-        # Main game loop
+        # Main game loop: a terminal client of push, legal_moves and result
         while True:
             self.print_board()  # Print the board before each move
-            
-            
+
             if self.is_game_over():
                 break
-            
+
             # Check if the current player's king is in check
-            if self.is_king_in_check():
+            if self.get_status().in_check:
                 print(f"{self.turn.capitalize()}'s king is in check!")
-                moves_out_of_check = self.get_moves_out_of_check()
-                if not moves_out_of_check:
-                    print(f"Checkmate! {self.turn.capitalize()} has no legal moves. {'Black' if self.turn == 'white' else 'White'} wins!")
-                    break
-                self.display_moves_out_of_check(moves_out_of_check)
+                self.display_moves_out_of_check(self.get_moves_out_of_check())
             else:
-                # Check for stalemate
-                if self.is_stalemate():
-                    print(f"Stalemate! {self.turn.capitalize()} has no legal moves. The game is a draw.")
-                    break
                 # Display all possible moves when not in check
                 self.display_possible_moves()
-            
+
             try:
                 # Ask for the source position (row and column) as a combined input like "66"
                 src = input(f"{self.turn.capitalize()}'s move: Select piece to move (e.g., '66'): ")
@@ -647,11 +1407,7 @@ class ChessGame:
                     continue
 
                 # Get legal moves for the selected piece
-                if self.is_king_in_check():
-                    legal_moves = moves_out_of_check.get((src_row, src_col), set())
-                else:
-                    legal_moves = self.get_legal_moves(src_row, src_col)
-
+                legal_moves = self.get_status().moves.get((src_row, src_col), set())
                 legal_moves_notation = {f"{r}{c}" for r, c in legal_moves}
                 print(f"Legal moves for the selected piece at ({src_row}{src_col}): {legal_moves_notation}")
 
@@ -661,19 +1417,457 @@ class ChessGame:
                     raise ValueError
                 dest_row, dest_col = int(dest[0]), int(dest[1])
 
-                # Check if the destination is a legal move
-                if (dest_row, dest_col) not in legal_moves:
-                    print("Invalid move: Not a legal move.")
-                    continue
-
             except (ValueError, IndexError):
                 print("Invalid input. Please enter two digits (e.g., '66').")
                 continue
 
-            # Move the piece and check for validity
-            if not self.move_piece(src_row, src_col, dest_row, dest_col):
-                print("Try again.")
-        
+            # Move the piece, asking for the promotion piece if needed
+            self.move_piece(src_row, src_col, dest_row, dest_col)
+
+
+# Bitboard backend
+# Bit n of a bitboard is square number n (row * 8 + col), so bit 0 is row 0, col 0 (the black
+# queenside corner) and bit 63 is row 7, col 7, matching the layout of ChessGame.board.
+# The attack masks below are derived from the move tables at the top of the module.
+
+COLOR_PIECES = {"w": PIECE_CODES[:6], "b": PIECE_CODES[6:]}
+
+
+def squares_to_bitboard(squares):
+    bitboard = 0
+    for row, col in squares:
+        bitboard |= 1 << (row * 8 + col)
+    return bitboard
+
+
+def _build_ray_masks(rays, directions):
+    # One mask tuple per direction, built from the ray tables and paired with whether the ray
+    # runs towards higher square numbers: the nearest blocker is then the lowest set bit of
+    # the blockers, otherwise the highest one
+    return tuple(
+        (tuple(squares_to_bitboard(square_rays[index]) for square_rays in rays), d_row > 0 or (d_row == 0 and d_col > 0))
+        for index, (d_row, d_col) in enumerate(directions)
+    )
+
+
+KNIGHT_ATTACKS = tuple(squares_to_bitboard(targets) for targets in KNIGHT_TARGETS)
+KING_ATTACKS = tuple(squares_to_bitboard(targets) for targets in KING_TARGETS)
+PAWN_ATTACKS = {color: tuple(squares_to_bitboard(targets) for targets in captures) for color, captures in PAWN_CAPTURES.items()}
+ROOK_RAY_MASKS = _build_ray_masks(ROOK_RAYS, ROOK_DIRECTIONS)
+BISHOP_RAY_MASKS = _build_ray_masks(BISHOP_RAYS, BISHOP_DIRECTIONS)
+QUEEN_RAY_MASKS = ROOK_RAY_MASKS + BISHOP_RAY_MASKS
+FULL_BOARD = (1 << 64) - 1
+
+
+def _build_between():
+    # BETWEEN[a][b] holds the squares strictly between two squares on a common line, or 0
+    between = [[0] * 64 for _ in range(64)]
+    for ray, _ in QUEEN_RAY_MASKS:
+        for square in range(64):
+            targets = ray[square]
+            while targets:
+                bit = targets & -targets
+                target = bit.bit_length() - 1
+                between[square][target] = ray[square] ^ ray[target] ^ bit
+                targets ^= bit
+    return tuple(tuple(row) for row in between)
+
+
+BETWEEN = _build_between()
+
+
+def sliding_attacks(square, occupied, rays):
+    # Squares a slider on square attacks, stopping each ray at the first occupied square
+    attacks = 0
+    for ray, ascending in rays:
+        mask = ray[square]
+        blockers = mask & occupied
+        if blockers:
+            if ascending:
+                blocker = (blockers & -blockers).bit_length() - 1
+            else:
+                blocker = blockers.bit_length() - 1
+            mask ^= ray[blocker]
+        attacks |= mask
+    return attacks
+
+
+def sliding_attackers(square, occupied, rays, sliders):
+    # Sliders that see square: only rays holding one of them are scanned, and a ray
+    # contributes its nearest blocker when that blocker is one of the sliders. Sliders
+    # missing from occupied (taken off the board by an exchange) are ignored.
+    attackers = 0
+    for ray, ascending in rays:
+        blockers = ray[square] & occupied
+        if blockers & sliders:
+            if ascending:
+                nearest = blockers & -blockers
+            else:
+                nearest = 1 << (blockers.bit_length() - 1)
+            attackers |= nearest & sliders
+    return attackers
+
+
+def bitboard_squares(bitboard):
+    # Convert a bitboard into the set of (row, col) tuples used by the ChessGame API
+    squares = set()
+    while bitboard:
+        lowest_bit = bitboard & -bitboard
+        squares.add(SQUARES[lowest_bit.bit_length() - 1])
+        bitboard ^= lowest_bit
+    return squares
+
+
+class BitboardChessGame(ChessGame):
+    # Same rules and API as ChessGame, but the position is mirrored into one 64-bit integer
+    # per piece type and color plus occupancy masks, and moves are generated with bit operations
+    def __init__(self):
+        super().__init__()
+        self.sync_bitboards()
+
+    def restore(self, snapshot):
+        super().restore(snapshot)
+        self.sync_bitboards()
+
+    def copy_board_maps(self, game):
+        game.bitboards = dict(self.bitboards)
+        game.occupancy = dict(self.occupancy)
+
+    def sync_bitboards(self):
+        # Rebuild every bitboard from self.board
+        self.bitboards = {piece: 0 for piece in PIECE_CODES}
+        self.occupancy = {"w": 0, "b": 0}
+        for row in range(8):
+            for col in range(8):
+                piece = self.board[row][col]
+                if piece != "  ":
+                    bit = 1 << (row * 8 + col)
+                    self.bitboards[piece] |= bit
+                    self.occupancy[piece[0]] |= bit
+        self.occupied = self.occupancy["w"] | self.occupancy["b"]
+
+    def set_piece(self, row, col, piece):
+        bit = 1 << (row * 8 + col)
+        old_piece = self.board[row][col]
+        if old_piece != "  ":
+            self.bitboards[old_piece] ^= bit
+            self.occupancy[old_piece[0]] ^= bit
+        if piece != "  ":
+            self.bitboards[piece] |= bit
+            self.occupancy[piece[0]] |= bit
+        self.occupied = self.occupancy["w"] | self.occupancy["b"]
+        super().set_piece(row, col, piece)
+
+    def reset_attack_counts(self):
+        # Attack queries are answered straight from the bitboards, so no attack maps are kept
+        pass
+
+    def update_attack_counts(self, row, col, old_piece, piece):
+        pass
+
+    def get_attackers(self, square, attacking_color, occupied):
+        # Bitboard of attacking_color pieces that hit square, with sliders blocked by occupied
+        bitboards = self.bitboards
+        pawn, knight, bishop, rook, queen, king = COLOR_PIECES[attacking_color]
+        rooks = bitboards[rook] | bitboards[queen]
+        bishops = bitboards[bishop] | bitboards[queen]
+        # A pawn attacks square from wherever a pawn of the other color on square would attack
+        attackers = PAWN_ATTACKS["b" if attacking_color == "w" else "w"][square] & bitboards[pawn]
+        attackers |= KNIGHT_ATTACKS[square] & bitboards[knight]
+        attackers |= KING_ATTACKS[square] & bitboards[king]
+        if rooks:
+            attackers |= sliding_attackers(square, occupied, ROOK_RAY_MASKS, rooks)
+        if bishops:
+            attackers |= sliding_attackers(square, occupied, BISHOP_RAY_MASKS, bishops)
+        return attackers
+
+    def is_square_under_attack(self, row, col, attacking_color):
+        return self.get_attackers(row * 8 + col, attacking_color, self.occupied) != 0
+
+    def get_square_attackers(self, row, col, attacking_color, removed=()):
+        occupied = self.occupied
+        for removed_row, removed_col in removed:
+            occupied &= ~(1 << (removed_row * 8 + removed_col))
+        attackers = self.get_attackers(row * 8 + col, attacking_color, occupied) & occupied
+        return sorted(
+            (SEE_PIECE_VALUES[self.board[attacker_row][attacker_col][1]], attacker_row, attacker_col)
+            for attacker_row, attacker_col in bitboard_squares(attackers)
+        )
+
+    def is_king_in_check(self, color=None):
+        color = color or self.turn
+        own_color = "w" if color == "white" else "b"
+        king_square = self.bitboards[own_color + "k"].bit_length() - 1
+        return self.get_attackers(king_square, "b" if own_color == "w" else "w", self.occupied) != 0
+
+    def is_move_safe(self, src_row, src_col, dest_row, dest_col):
+        # Apply the move to a copy of the occupancy only and look for attackers of the king
+        piece = self.board[src_row][src_col]
+        color = piece[0]
+        enemy_color = "b" if color == "w" else "w"
+        dest_bit = 1 << (dest_row * 8 + dest_col)
+        occupied = (self.occupied ^ (1 << (src_row * 8 + src_col))) | dest_bit
+        captured = dest_bit
+
+        # An en passant capture also clears the square of the captured pawn
+        if piece[1] == "p" and (dest_row, dest_col) == self.en_passant_target and self.board[dest_row][dest_col] == "  ":
+            captured_bit = 1 << (src_row * 8 + dest_col)
+            occupied ^= captured_bit
+            captured |= captured_bit
+
+        if piece[1] == "k":
+            king_square = dest_row * 8 + dest_col
+        else:
+            king_square = self.bitboards[color + "k"].bit_length() - 1
+
+        return not self.get_attackers(king_square, enemy_color, occupied) & ~captured
+
+    def is_path_clear(self, start_col, end_col, row):
+        low_col, high_col = min(start_col, end_col), max(start_col, end_col)
+        between = ((1 << (high_col - low_col - 1)) - 1) << (row * 8 + low_col + 1)
+        return not self.occupied & between
+
+    def get_piece_targets(self, square, piece):
+        # Pseudo-legal destinations of a piece as a bitboard, without en passant and castling
+        kind = piece[1]
+        own_pieces = self.occupancy[piece[0]]
+        if kind == "n":
+            return KNIGHT_ATTACKS[square] & ~own_pieces
+        if kind == "b":
+            return sliding_attacks(square, self.occupied, BISHOP_RAY_MASKS) & ~own_pieces
+        if kind == "r":
+            return sliding_attacks(square, self.occupied, ROOK_RAY_MASKS) & ~own_pieces
+        if kind == "q":
+            return sliding_attacks(square, self.occupied, QUEEN_RAY_MASKS) & ~own_pieces
+        if kind == "k":
+            return KING_ATTACKS[square] & ~own_pieces
+
+        color = piece[0]
+        targets = PAWN_ATTACKS[color][square] & self.occupancy["b" if color == "w" else "w"]
+
+        # Forward moves, including the double step from the starting row
+        step = -8 if color == "w" else 8
+        one_step = square + step
+        if 0 <= one_step < 64 and not (self.occupied >> one_step) & 1:
+            targets |= 1 << one_step
+            if square // 8 == (6 if color == "w" else 1) and not (self.occupied >> (one_step + step)) & 1:
+                targets |= 1 << (one_step + step)
+        return targets
+
+    def can_capture_en_passant(self, square, piece):
+        if not self.en_passant_target:
+            return False
+        target_row, target_col = self.en_passant_target
+        return (PAWN_ATTACKS[piece[0]][square] >> (target_row * 8 + target_col)) & 1
+
+    def get_legal_moves_for_pawn(self, row, col, piece):
+        moves = bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+        if self.can_capture_en_passant(row * 8 + col, piece):
+            moves.add(self.en_passant_target)
+        return moves
+
+    def get_legal_moves_for_king(self, row, col, piece):
+        moves = bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+        moves.update(self.get_castling_moves())
+        return moves
+
+    def get_legal_moves_for_queen(self, row, col, piece):
+        return bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+
+    def get_legal_moves_for_bishop(self, row, col, piece):
+        return bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+
+    def get_legal_moves_for_knight(self, row, col, piece):
+        return bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+
+    def get_legal_moves_for_rook(self, row, col, piece):
+        return bitboard_squares(self.get_piece_targets(row * 8 + col, piece))
+
+    def get_check_and_pin_info(self, color=None):
+        # Same contract as ChessGame.get_check_and_pin_info, with bitboards in place of sets:
+        # (checkers bitboard, mask of squares that resolve the check, {pinned square: allowed mask})
+        color = color or self.turn
+        own_color = "w" if color == "white" else "b"
+        enemy_color = "b" if own_color == "w" else "w"
+        bitboards = self.bitboards
+        king_square = bitboards[own_color + "k"].bit_length() - 1
+
+        checkers = self.get_attackers(king_square, enemy_color, self.occupied)
+        if not checkers:
+            evasions = FULL_BOARD
+        elif checkers & (checkers - 1):
+            # Double check: only the king can move
+            evasions = 0
+        else:
+            evasions = checkers | BETWEEN[king_square][checkers.bit_length() - 1]
+
+        # A piece is pinned when it is the first piece on a line from the king and the
+        # second one is an enemy slider moving along that line
+        pins = {}
+        own_pieces = self.occupancy[own_color]
+        _, _, bishop, rook, queen, _ = COLOR_PIECES[enemy_color]
+        for rays, sliders in ((ROOK_RAY_MASKS, bitboards[rook] | bitboards[queen]),
+                              (BISHOP_RAY_MASKS, bitboards[bishop] | bitboards[queen])):
+            for ray, ascending in rays:
+                mask = ray[king_square]
+                if not mask & sliders:
+                    continue
+                blockers = mask & self.occupied
+                first = blockers & -blockers if ascending else 1 << (blockers.bit_length() - 1)
+                blockers ^= first
+                if not first & own_pieces or not blockers:
+                    continue
+                second = blockers & -blockers if ascending else 1 << (blockers.bit_length() - 1)
+                if second & sliders:
+                    pins[first.bit_length() - 1] = BETWEEN[king_square][second.bit_length() - 1] | second
+        return checkers, evasions, pins
+
+    def get_legal_king_moves(self, row, col, piece):
+        # Look for attackers with the king lifted off the board, so it cannot hide behind itself
+        enemy_color = "b" if piece[0] == "w" else "w"
+        occupied = self.occupied ^ (1 << (row * 8 + col))
+        targets = self.get_piece_targets(row * 8 + col, piece)
+        legal_targets = 0
+        while targets:
+            bit = targets & -targets
+            targets ^= bit
+            if not self.get_attackers(bit.bit_length() - 1, enemy_color, occupied):
+                legal_targets |= bit
+        moves = bitboard_squares(legal_targets)
+        moves.update(self.get_castling_moves())
+        return moves
+
+    def get_legal_moves(self, row, col, check_info=None):
+        piece = self.board[row][col]
+        if piece[1] == "k":
+            return self.get_legal_king_moves(row, col, piece)
+
+        if check_info is None:
+            check_info = self.get_check_and_pin_info("white" if piece[0] == "w" else "black")
+        checkers, evasions, pins = check_info
+
+        square = row * 8 + col
+        targets = self.get_piece_targets(square, piece) & evasions
+        if square in pins:
+            targets &= pins[square]
+        moves = bitboard_squares(targets)
+
+        # En passant removes two pieces from the board, so it gets a full safety check
+        if piece[1] == "p" and self.can_capture_en_passant(square, piece):
+            if self.is_move_safe(row, col, *self.en_passant_target):
+                moves.add(self.en_passant_target)
+        return moves
+
+    def generate_all_moves(self):
+        check_info = self.get_check_and_pin_info(self.turn)
+        all_moves = {}
+        pieces = self.occupancy["w" if self.turn == "white" else "b"]
+        while pieces:
+            bit = pieces & -pieces
+            pieces ^= bit
+            row, col = SQUARES[bit.bit_length() - 1]
+            legal_moves = self.get_legal_moves(row, col, check_info)
+            if legal_moves:
+                all_moves[(row, col)] = legal_moves
+        return all_moves
+
+
+BACKENDS = {"mailbox": ChessGame, "bitboard": BitboardChessGame}
+
+
+def run_perft_suite(backend, max_depth, positions=PERFT_POSITIONS):
+    # Run perft on every reference position up to max_depth (or as deep as its known counts go),
+    # printing a line per depth and returning the results as a JSON-ready dict
+    results = []
+    total_nodes, total_seconds, passed = 0, 0.0, True
+    for name, fen, expected_counts in positions:
+        game = BACKENDS[backend]()
+        game.load_fen(fen)
+        depths = []
+        for depth in range(1, min(max_depth, len(expected_counts)) + 1):
+            start = time.perf_counter()
+            nodes = game.perft(depth)
+            seconds = time.perf_counter() - start
+            expected = expected_counts[depth - 1]
+            nodes_per_second = nodes / seconds if seconds > 0 else 0.0
+            total_nodes += nodes
+            total_seconds += seconds
+            passed = passed and nodes == expected
+            depths.append({
+                "depth": depth, "nodes": nodes, "expected": expected, "ok": nodes == expected,
+                "seconds": round(seconds, 6), "nps": round(nodes_per_second),
+            })
+            status = "ok" if nodes == expected else "MISMATCH"
+            print(f"{name:<10} depth {depth}  nodes {nodes:>9}  expected {expected:>9}  {status:<8} "
+                  f"{seconds:9.3f}s {nodes_per_second:10.0f} nps")
+        results.append({"name": name, "fen": fen, "depths": depths})
+
+    return {
+        "backend": backend,
+        "max_depth": max_depth,
+        "python": platform.python_version(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "passed": passed,
+        "total_nodes": total_nodes,
+        "total_seconds": round(total_seconds, 6),
+        "nps": round(total_nodes / total_seconds) if total_seconds > 0 else 0,
+        "positions": results,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Play chess in the terminal, benchmark the move generator or run as a UCI engine.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="mailbox",
+                        help="board representation to use (default: mailbox)")
+    parser.add_argument("--perft", action="store_true",
+                        help="run perft on the reference positions and check the node counts")
+    parser.add_argument("--depth", type=int, default=3, help="maximum perft depth (default: 3)")
+    parser.add_argument("--output", default="perft_results.json",
+                        help="file the --perft results are written to as JSON (default: perft_results.json)")
+    parser.add_argument("--divide", type=int, metavar="DEPTH",
+                        help="print the perft node count below every root move of --fen")
+    parser.add_argument("--fen", default=START_FEN, help="position for --divide (default: start position)")
+    parser.add_argument("--uci", action="store_true",
+                        help="run as a UCI engine on stdin / stdout with the alpha-beta search (see uci.py)")
+    parser.add_argument("--check-fen", action="store_true",
+                        help="check that load_fen drops impossible castling rights and en passant squares")
+    args = parser.parse_args(argv)
+
+    if args.uci:
+        from uci import run_uci
+        return run_uci(args.backend)
+
+    if args.perft:
+        report = run_perft_suite(args.backend, args.depth)
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2)
+        print(f"{report['total_nodes']} nodes in {report['total_seconds']:.3f}s ({report['nps']} nps), "
+              f"{'all counts match' if report['passed'] else 'COUNT MISMATCH'}; results written to {args.output}")
+        return 0 if report["passed"] else 1
+
+    if args.check_fen:
+        passed = True
+        for fen, expected in FEN_CHECKS:
+            game = BACKENDS[args.backend]()
+            game.load_fen(fen)
+            ok = game.to_fen() == expected
+            passed = passed and ok
+            print(f"{fen:<40} -> {game.to_fen():<40} {'ok' if ok else 'MISMATCH'}")
+        return 0 if passed else 1
+
+    if args.divide:
+        game = BACKENDS[args.backend]()
+        game.load_fen(args.fen)
+        counts = game.perft_divide(args.divide)
+        for move in sorted(counts):
+            print(f"{move}: {counts[move]}")
+        print(f"\nMoves: {len(counts)}  Nodes: {sum(counts.values())}")
+        return 0
+
+    game = BACKENDS[args.backend]()
+    game.play()
+    return 0
+
+
 if __name__ == "__main__":
-    game = ChessGame()
-    game.play()
\ No newline at end of file
+    sys.exit(main())
\ No newline at end of file
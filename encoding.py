@@ -0,0 +1,287 @@
+import argparse
+import sys
+
+import numpy as np
+
+from chess import (BACKENDS, MOVE_CASTLING, MOVE_EN_PASSANT, MOVE_NORMAL, MOVE_PROMOTION, PERFT_POSITIONS, PIECE_CODES,
+                   PROMOTION_PIECES)
+
+
+# AlphaZero policy head: 8 x 8 x 73 = 4672 move slots. A move is stored at
+# (from_row, from_col, plane), flattened to from_square * 73 + plane, where the board is
+# seen from the side to move (rows mirrored for black, so its pawns also move towards
+# row 0). Planes 0-55 are queen-like moves (8 directions x distances 1-7), planes 56-63
+# knight moves and planes 64-72 underpromotions to n, b, r going left, straight or
+# right. Queen promotions use the queen-like planes.
+POLICY_PLANES = 73
+POLICY_SIZE = 64 * POLICY_PLANES
+
+# (row, col) steps of the queen-like directions, starting north (towards row 0)
+QUEEN_DIRECTIONS = ((-1, 0), (-1, 1), (0, 1), (1, 1), (1, 0), (1, -1), (0, -1), (-1, -1))
+KNIGHT_DIRECTIONS = ((-2, 1), (-1, 2), (1, 2), (2, 1), (2, -1), (1, -2), (-1, -2), (-2, -1))
+UNDERPROMOTION_PIECES = "nbr"
+
+
+def _build_policy_tables():
+    # policy index of every packed move code as seen by white, -1 for codes that are no
+    # chess move, and the move code of every index. Castling and en passant codes share the
+    # index of the plain move; promotion codes are told apart by their flag, so that a
+    # non-pawn move onto the back rank is not taken for a knight underpromotion.
+    move_to_policy = np.full(1 << 16, -1, dtype=np.int16)
+    policy_to_move = np.zeros(POLICY_SIZE, dtype=np.uint16)
+    for src in range(64):
+        src_row, src_col = divmod(src, 8)
+        for direction, (row_step, col_step) in enumerate(QUEEN_DIRECTIONS):
+            for distance in range(1, 8):
+                dest_row, dest_col = src_row + row_step * distance, src_col + col_step * distance
+                if not (0 <= dest_row < 8 and 0 <= dest_col < 8):
+                    break
+                index = src * POLICY_PLANES + direction * 7 + distance - 1
+                code = src | (dest_row * 8 + dest_col) << 6
+                for flag in (MOVE_NORMAL, MOVE_EN_PASSANT, MOVE_CASTLING):
+                    move_to_policy[code | flag << 14] = index
+                policy_to_move[index] = code
+                # A queen promotion shares the plane of the plain pawn move
+                if src_row == 1 and dest_row == 0 and distance == 1:
+                    move_to_policy[code | PROMOTION_PIECES.index("q") << 12 | MOVE_PROMOTION << 14] = index
+        for plane, (row_step, col_step) in enumerate(KNIGHT_DIRECTIONS, 56):
+            dest_row, dest_col = src_row + row_step, src_col + col_step
+            if 0 <= dest_row < 8 and 0 <= dest_col < 8:
+                index = src * POLICY_PLANES + plane
+                code = src | (dest_row * 8 + dest_col) << 6
+                move_to_policy[code] = index
+                policy_to_move[index] = code
+        if src_row == 1:
+            for piece_index, piece in enumerate(UNDERPROMOTION_PIECES):
+                for col_step in (-1, 0, 1):
+                    dest_col = src_col + col_step
+                    if 0 <= dest_col < 8:
+                        index = src * POLICY_PLANES + 64 + piece_index * 3 + col_step + 1
+                        code = src | dest_col << 6 | PROMOTION_PIECES.index(piece) << 12 | MOVE_PROMOTION << 14
+                        move_to_policy[code] = index
+                        policy_to_move[index] = code
+    return move_to_policy, policy_to_move
+
+
+MOVE_TO_POLICY, POLICY_TO_MOVE = _build_policy_tables()
+
+# Mirrors the rows of both squares of a packed move code: black's moves seen as white's
+MIRROR_MOVE = 56 | 56 << 6
+
+
+def move_codes_to_policy(codes, black=False):
+    # Policy indices of an array of packed move codes, for the given side to move
+    codes = np.asarray(codes, dtype=np.uint16)
+    if black:
+        codes = codes ^ np.uint16(MIRROR_MOVE)
+    return MOVE_TO_POLICY[codes]
+
+
+def policy_to_move_codes(indices, black=False):
+    # Packed move codes of an array of policy indices, for the given side to move. An index
+    # does not tell castling, en passant or queen promotions apart from plain moves, so
+    # these codes only carry the flag of underpromotions; legal_policy keeps the full codes.
+    codes = POLICY_TO_MOVE[np.asarray(indices)]
+    if black:
+        codes = codes ^ np.uint16(MIRROR_MOVE)
+    return codes
+
+
+def legal_policy(game):
+    # (packed codes, policy indices) of every legal move of the game, in legal_moves order
+    codes = np.frombuffer(game.legal_move_codes(), dtype=np.uint16)
+    return codes, move_codes_to_policy(codes, game.turn == "black")
+
+
+def legal_move_mask(game, out=None):
+    # Boolean mask over the 4672 policy slots of the legal moves of the game
+    if out is None:
+        out = np.zeros(POLICY_SIZE, dtype=bool)
+    else:
+        out[:] = False
+    out[legal_policy(game)[1]] = True
+    return out
+
+
+def policy_target(game, codes, visits, out=None):
+    # Normalised float32 policy target from visit counts of the moves with the given codes
+    if out is None:
+        out = np.zeros(POLICY_SIZE, dtype=np.float32)
+    else:
+        out[:] = 0
+    visits = np.asarray(visits, dtype=np.float32)
+    out[move_codes_to_policy(codes, game.turn == "black")] = visits / max(visits.sum(), 1)
+    return out
+
+
+# Input planes. Every position in the history takes 14 planes: the 12 piece types of
+# PIECE_CODES and two repetition flags (position seen twice, three times). The planes of
+# the current position come first, then those of the positions before it, zero-filled
+# past the start of the game. Six constant planes follow: side to move, own and opponent
+# kingside / queenside castling rights and the en passant target square. Like the policy,
+# everything is seen from the side to move: rows are mirrored and the colors swapped
+# when black is to move.
+PIECE_PLANES = {piece: plane for plane, piece in enumerate(PIECE_CODES)}
+POSITION_PLANES = 14
+CONSTANT_PLANES = 6
+# Channel order of a position seen from black: its own pieces first
+BLACK_PERSPECTIVE = list(range(6, 12)) + list(range(6)) + [12, 13]
+
+
+class PlaneEncoder:
+    # Keeps the piece and repetition planes of every position of a game, in white's
+    # orientation, as a stack that follows push / pop. Each new position is patched
+    # from the one before it on the squares the last move touched, instead of being
+    # encoded from the whole board.
+    def __init__(self, game, history=8, dtype=np.float32):
+        self.game = game
+        self.history = history
+        self.dtype = dtype
+        self.num_planes = history * POSITION_PLANES + CONSTANT_PLANES
+        self.planes = np.zeros((64, POSITION_PLANES, 8, 8), dtype=np.uint8)
+        self.size = 0
+        self.reset()
+
+    def reset(self):
+        # Encode the current position of the game from scratch, dropping the history
+        self.size = 0
+        planes = self.next_slot()
+        planes[:] = 0
+        for row in range(8):
+            for col in range(8):
+                piece = self.game.board[row][col]
+                if piece != "  ":
+                    planes[PIECE_PLANES[piece], row, col] = 1
+        self.set_repetition_planes(planes)
+
+    def next_slot(self):
+        # Planes of a new position on top of the stack, growing the stack when it is full
+        if self.size == len(self.planes):
+            self.planes = np.concatenate([self.planes, np.zeros_like(self.planes)])
+        self.size += 1
+        return self.planes[self.size - 1]
+
+    def set_repetition_planes(self, planes):
+        count = self.game.position_counts.get(self.game.zobrist_key, 1)
+        planes[12] = count >= 2
+        planes[13] = count >= 3
+
+    def push(self):
+        # Add the position reached by the last move made on the game
+        record = self.game.undo_stack[-1]
+        (src_row, src_col), (dest_row, dest_col) = record.move[0], record.move[1]
+        changed = [(src_row, src_col), (dest_row, dest_col), record.captured_position]
+        if record.piece[1] == "k" and abs(dest_col - src_col) == 2:
+            changed += [(src_row, 7), (src_row, 5)] if dest_col > src_col else [(src_row, 0), (src_row, 3)]
+
+        planes = self.next_slot()
+        planes[:12] = self.planes[self.size - 2, :12]
+        for row, col in changed:
+            planes[:12, row, col] = 0
+            piece = self.game.board[row][col]
+            if piece != "  ":
+                planes[PIECE_PLANES[piece], row, col] = 1
+        self.set_repetition_planes(planes)
+
+    def pop(self):
+        # Drop the newest position, after the game took back its last move
+        self.size -= 1
+
+    def encode(self, out=None):
+        # Input planes of the current position, written into out (num_planes x 8 x 8)
+        if out is None:
+            out = np.empty((self.num_planes, 8, 8), dtype=self.dtype)
+        game = self.game
+        count = min(self.history, self.size)
+        # Newest position first
+        recent = self.planes[self.size - count:self.size][::-1]
+        history_planes = out[:count * POSITION_PLANES].reshape(count, POSITION_PLANES, 8, 8)
+        if game.turn == "white":
+            history_planes[:] = recent
+        else:
+            history_planes[:] = recent[:, BLACK_PERSPECTIVE, ::-1]
+        out[count * POSITION_PLANES:self.history * POSITION_PLANES] = 0
+
+        constant = out[self.history * POSITION_PLANES:]
+        white_rights = (
+            not game.white_king_moved and not game.white_rook_moved["right"],
+            not game.white_king_moved and not game.white_rook_moved["left"],
+        )
+        black_rights = (
+            not game.black_king_moved and not game.black_rook_moved["right"],
+            not game.black_king_moved and not game.black_rook_moved["left"],
+        )
+        own_rights, enemy_rights = (white_rights, black_rights) if game.turn == "white" else (black_rights, white_rights)
+        constant[0] = game.turn == "white"
+        constant[1], constant[2] = own_rights
+        constant[3], constant[4] = enemy_rights
+        constant[5] = 0
+        if game.en_passant_target is not None:
+            row, col = game.en_passant_target
+            constant[5, row if game.turn == "white" else 7 - row, col] = 1
+        return out
+
+
+def encode_batch(encoders, out=None):
+    # Input planes of several positions as one contiguous (batch x num_planes x 8 x 8) array
+    if out is None:
+        first = encoders[0]
+        out = np.empty((len(encoders), first.num_planes, 8, 8), dtype=first.dtype)
+    for index, encoder in enumerate(encoders):
+        encoder.encode(out[index])
+    return out
+
+
+# Positions with rook, queen and king moves onto the back rank next to pawn promotions
+# (both colors), for the policy round trip check
+ROUND_TRIP_POSITIONS = [
+    ("backrank", "4k3/R1P5/8/8/8/8/1p5r/4K3 w - - 0 1"),
+    ("backrank-black", "4k3/R1P5/8/8/8/8/1p5r/4K3 b - - 0 1"),
+    ("promotions", "r3k2r/1P4P1/8/8/8/8/1p4p1/R3K2R w KQkq - 0 1"),
+]
+
+
+def check_round_trip(game):
+    # Whether the legal moves of a position map to distinct policy indices that map back
+    # to the same squares and promotion piece
+    codes, indices = legal_policy(game)
+    if (indices < 0).any() or len(set(indices.tolist())) != len(indices):
+        return False
+    back = policy_to_move_codes(indices, game.turn == "black")
+    promotion = codes >> 14 == MOVE_PROMOTION
+    underpromotion = promotion & (codes >> 12 & 3 != PROMOTION_PIECES.index("q"))
+    expected = np.where(underpromotion, codes, codes & 0xFFF)
+    return bool((back == expected).all())
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check that legal moves round-trip through the policy encoding.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--depth", type=int, default=2, help="plies of every position to check (default: 2)")
+    args = parser.parse_args(argv)
+
+    def check_tree(game, depth):
+        # (positions, failed positions) of the tree below game
+        positions, failed = 1, int(not check_round_trip(game))
+        if depth > 1:
+            for move in game.legal_moves():
+                game.make_move(move)
+                more, more_failed = check_tree(game, depth - 1)
+                game.unmake_move()
+                positions += more
+                failed += more_failed
+        return positions, failed
+
+    passed = True
+    for name, fen in [(name, fen) for name, fen, _ in PERFT_POSITIONS] + ROUND_TRIP_POSITIONS:
+        game = BACKENDS[args.backend]()
+        game.load_fen(fen)
+        positions, failed = check_tree(game, args.depth)
+        passed = passed and not failed
+        print(f"{name:<15} {positions:>6} positions  {'ok' if not failed else f'{failed} MISMATCHES'}")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from chess import BACKENDS, START_FEN, unpack_move
+from encoding import POLICY_SIZE, PlaneEncoder, encode_batch, legal_policy
+
+
+class VectorEnv:
+    # num_envs games stepped together for reinforcement learning. Observations (input
+    # planes from encoding.py), legal action masks over the 4672 policy slots, rewards and
+    # done flags are kept in preallocated NumPy arrays that every step updates in place.
+    # The positions themselves stay ChessGame objects stepped one by one, since move
+    # generation is only written for a single board; that loop bounds the throughput.
+    # Actions are policy indices from the side to move's point of view. The rules, including
+    # checkmate, stalemate and threefold repetition, are those of ChessGame. A finished game
+    # is reset to the start position right away, so the observation returned for it is
+    # already the first one of its next game.
+    def __init__(self, num_envs, backend="bitboard", history=8, max_plies=512, fen=START_FEN):
+        self.num_envs = num_envs
+        self.max_plies = max_plies
+        self.fen = fen
+        self.games = [BACKENDS[backend]() for _ in range(num_envs)]
+        self.encoders = [PlaneEncoder(game, history) for game in self.games]
+        self.observations = np.zeros((num_envs, self.encoders[0].num_planes, 8, 8), dtype=np.float32)
+        self.masks = np.zeros((num_envs, POLICY_SIZE), dtype=bool)
+        self.rewards = np.zeros(num_envs, dtype=np.float32)
+        self.dones = np.zeros(num_envs, dtype=bool)
+        # Result strings of the games that ended in the last step ("*" when cut off at
+        # max_plies), None for the others
+        self.results = [None] * num_envs
+        self.plies = np.zeros(num_envs, dtype=np.int32)
+        # Packed move code behind every legal action, and the legal policy indices of each
+        # environment so the next update only clears those
+        self.action_codes = np.zeros((num_envs, POLICY_SIZE), dtype=np.uint16)
+        self.legal_indices = [np.zeros(0, dtype=np.int64)] * num_envs
+
+    def reset(self):
+        # Start every game over and return the observations
+        for index in range(self.num_envs):
+            self.reset_game(index)
+        self.rewards[:] = 0
+        self.dones[:] = False
+        self.results = [None] * self.num_envs
+        return encode_batch(self.encoders, self.observations)
+
+    def reset_game(self, index):
+        self.games[index].load_fen(self.fen)
+        self.encoders[index].reset()
+        self.plies[index] = 0
+        self.update_actions(index)
+
+    def update_actions(self, index):
+        # Refresh the legal action mask and action codes of one environment
+        mask = self.masks[index]
+        mask[self.legal_indices[index]] = False
+        codes, indices = legal_policy(self.games[index])
+        mask[indices] = True
+        self.action_codes[index, indices] = codes
+        self.legal_indices[index] = indices
+
+    def step(self, actions):
+        # Play one action in every game. Returns (observations, rewards, dones): rewards
+        # are for the side that just moved (1 for a win, 0 otherwise) and done marks games
+        # that ended with this move, by the rules or by reaching max_plies.
+        actions = np.asarray(actions)
+        if actions.shape != (self.num_envs,):
+            raise ValueError(f"expected {self.num_envs} actions, got shape {actions.shape}")
+        if actions.dtype.kind not in "iu":
+            raise ValueError(f"actions must be integer policy indices, got {actions.dtype}")
+        outside = np.flatnonzero((actions < 0) | (actions >= POLICY_SIZE))
+        if len(outside):
+            raise ValueError(f"actions {actions[outside].tolist()} in environments {outside.tolist()} "
+                             f"are not policy indices (0-{POLICY_SIZE - 1})")
+        rows = np.arange(self.num_envs)
+        illegal = np.flatnonzero(~self.masks[rows, actions])
+        if len(illegal):
+            raise ValueError(f"illegal actions {actions[illegal].tolist()} in environments {illegal.tolist()}")
+
+        codes = self.action_codes[rows, actions].tolist()
+        self.plies += 1
+        for index, game in enumerate(self.games):
+            game.make_move(unpack_move(codes[index]))
+            self.encoders[index].push()
+            result = game.result()
+            if result is None and self.plies[index] >= self.max_plies:
+                result = "*"
+            self.results[index] = result
+            if result is None:
+                self.rewards[index] = 0
+                self.dones[index] = False
+                self.update_actions(index)
+            else:
+                self.rewards[index] = 1 if result in ("1-0", "0-1") else 0
+                self.dones[index] = True
+                self.reset_game(index)
+        return encode_batch(self.encoders, self.observations), self.rewards, self.dones
+
+    def sample_actions(self, rng):
+        # One uniformly random legal action per environment
+        return np.array([rng.choice(indices) for indices in self.legal_indices])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the vectorized environment with random actions.")
+    parser.add_argument("--envs", type=int, default=64, help="games stepped together (default: 64)")
+    parser.add_argument("--steps", type=int, default=200, help="steps to time (default: 200)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--history", type=int, default=8, help="positions encoded per observation (default: 8)")
+    parser.add_argument("--max-plies", type=int, default=512,
+                        help="cut games off after this many plies (default: 512)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed (default: 0)")
+    args = parser.parse_args(argv)
+
+    env = VectorEnv(args.envs, args.backend, args.history, args.max_plies)
+    rng = np.random.default_rng(args.seed)
+    env.reset()
+    games = 0
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        _, _, dones = env.step(env.sample_actions(rng))
+        games += int(dones.sum())
+    seconds = time.perf_counter() - start
+    steps = args.steps * args.envs
+    print(f"{steps} environment steps in {seconds:.3f}s ({steps / seconds:.0f} steps/s), {games} games finished")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
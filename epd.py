@@ -0,0 +1,177 @@
+import argparse
+import itertools
+import multiprocessing
+import sys
+import threading
+import time
+
+from chess import BACKENDS, IllegalMoveError, unpack_move
+from search import AlphaBetaSearch
+from transposition import TranspositionTable
+
+
+# EPD lines are the first four FEN fields followed by operations separated by semicolons,
+# each an opcode and its operands, e.g.
+#   r1bqkbnr/pppp1ppp/2n5/4p3/4P3/5N2/PPPP1PPP/RNBQKB1R w KQkq - bm Bb5; id "ruy lopez";
+# Perft suites often give a full FEN and one "D<depth> <nodes>" operation per depth:
+#   rnbqkbnr/pppppppp/8/8/8/8/PPPPPPPP/RNBQKBNR w KQkq - 0 1 ;D1 20 ;D2 400
+# The runner checks bm (best moves), am (moves to avoid) and D<n> perft counts.
+CHECKS = ("bm", "am", "perft")
+
+# Lines read ahead of the workers per worker process, so that huge suites are streamed
+# instead of being read into memory
+READ_AHEAD = 64
+
+
+def parse_epd(line):
+    # (fen, operations) of an EPD line, operations mapping each opcode to its list of
+    # operands (unquoted). hmvc and fmvn operations, or two numbers after the position
+    # fields, become the FEN move counters.
+    segments = line.split(";")
+    fields = segments[0].split()
+    if len(fields) < 4:
+        raise ValueError(f"Invalid EPD line: {line.strip()!r}")
+    position, first = fields[:4], fields[4:]
+    counters = ["0", "1"]
+    if len(first) >= 2 and first[0].isdigit() and first[1].isdigit():
+        counters, first = first[:2], first[2:]
+
+    operations = {}
+    for segment in [" ".join(first)] + segments[1:]:
+        tokens = segment.split('"')
+        # Words outside quotes split on whitespace, quoted strings stay whole
+        words = [word for index, token in enumerate(tokens)
+                 for word in ([token] if index % 2 else token.split())]
+        if words:
+            operations[words[0]] = words[1:]
+    if "hmvc" in operations:
+        counters[0] = operations["hmvc"][0]
+    if "fmvn" in operations:
+        counters[1] = operations["fmvn"][0]
+    return " ".join(position + counters), operations
+
+
+# Worker process state, set up once per process by init_worker
+_worker_options = None
+_worker_table = None
+
+
+def init_worker(options):
+    global _worker_options, _worker_table
+    _worker_options = options
+    _worker_table = TranspositionTable(options.hash)
+
+
+def check_position(task):
+    # Run every check the operations of one EPD line ask for and return a JSON-ready dict
+    # with the outcome of each (True for pass), or the error that stopped it
+    number, line = task
+    options = _worker_options
+    record = {"line": number, "checks": {}}
+    try:
+        fen, operations = parse_epd(line)
+        record["id"] = " ".join(operations.get("id", [])) or None
+        game = BACKENDS[options.backend]()
+        game.load_fen(fen)
+
+        # Moves and perft counts are checked on the position as loaded, before the search
+        expected = {check: {game.parse_san(san) for san in operations[check]}
+                    for check in ("bm", "am") if check in operations}
+        depths = sorted(int(opcode[1:]) for opcode in operations
+                        if opcode[:1] == "D" and opcode[1:].isdigit() and int(opcode[1:]) <= options.perft_depth)
+        if depths:
+            record["checks"]["perft"] = all(game.perft(depth) == int(operations[f"D{depth}"][0]) for depth in depths)
+
+        if expected:
+            _worker_table.clear()
+            result = AlphaBetaSearch(game, _worker_table).search(options.depth, options.movetime, options.nodes)
+            best = unpack_move(result.pv[0]) if result is not None and result.pv else None
+            record["move"] = best.uci() if best else None
+            for check, moves in expected.items():
+                record["checks"][check] = (best in moves) == (check == "bm")
+    except (ValueError, IndexError) as error:
+        record["error"] = str(error) if isinstance(error, IllegalMoveError) else f"{type(error).__name__}: {error}"
+    return record
+
+
+def read_positions(path, read_ahead):
+    # (line number, line) of every position in an EPD file, read lazily. The pool's task
+    # feeder would otherwise read the whole file at once, so each line waits for a slot of
+    # read_ahead, freed whenever a result comes back.
+    with open(path) as lines:
+        for number, line in enumerate(lines, 1):
+            if line.strip() and not line.lstrip().startswith("#"):
+                read_ahead.acquire()
+                yield number, line
+
+
+def run_suite(options, report):
+    # Check every position of options.suite on options.workers processes, calling report
+    # with each result in file order. Returns a summary dict.
+    read_ahead = threading.BoundedSemaphore(READ_AHEAD * options.workers)
+    tasks = read_positions(options.suite, read_ahead)
+    if options.limit is not None:
+        tasks = itertools.islice(tasks, options.limit)
+
+    positions = errors = 0
+    checks = {check: [0, 0] for check in CHECKS}
+    start = time.perf_counter()
+    with multiprocessing.Pool(options.workers, init_worker, (options,)) as pool:
+        for record in pool.imap(check_position, tasks):
+            read_ahead.release()
+            positions += 1
+            errors += "error" in record
+            for check, passed in record["checks"].items():
+                checks[check][0] += passed
+                checks[check][1] += 1
+            report(record)
+    seconds = time.perf_counter() - start
+    return {
+        "positions": positions,
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "positions_per_second": round(positions / seconds, 1) if seconds > 0 else 0.0,
+        "checks": {check: {"passed": passed, "total": total, "rate": round(passed / total, 4) if total else None}
+                   for check, (passed, total) in checks.items()},
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run an EPD test suite (bm, am and perft) on several processes.")
+    parser.add_argument("suite", help="EPD file, one position per line")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--depth", type=int, default=64, help="search depth for bm / am (default: 64)")
+    parser.add_argument("--movetime", type=float, default=1.0,
+                        help="search time in seconds for bm / am (default: 1)")
+    parser.add_argument("--nodes", type=int, help="search node limit for bm / am")
+    parser.add_argument("--perft-depth", type=int, default=4,
+                        help="skip D<n> perft counts deeper than this (default: 4)")
+    parser.add_argument("--hash", type=int, default=16,
+                        help="transposition table size in MB per worker (default: 16)")
+    parser.add_argument("--limit", type=int, help="stop after this many positions")
+    parser.add_argument("--verbose", action="store_true", help="print every position, not only failures")
+    args = parser.parse_args(argv)
+
+    def report(record):
+        failed = [check for check, passed in record["checks"].items() if not passed]
+        if args.verbose or failed or "error" in record:
+            outcome = f"error: {record['error']}" if "error" in record else \
+                f"FAIL {' '.join(failed)}" if failed else "ok"
+            move = f" (played {record['move']})" if record.get("move") else ""
+            print(f"line {record['line']}{' ' + record['id'] if record.get('id') else ''}: {outcome}{move}")
+
+    summary = run_suite(args, report)
+    rates = "  ".join(f"{check} {result['passed']}/{result['total']} ({result['rate']:.1%})"
+                      for check, result in summary["checks"].items() if result["total"])
+    print(f"{summary['positions']} positions in {summary['seconds']:.3f}s "
+          f"({summary['positions_per_second']:.1f} positions/s), {summary['errors']} errors"
+          + (f"; {rates}" if rates else ""))
+    passed = summary["errors"] == 0 and all(result["passed"] == result["total"] for result in summary["checks"].values())
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
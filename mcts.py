@@ -0,0 +1,551 @@
+import argparse
+import math
+import queue
+import random
+import sys
+import threading
+import time
+from concurrent.futures import Future
+
+import numpy as np
+
+from chess import BACKENDS, MOVE_PROMOTION, START_FEN, move_to_uci, pack_move, unpack_move
+from encoding import POLICY_SIZE, PlaneEncoder, move_codes_to_policy
+
+
+# Evaluators map a position to (priors, value): priors is a float array over the legal moves
+# of the game in legal_move_codes order and value is the expected result in [-1, 1] for the
+# side to move.
+
+class UniformEvaluator:
+    # Every legal move equally likely and every position even
+    def evaluate(self, game):
+        count = len(game.legal_move_codes())
+        return np.full(count, 1.0 / count, dtype=np.float32), 0.0
+
+
+class RolloutEvaluator:
+    # Uniform priors, valued by a random playout of at most max_plies moves. Unfinished
+    # playouts count as draws.
+    def __init__(self, max_plies=200, seed=None):
+        self.max_plies = max_plies
+        self.random = random.Random(seed)
+
+    def evaluate(self, game):
+        count = len(game.legal_move_codes())
+        priors = np.full(count, 1.0 / count, dtype=np.float32)
+        turn = game.turn
+
+        plies = 0
+        while plies < self.max_plies and game.result() is None:
+            game.make_move(self.random.choice(game.legal_moves()))
+            plies += 1
+        result = game.result()
+        for _ in range(plies):
+            game.unmake_move()
+
+        if result is None or result == "1/2-1/2":
+            return priors, 0.0
+        return priors, 1.0 if (result == "1-0") == (turn == "white") else -1.0
+
+
+def terminal_value(result):
+    # Value of a finished game for the side to move: it can only have been checkmated
+    return 0.0 if result == "1/2-1/2" else -1.0
+
+
+class SearchTree:
+    # MCTS nodes as parallel arrays indexed by node number. Node 0 is the root and the
+    # children of a node take the contiguous range first_child .. first_child + num_children.
+    # W and Q are seen by the side that played the move into the node. 24 bytes a node.
+    def __init__(self, capacity=1 << 16):
+        self.allocate_arrays(capacity)
+        self.clear()
+
+    def allocate_arrays(self, capacity):
+        self.N = np.zeros(capacity, dtype=np.int32)
+        self.W = np.zeros(capacity, dtype=np.float32)
+        self.Q = np.zeros(capacity, dtype=np.float32)
+        self.P = np.zeros(capacity, dtype=np.float32)
+        self.move = np.zeros(capacity, dtype=np.uint16)
+        self.first_child = np.zeros(capacity, dtype=np.int32)
+        self.num_children = np.zeros(capacity, dtype=np.int16)
+
+    @property
+    def capacity(self):
+        return len(self.N)
+
+    def clear(self):
+        # Forget every node but a fresh, unexpanded root
+        self.size = 1
+        self.reset_nodes(0, 1)
+
+    def reset_nodes(self, start, stop):
+        for values in (self.N, self.W, self.Q, self.P, self.move, self.first_child, self.num_children):
+            values[start:stop] = 0
+
+    def grow(self, capacity):
+        old = (self.N, self.W, self.Q, self.P, self.move, self.first_child, self.num_children)
+        self.allocate_arrays(capacity)
+        for new_values, old_values in zip(
+                (self.N, self.W, self.Q, self.P, self.move, self.first_child, self.num_children), old):
+            new_values[:len(old_values)] = old_values
+
+    def expand(self, node, codes, priors):
+        # Give node one child per legal move code with the given prior
+        count = len(codes)
+        if self.size + count > self.capacity:
+            self.grow(max(self.capacity * 2, self.size + count))
+        first = self.size
+        self.size += count
+        self.reset_nodes(first, self.size)
+        self.move[first:self.size] = codes
+        self.P[first:self.size] = priors
+        self.first_child[node] = first
+        self.num_children[node] = count
+
+    def reroot(self, child):
+        # Keep only the subtree under child, copied breadth first so child becomes node 0
+        # and every node's children stay contiguous
+        order = [child]
+        new_first = [0]
+        size = 1
+        position = 0
+        while position < len(order):
+            node = order[position]
+            count = int(self.num_children[node])
+            if count:
+                first = int(self.first_child[node])
+                new_first[position] = size
+                order.extend(range(first, first + count))
+                new_first.extend([0] * count)
+                size += count
+            position += 1
+
+        order = np.array(order, dtype=np.int64)
+        for values in (self.N, self.W, self.Q, self.P, self.move, self.num_children):
+            values[:size] = values[order]
+        self.first_child[:size] = new_first
+        self.size = size
+
+
+class MCTS:
+    # PUCT search over a ChessGame. The tree persists between moves: call advance after
+    # each move played so the next search starts from the subtree it already built.
+    def __init__(self, evaluator, c_puct=1.5, dirichlet_alpha=0.3, dirichlet_epsilon=0.25,
+                 capacity=1 << 16, seed=None):
+        self.evaluator = evaluator
+        self.c_puct = c_puct
+        self.dirichlet_alpha = dirichlet_alpha
+        self.dirichlet_epsilon = dirichlet_epsilon
+        self.tree = SearchTree(capacity)
+        self.rng = np.random.default_rng(seed)
+        # Zobrist key of the position the root stands for, None for an empty tree
+        self.root_key = None
+        # Whether the root's priors already carry Dirichlet noise, so that searching the
+        # same root again does not mix in more
+        self.root_noised = False
+
+    def search(self, game, simulations, add_noise=True):
+        # Run simulations from the current position of game, which is left unchanged
+        tree = self.tree
+        if self.root_key != game.zobrist_key:
+            tree.clear()
+            self.root_key = game.zobrist_key
+            self.root_noised = False
+        if game.result() is not None:
+            return
+        if not tree.num_children[0]:
+            self.evaluate_leaf(game, 0)
+            tree.N[0] += 1
+        if add_noise and not self.root_noised:
+            self.add_dirichlet_noise()
+            self.root_noised = True
+
+        for _ in range(simulations):
+            self.simulate(game)
+
+    def simulate(self, game):
+        tree = self.tree
+        node = 0
+        path = [0]
+        while tree.num_children[node]:
+            node = self.select_child(node)
+            game.make_move(unpack_move(int(tree.move[node])))
+            path.append(node)
+
+        result = game.result()
+        value = terminal_value(result) if result is not None else self.evaluate_leaf(game, node)
+        self.backup(path, value)
+        for _ in range(len(path) - 1):
+            game.unmake_move()
+
+    def select_child(self, node):
+        tree = self.tree
+        first = int(tree.first_child[node])
+        children = slice(first, first + int(tree.num_children[node]))
+        scores = tree.Q[children] + self.c_puct * math.sqrt(tree.N[node]) * tree.P[children] / (1 + tree.N[children])
+        return first + int(np.argmax(scores))
+
+    def evaluate_leaf(self, game, node):
+        # Expand node with the evaluator's priors and return its value for the side to move
+        priors, value = self.evaluator.evaluate(game)
+        self.tree.expand(node, game.legal_move_codes(), priors)
+        return value
+
+    def backup(self, path, value):
+        # value is for the side to move at the leaf, so the move into the leaf scores -value
+        # and signs alternate up the path
+        tree = self.tree
+        for node in reversed(path):
+            value = -value
+            tree.N[node] += 1
+            tree.W[node] += value
+            tree.Q[node] = tree.W[node] / tree.N[node]
+
+    def add_dirichlet_noise(self):
+        tree = self.tree
+        first, count = int(tree.first_child[0]), int(tree.num_children[0])
+        noise = self.rng.dirichlet([self.dirichlet_alpha] * count)
+        priors = tree.P[first:first + count]
+        priors[:] = (1 - self.dirichlet_epsilon) * priors + self.dirichlet_epsilon * noise
+
+    def root_visits(self):
+        # (move codes, visit counts) of the root's children
+        tree = self.tree
+        first, count = int(tree.first_child[0]), int(tree.num_children[0])
+        return tree.move[first:first + count].copy(), tree.N[first:first + count].copy()
+
+    def choose_move(self, temperature=1.0):
+        # Move code sampled from the root visit counts raised to 1 / temperature; the most
+        # visited move (ties broken at random) at temperature 0
+        codes, visits = self.root_visits()
+        if temperature == 0:
+            best = np.flatnonzero(visits == visits.max())
+            return int(codes[self.rng.choice(best)])
+        weights = visits.astype(np.float64) ** (1.0 / temperature)
+        total = weights.sum()
+        if total == 0:
+            return int(self.rng.choice(codes))
+        return int(self.rng.choice(codes, p=weights / total))
+
+    def advance(self, game):
+        # Reuse the subtree of the move just played on game, or start over if the tree does
+        # not have it
+        tree = self.tree
+        first, count = int(tree.first_child[0]), int(tree.num_children[0])
+        self.root_noised = False
+        if self.root_key is not None and game.undo_stack and count:
+            move = game.undo_stack[-1].move
+            code = pack_move(move[0], move[1], move[2] if len(move) > 2 else None)
+            children = tree.move[first:first + count]
+            # Only promotions carry their flag in the undo stack: compare castling and en
+            # passant by their squares, and never match a plain move to a knight promotion
+            if code >> 14 == MOVE_PROMOTION:
+                matches = np.flatnonzero(children == code)
+            else:
+                matches = np.flatnonzero((children & 0xFFF == code) & (children >> 14 != MOVE_PROMOTION))
+            if len(matches):
+                tree.reroot(first + int(matches[0]))
+                self.root_key = game.zobrist_key
+                return
+        tree.clear()
+        self.root_key = None
+
+
+# Batch evaluators take input planes of shape (N, planes, 8, 8), as written by
+# encoding.PlaneEncoder, and return (policy logits of shape (N, 4672), values of shape (N,))
+# with the values for the side to move of each position.
+
+class UniformBatchEvaluator:
+    # Batch counterpart of UniformEvaluator
+    def evaluate_batch(self, planes):
+        return np.zeros((len(planes), POLICY_SIZE), dtype=np.float32), np.zeros(len(planes), dtype=np.float32)
+
+
+class LinearEvaluator:
+    # Two random dense layers: a NumPy stand-in for a network, to measure batching on the CPU
+    def __init__(self, num_planes, hidden=64, seed=None):
+        rng = np.random.default_rng(seed)
+        inputs = num_planes * 64
+        self.hidden_weights = (rng.standard_normal((inputs, hidden)) / math.sqrt(inputs)).astype(np.float32)
+        self.policy_weights = (rng.standard_normal((hidden, POLICY_SIZE)) / math.sqrt(hidden)).astype(np.float32)
+        self.value_weights = (rng.standard_normal(hidden) / hidden).astype(np.float32)
+
+    def evaluate_batch(self, planes):
+        hidden = np.maximum(planes.reshape(len(planes), -1).astype(np.float32, copy=False) @ self.hidden_weights, 0)
+        return hidden @ self.policy_weights, np.tanh(hidden @ self.value_weights)
+
+
+class BatchStats:
+    # Evaluation throughput and how full the batches sent to the evaluator were
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.batches = 0
+        self.positions = 0
+        self.seconds = 0.0
+
+    def record(self, positions, seconds):
+        self.batches += 1
+        self.positions += positions
+        self.seconds += seconds
+
+    @property
+    def fill_rate(self):
+        return self.positions / (self.batches * self.batch_size) if self.batches else 0.0
+
+    def summary(self):
+        positions_per_second = self.positions / self.seconds if self.seconds > 0 else 0.0
+        return (f"{self.positions} positions in {self.batches} batches, fill rate {self.fill_rate:.1%}, "
+                f"{positions_per_second:.0f} evaluations/s")
+
+
+class BatchMCTS(MCTS):
+    # MCTS that descends up to batch_size times before calling the evaluator once for all
+    # the leaves found. Virtual loss (virtual_loss visits counted as losses) on every node
+    # of a pending path steers the next descents elsewhere, and is taken back on backup.
+    def __init__(self, evaluator, batch_size=16, virtual_loss=1, history=8, **kwargs):
+        super().__init__(evaluator, **kwargs)
+        self.batch_size = batch_size
+        self.virtual_loss = virtual_loss
+        self.history = history
+        self.stats = BatchStats(batch_size)
+        self.planes = None
+
+    def search(self, game, simulations, add_noise=True, encoder=None):
+        # encoder should be a PlaneEncoder following game, so the leaves see its history
+        tree = self.tree
+        if encoder is None:
+            encoder = PlaneEncoder(game, self.history)
+        if self.planes is None or self.planes.shape[1] != encoder.num_planes:
+            self.planes = np.zeros((self.batch_size, encoder.num_planes, 8, 8), dtype=encoder.dtype)
+        if self.root_key != game.zobrist_key:
+            tree.clear()
+            self.root_key = game.zobrist_key
+            self.root_noised = False
+        if game.result() is not None:
+            return
+        if not tree.num_children[0]:
+            self.evaluate_pending(game, [self.add_pending(game, encoder, [0], 0)])
+        if add_noise and not self.root_noised:
+            self.add_dirichlet_noise()
+            self.root_noised = True
+
+        done = 0
+        while done < simulations:
+            pending = []
+            leaves = set()
+            while len(pending) < self.batch_size and done < simulations:
+                path = self.descend(game, encoder)
+                leaf = path[-1]
+                result = game.result()
+                if result is not None:
+                    self.backup(path, terminal_value(result))
+                    done += 1
+                elif leaf in leaves:
+                    # Two descents met at the same leaf: evaluate what we have first
+                    self.unwind(game, encoder, path)
+                    break
+                else:
+                    leaves.add(leaf)
+                    pending.append(self.add_pending(game, encoder, path, len(pending)))
+                    done += 1
+                self.unwind(game, encoder, path)
+            if pending:
+                self.evaluate_pending(game, pending)
+
+    def descend(self, game, encoder):
+        tree = self.tree
+        node = 0
+        path = [0]
+        while tree.num_children[node]:
+            node = self.select_child(node)
+            game.make_move(unpack_move(int(tree.move[node])))
+            encoder.push()
+            path.append(node)
+        return path
+
+    def unwind(self, game, encoder, path):
+        for _ in range(len(path) - 1):
+            game.unmake_move()
+            encoder.pop()
+
+    def add_pending(self, game, encoder, path, slot):
+        # Encode the leaf at the end of path into the batch and put virtual loss on the path
+        codes = np.array(game.legal_move_codes(), dtype=np.uint16)
+        encoder.encode(self.planes[slot])
+        nodes = np.array(path)
+        tree = self.tree
+        tree.N[nodes] += self.virtual_loss
+        tree.W[nodes] -= self.virtual_loss
+        tree.Q[nodes] = tree.W[nodes] / tree.N[nodes]
+        return nodes, codes, move_codes_to_policy(codes, game.turn == "black")
+
+    def evaluate_pending(self, game, pending):
+        start = time.perf_counter()
+        logits, values = self.evaluator.evaluate_batch(self.planes[:len(pending)])
+        self.stats.record(len(pending), time.perf_counter() - start)
+
+        tree = self.tree
+        for (nodes, codes, indices), leaf_logits, value in zip(pending, logits, values):
+            priors = np.exp(leaf_logits[indices] - leaf_logits[indices].max())
+            tree.expand(int(nodes[-1]), codes, priors / priors.sum())
+            tree.N[nodes] -= self.virtual_loss
+            tree.W[nodes] += self.virtual_loss
+            self.backup(nodes.tolist(), float(value))
+
+
+class SharedEvaluator:
+    # Batch evaluator shared by many searches running on their own threads: their
+    # evaluate_batch calls are queued and merged into batches of up to batch_size positions
+    # for the wrapped evaluator, which runs on a background thread. A call waits at most
+    # timeout seconds for others to join its batch.
+    def __init__(self, evaluator, batch_size=256, timeout=0.002):
+        self.evaluator = evaluator
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.stats = BatchStats(batch_size)
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def evaluate_batch(self, planes):
+        future = Future()
+        self.requests.put((planes, future))
+        return future.result()
+
+    def close(self):
+        self.requests.put(None)
+        self.thread.join()
+
+    def run(self):
+        while True:
+            request = self.requests.get()
+            if request is None:
+                return
+            batch = [request]
+            count = len(request[0])
+            deadline = time.perf_counter() + self.timeout
+            while count < self.batch_size:
+                try:
+                    request = self.requests.get(timeout=max(deadline - time.perf_counter(), 0))
+                except queue.Empty:
+                    break
+                if request is None:
+                    # Finish this batch, then stop
+                    self.requests.put(None)
+                    break
+                batch.append(request)
+                count += len(request[0])
+
+            start = time.perf_counter()
+            try:
+                logits, values = self.evaluator.evaluate_batch(np.concatenate([planes for planes, _ in batch]))
+            except Exception as error:
+                for _, future in batch:
+                    future.set_exception(error)
+                continue
+            self.stats.record(count, time.perf_counter() - start)
+
+            offset = 0
+            for planes, future in batch:
+                future.set_result((logits[offset:offset + len(planes)], values[offset:offset + len(planes)]))
+                offset += len(planes)
+
+
+def play_threaded_games(evaluator, num_games, moves, simulations, batch_size=16, backend="bitboard",
+                        seed=None):
+    # Play num_games games of at most moves moves at once, one thread each, with every search
+    # sharing one evaluation queue. Returns the SharedEvaluator's BatchStats.
+    shared = SharedEvaluator(evaluator, batch_size=num_games * batch_size)
+
+    def play(index):
+        game = BACKENDS[backend]()
+        encoder = PlaneEncoder(game)
+        search = BatchMCTS(shared, batch_size, seed=None if seed is None else seed + index)
+        for _ in range(moves):
+            if game.result() is not None:
+                break
+            search.search(game, simulations, encoder=encoder)
+            game.push(search.choose_move(temperature=1.0))
+            encoder.push()
+            search.advance(game)
+
+    threads = [threading.Thread(target=play, args=(index,)) for index in range(num_games)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    shared.close()
+    return shared.stats
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark MCTS with a CPU evaluator.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--evaluator", choices=("uniform", "rollout", "linear"), default="uniform",
+                        help="leaf evaluator; rollout needs --batch-size 0, linear a batch size (default: uniform)")
+    parser.add_argument("--simulations", type=int, default=10000,
+                        help="simulations per search (default: 10000)")
+    parser.add_argument("--moves", type=int, default=1,
+                        help="moves to play, reusing the tree between them (default: 1)")
+    parser.add_argument("--batch-size", type=int, default=0,
+                        help="leaves evaluated per batch, 0 for one at a time (default: 0)")
+    parser.add_argument("--games", type=int, default=1,
+                        help="games searched at once on threads sharing one evaluation queue (default: 1)")
+    parser.add_argument("--fen", default=START_FEN, help="position to search (default: start position)")
+    parser.add_argument("--seed", type=int, help="random seed for noise and move sampling")
+    args = parser.parse_args(argv)
+
+    if args.batch_size <= 0:
+        if args.evaluator == "linear" or args.games > 1:
+            parser.error("--evaluator linear and --games need a --batch-size")
+        evaluator = RolloutEvaluator(seed=args.seed) if args.evaluator == "rollout" else UniformEvaluator()
+    elif args.evaluator == "rollout":
+        parser.error("--evaluator rollout cannot be batched")
+    elif args.evaluator == "linear":
+        evaluator = LinearEvaluator(PlaneEncoder(BACKENDS[args.backend]()).num_planes, seed=args.seed)
+    else:
+        evaluator = UniformBatchEvaluator()
+
+    if args.games > 1:
+        start = time.perf_counter()
+        stats = play_threaded_games(evaluator, args.games, args.moves, args.simulations,
+                                    args.batch_size, args.backend, args.seed)
+        seconds = time.perf_counter() - start
+        print(f"{args.games} games x {args.moves} moves in {seconds:.3f}s "
+              f"({stats.positions / seconds:.0f} leaves/s overall); {stats.summary()}")
+        return 0
+
+    game = BACKENDS[args.backend]()
+    game.load_fen(args.fen)
+    if args.batch_size > 0:
+        encoder = PlaneEncoder(game)
+        search = BatchMCTS(evaluator, args.batch_size, seed=args.seed)
+    else:
+        encoder = None
+        search = MCTS(evaluator, seed=args.seed)
+    for _ in range(args.moves):
+        if game.result() is not None:
+            break
+        start = time.perf_counter()
+        if encoder is None:
+            search.search(game, args.simulations)
+        else:
+            search.search(game, args.simulations, encoder=encoder)
+        seconds = time.perf_counter() - start
+        code = search.choose_move(temperature=0)
+        move = game.push(code)
+        if encoder is not None:
+            encoder.push()
+        print(f"{move_to_uci(move):<6} {args.simulations} simulations in {seconds:.3f}s "
+              f"({args.simulations / seconds:.0f}/s), tree {search.tree.size} nodes")
+        search.advance(game)
+    if args.batch_size > 0:
+        print(search.stats.summary())
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
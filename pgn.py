@@ -0,0 +1,238 @@
+import argparse
+import multiprocessing
+import os
+import queue
+import re
+import signal
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from chess import BACKENDS
+from replay import DEFAULT_TOP_K, ShardWriter, encode_position, record_dtype
+
+
+# One game of a PGN file: its tag pairs, its main-line moves in SAN, the result ("1-0",
+# "0-1", "1/2-1/2" or "*") and the byte offset the game starts at
+PGNGame = namedtuple("PGNGame", ["headers", "moves", "result", "offset"])
+
+RESULTS = ("1-0", "0-1", "1/2-1/2", "*")
+TAG_PAIR = re.compile(rb'\[\s*(\w+)\s+"((?:[^"\\]|\\.)*)"\s*\]')
+# Movetext tokens: comments, variation brackets, NAGs and everything else (move numbers,
+# moves and results)
+MOVETEXT_TOKEN = re.compile(r"\{[^}]*\}?|;[^\n]*|[()]|\$\d+|[^\s(){};$]+")
+MOVE_NUMBER = re.compile(r"^\d+\.*")
+
+# Seconds between two progress messages of a worker to the parent
+PROGRESS_INTERVAL = 0.5
+
+
+def parse_movetext(text):
+    # (main-line SAN moves, termination marker or None) of the movetext of one game,
+    # leaving out comments, variations, NAGs and move numbers
+    moves, result, depth = [], None, 0
+    for token in MOVETEXT_TOKEN.findall(text):
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth = max(depth - 1, 0)
+        elif depth or token[0] in "{;$":
+            continue
+        elif token in RESULTS:
+            result = token
+        else:
+            token = MOVE_NUMBER.sub("", token)
+            if token:
+                moves.append(token)
+    return moves, result
+
+
+def read_games(pgn, start=0, end=None):
+    # Generate the PGNGames of a PGN file opened in binary mode, reading one line at a time.
+    # With start and end only the games that begin in that byte range are read: reading
+    # starts at the first [Event tag line at or after start (every game begins with its
+    # Event tag in standard PGN) and stops at the first game beginning at or after end.
+    if start:
+        # Skip the rest of the line start falls in
+        pgn.seek(start - 1)
+        pgn.readline()
+        while True:
+            offset = pgn.tell()
+            line = pgn.readline()
+            if not line or line.startswith(b"[Event "):
+                break
+        pgn.seek(offset)
+    else:
+        pgn.seek(0)
+
+    headers, movetext, offset, in_movetext = {}, [], None, False
+    while True:
+        line_offset = pgn.tell()
+        line = pgn.readline()
+        stripped = line.strip()
+        # A tag line after movetext (or the end of the file) finishes the game being read
+        if not line or (in_movetext and stripped.startswith(b"[") and TAG_PAIR.match(stripped)):
+            if offset is not None:
+                moves, result = parse_movetext(" ".join(movetext))
+                yield PGNGame(headers, moves, headers.get("Result", result or "*"), offset)
+            if not line:
+                return
+            headers, movetext, offset, in_movetext = {}, [], None, False
+        if not stripped or stripped.startswith(b"%"):
+            continue
+        if offset is None:
+            if end is not None and line_offset >= end:
+                return
+            offset = line_offset
+        match = TAG_PAIR.match(stripped) if not in_movetext else None
+        if match:
+            headers[match.group(1).decode("ascii")] = match.group(2).decode("utf-8", "replace").replace('\\"', '"')
+        else:
+            in_movetext = True
+            movetext.append(line.decode("utf-8", "replace"))
+
+
+def game_positions(pgn_game, backend="bitboard", top_k=DEFAULT_TOP_K):
+    # Records (see replay.py) of every position of a PGN game, with the move played as its
+    # policy and the game result as its value. Raises ValueError (IllegalMoveError for a
+    # move that does not parse or is illegal) for a malformed game.
+    if pgn_game.result not in RESULTS:
+        raise ValueError(f"invalid result {pgn_game.result!r}")
+    game = BACKENDS[backend]()
+    if "FEN" in pgn_game.headers:
+        game.load_fen(pgn_game.headers["FEN"])
+    records = np.zeros(len(pgn_game.moves), dtype=record_dtype(top_k))
+    for ply, san in enumerate(pgn_game.moves):
+        move = game.parse_san(san)
+        encode_position(game, records[ply], (game.encode_move(move),), (1,), pgn_game.result)
+        game.make_move(move)
+    return records
+
+
+def iter_positions(pgn, start=0, end=None, backend="bitboard", top_k=DEFAULT_TOP_K, skipped=None):
+    # (PGNGame, records) of every well-formed game in a byte range of a PGN file. Malformed
+    # games are skipped, and appended to the skipped list as (PGNGame, error) if one is given.
+    for pgn_game in read_games(pgn, start, end):
+        try:
+            records = game_positions(pgn_game, backend, top_k)
+        except (ValueError, IndexError, KeyError) as error:
+            if skipped is not None:
+                skipped.append((pgn_game, error))
+            continue
+        yield pgn_game, records
+
+
+def shard_ranges(path, count):
+    # count byte ranges covering a file; read_games moves each boundary to a game start
+    size = os.path.getsize(path)
+    bounds = [size * index // count for index in range(count + 1)]
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def worker(path, byte_range, output_path, options, stop, progress):
+    # Import the games starting in one byte range of the PGN file into a shard of its own,
+    # sending (games, positions, skipped) counts to the parent as it goes and None at the end
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    games = positions = 0
+    skipped = []
+    last_progress = time.perf_counter()
+    try:
+        with open(path, "rb") as pgn, ShardWriter(output_path, options.top_k) as writer:
+            for _, records in iter_positions(pgn, *byte_range, options.backend, options.top_k, skipped):
+                writer.add_records(records)
+                games += 1
+                positions += len(records)
+                if time.perf_counter() - last_progress >= PROGRESS_INTERVAL:
+                    progress.put((games, positions, len(skipped)))
+                    games = positions = 0
+                    skipped.clear()
+                    last_progress = time.perf_counter()
+                if stop.is_set():
+                    break
+    finally:
+        progress.put((games, positions, len(skipped)))
+        progress.put(None)
+
+
+def import_pgn(options, report=None):
+    # Split options.pgn into options.workers byte ranges and import them in parallel into
+    # the shards options.output-<n>.bin, calling report with the running totals about once
+    # a second. Returns a summary dict.
+    ranges = shard_ranges(options.pgn, options.workers)
+    outputs = [f"{options.output}-{index:03d}.bin" for index in range(len(ranges))]
+    stop = multiprocessing.Event()
+    progress = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker, args=(options.pgn, byte_range, output, options, stop, progress),
+                                daemon=True)
+        for byte_range, output in zip(ranges, outputs)
+    ]
+
+    def interrupt(signum, frame):
+        # Let every worker finish the game it is importing, then stop. Handled as a flag
+        # rather than KeyboardInterrupt, so that Ctrl-C never cuts a report short.
+        stop.set()
+
+    start = last_report = time.perf_counter()
+    for process in workers:
+        process.start()
+    previous_handler = signal.signal(signal.SIGINT, interrupt)
+
+    totals = {"games": 0, "positions": 0, "skipped": 0}
+    running = len(workers)
+    try:
+        while running:
+            try:
+                message = progress.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    break
+                message = ()
+            if message is None:
+                running -= 1
+            elif message:
+                for key, count in zip(("games", "positions", "skipped"), message):
+                    totals[key] += count
+            now = time.perf_counter()
+            if report is not None and now - last_report >= 1:
+                report(totals, now - start)
+                last_report = now
+
+        for process in workers:
+            process.join()
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+    interrupted = stop.is_set()
+    seconds = time.perf_counter() - start
+    return dict(totals, seconds=round(seconds, 3), outputs=outputs, interrupted=interrupted,
+                games_per_second=round(totals["games"] / seconds, 1) if seconds > 0 else 0.0)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import the positions of a PGN archive into record shards.")
+    parser.add_argument("pgn", help="PGN file")
+    parser.add_argument("--output", default="pgn",
+                        help="shard file prefix; worker n writes PREFIX-<n>.bin (default: pgn)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes, each reading its own part of the file (default: one per core)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--top-k", type=int, default=DEFAULT_TOP_K,
+                        help=f"moves kept per policy for new shards (default: {DEFAULT_TOP_K})")
+    args = parser.parse_args(argv)
+
+    def report(totals, seconds):
+        print(f"{totals['games']} games, {totals['positions']} positions, {totals['skipped']} skipped "
+              f"({totals['games'] / seconds:.1f} games/s)", file=sys.stderr)
+
+    summary = import_pgn(args, report)
+    print(f"{summary['games']} games, {summary['positions']} positions in {summary['seconds']:.3f}s "
+          f"({summary['games_per_second']:.1f} games/s), {summary['skipped']} malformed games skipped; "
+          f"written to {', '.join(summary['outputs'])}" + (" (interrupted)" if summary["interrupted"] else ""))
+    return 130 if summary["interrupted"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,289 @@
+import argparse
+import glob
+import json
+import os
+import struct
+import sys
+import time
+
+import numpy as np
+
+from chess import BACKENDS, PIECE_CODES
+from encoding import POLICY_SIZE, move_codes_to_policy
+
+
+# Training positions are stored as fixed-width records in append-only shard files: a
+# 16-byte header followed by nothing but records, so a shard can be memory-mapped as one
+# NumPy array. Squares are numbered row * 8 + col as everywhere else.
+#   board       64 squares as nibbles, two per byte (low nibble first): 0 for an empty
+#               square, 1 + the PIECE_CODES index of the piece otherwise
+#   flags       FLAG_* bits: side to move, castling rights, unfinished game
+#   en_passant  en passant target square, -1 for none
+#   result      game outcome for white: 1, 0 or -1 (0 as well for unfinished games)
+#   moves       packed move codes of the top_k most visited moves, visits their visit
+#               counts; unused slots have 0 visits
+SHARD_MAGIC = b"AZRB"
+SHARD_VERSION = 1
+SHARD_HEADER = struct.Struct("<4sHHI4x")
+DEFAULT_TOP_K = 16
+
+FLAG_BLACK_TO_MOVE = 1
+FLAG_WHITE_KINGSIDE = 2
+FLAG_WHITE_QUEENSIDE = 4
+FLAG_BLACK_KINGSIDE = 8
+FLAG_BLACK_QUEENSIDE = 16
+FLAG_UNFINISHED = 32
+
+PIECE_NIBBLES = {piece: nibble for nibble, piece in enumerate(PIECE_CODES, 1)}
+PIECE_NIBBLES["  "] = 0
+RESULT_VALUES = {"1-0": 1, "0-1": -1, "1/2-1/2": 0, "*": 0}
+
+
+def record_dtype(top_k=DEFAULT_TOP_K):
+    return np.dtype([
+        ("board", np.uint8, 32),
+        ("flags", np.uint8),
+        ("en_passant", np.int8),
+        ("result", np.int8),
+        ("moves", np.uint16, top_k),
+        ("visits", np.uint16, top_k),
+    ])
+
+
+def pack_board(board):
+    # 32 bytes of nibbles for a ChessGame board
+    nibbles = [PIECE_NIBBLES[piece] for row in board for piece in row]
+    return bytes(nibbles[square] | nibbles[square + 1] << 4 for square in range(0, 64, 2))
+
+
+def unpack_boards(boards):
+    # (N, 64) array of piece nibbles from an (N, 32) array of packed boards
+    squares = np.empty((len(boards), 64), dtype=np.uint8)
+    squares[:, 0::2] = boards & 15
+    squares[:, 1::2] = boards >> 4
+    return squares
+
+
+def encode_position(game, record, moves, visits, result):
+    # Fill one record with the position of game, the given (move code, visit count) policy
+    # and the game result string
+    record["board"] = np.frombuffer(pack_board(game.board), dtype=np.uint8)
+    flags = FLAG_BLACK_TO_MOVE if game.turn == "black" else 0
+    if not game.white_king_moved:
+        flags |= (FLAG_WHITE_KINGSIDE if not game.white_rook_moved["right"] else 0) | \
+                 (FLAG_WHITE_QUEENSIDE if not game.white_rook_moved["left"] else 0)
+    if not game.black_king_moved:
+        flags |= (FLAG_BLACK_KINGSIDE if not game.black_rook_moved["right"] else 0) | \
+                 (FLAG_BLACK_QUEENSIDE if not game.black_rook_moved["left"] else 0)
+    if result == "*":
+        flags |= FLAG_UNFINISHED
+    record["flags"] = flags
+    target = game.en_passant_target
+    record["en_passant"] = -1 if target is None else target[0] * 8 + target[1]
+    record["result"] = RESULT_VALUES[result]
+
+    # Keep the top_k most visited moves
+    top_k = len(record["moves"])
+    order = np.argsort(visits, kind="stable")[::-1][:top_k]
+    record["moves"] = 0
+    record["visits"] = 0
+    record["moves"][:len(order)] = np.asarray(moves, dtype=np.uint16)[order]
+    record["visits"][:len(order)] = np.minimum(np.asarray(visits)[order], 65535)
+
+
+class ShardWriter:
+    # Appends records to a shard file, writing the header first if the file is new. Records
+    # are buffered and written buffer_size at a time; close (or leave the with block) to
+    # write the rest.
+    def __init__(self, path, top_k=DEFAULT_TOP_K, buffer_size=4096):
+        self.path = path
+        self.dtype = record_dtype(top_k)
+        self.file = open(path, "ab")
+        if self.file.tell() == 0:
+            self.file.write(SHARD_HEADER.pack(SHARD_MAGIC, SHARD_VERSION, top_k, self.dtype.itemsize))
+        else:
+            read_shard_header(path, top_k)
+        self.buffer = np.zeros(buffer_size, dtype=self.dtype)
+        self.count = 0
+        self.written = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def next_record(self):
+        # Next free record of the buffer, flushing it first when full
+        if self.count == len(self.buffer):
+            self.flush()
+        self.count += 1
+        return self.buffer[self.count - 1]
+
+    def flush(self):
+        self.file.write(self.buffer[:self.count].tobytes())
+        self.file.flush()
+        self.written += self.count
+        self.count = 0
+
+    def close(self):
+        if not self.file.closed:
+            self.flush()
+            self.file.close()
+
+    def add_records(self, records):
+        # Append an array of records of this shard's dtype
+        for start in range(0, len(records), len(self.buffer)):
+            chunk = records[start:start + len(self.buffer)]
+            if self.count + len(chunk) > len(self.buffer):
+                self.flush()
+            self.buffer[self.count:self.count + len(chunk)] = chunk
+            self.count += len(chunk)
+
+    def add_game(self, game_record, backend="bitboard"):
+        # Append every position of a self-play game record (as written by selfplay.py),
+        # with its MCTS visit counts or, without them, the move played as the only policy
+        game = BACKENDS[backend]()
+        all_visits = game_record.get("visits")
+        for ply, notation in enumerate(game_record["moves"]):
+            if all_visits:
+                moves, visits = zip(*all_visits[ply])
+            else:
+                moves, visits = (game.encode_move(notation),), (1,)
+            encode_position(game, self.next_record(), moves, visits, game_record["result"])
+            game.push(notation)
+
+
+def read_shard_header(path, top_k=None):
+    # top_k of a shard, after checking its header
+    with open(path, "rb") as shard:
+        header = shard.read(SHARD_HEADER.size)
+    if len(header) < SHARD_HEADER.size:
+        raise ValueError(f"{path}: not a record shard (file too short)")
+    magic, version, shard_top_k, record_size = SHARD_HEADER.unpack(header)
+    if magic != SHARD_MAGIC or version != SHARD_VERSION:
+        raise ValueError(f"{path}: not a version {SHARD_VERSION} record shard")
+    if record_size != record_dtype(shard_top_k).itemsize or (top_k is not None and shard_top_k != top_k):
+        raise ValueError(f"{path}: record layout does not match (top_k {shard_top_k})")
+    return shard_top_k
+
+
+class ReplayBuffer:
+    # Memory-maps a list of shards (oldest first) as one window of positions, keeping only
+    # the newest window positions if given. Nothing is read until a sample touches it.
+    def __init__(self, paths, window=None):
+        self.shards = []
+        for path in paths:
+            top_k = read_shard_header(path)
+            dtype = record_dtype(top_k)
+            count = (os.path.getsize(path) - SHARD_HEADER.size) // dtype.itemsize
+            if count:
+                self.shards.append(np.memmap(path, dtype=dtype, mode="r", offset=SHARD_HEADER.size, shape=(count,)))
+        if len({shard.dtype for shard in self.shards}) > 1:
+            raise ValueError("shards of one replay buffer must share top_k")
+
+        # Drop whole shards, then leading records, that fall outside the window
+        sizes = [len(shard) for shard in self.shards]
+        if window is not None:
+            while self.shards and sum(sizes) - sizes[0] >= window:
+                self.shards.pop(0)
+                sizes.pop(0)
+            if self.shards and sum(sizes) > window:
+                self.shards[0] = self.shards[0][sum(sizes) - window:]
+                sizes[0] = len(self.shards[0])
+        self.ends = np.cumsum(sizes, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) else 0
+
+    def __getitem__(self, index):
+        # Record(s) at window positions index: a view for a slice inside one shard, a
+        # gathered copy for an index array
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(len(self))
+            if start >= stop:
+                return self.shards[0][:0] if self.shards else np.empty(0, dtype=record_dtype(DEFAULT_TOP_K))
+            shard = int(np.searchsorted(self.ends, start, side="right"))
+            offset = int(self.ends[shard - 1]) if shard else 0
+            if stop <= self.ends[shard]:
+                return self.shards[shard][start - offset:stop - offset]
+            index = np.arange(start, stop)
+        index = np.asarray(index, dtype=np.int64)
+        shard_of = np.searchsorted(self.ends, index, side="right")
+        batch = np.empty(len(index), dtype=self.shards[0].dtype)
+        for shard in np.unique(shard_of):
+            offset = int(self.ends[shard - 1]) if shard else 0
+            rows = shard_of == shard
+            batch[rows] = self.shards[shard][index[rows] - offset]
+        return batch
+
+    def sample(self, batch_size, rng=None):
+        # batch_size records drawn uniformly from the window. Only these records are read
+        # from the memory map.
+        rng = rng or np.random.default_rng()
+        return self[np.sort(rng.integers(0, len(self), batch_size))]
+
+
+def policy_targets(records):
+    # (N, 4672) float32 visit distributions of a batch of records, in the policy layout of
+    # encoding.py (seen from each record's side to move)
+    targets = np.zeros((len(records), POLICY_SIZE), dtype=np.float32)
+    visits = records["visits"].astype(np.float32)
+    totals = visits.sum(axis=1, keepdims=True)
+    black = (records["flags"] & FLAG_BLACK_TO_MOVE).astype(bool)
+    indices = np.where(black[:, None], move_codes_to_policy(records["moves"], True),
+                       move_codes_to_policy(records["moves"], False))
+    rows = np.broadcast_to(np.arange(len(records))[:, None], indices.shape)
+    used = visits > 0
+    targets[rows[used], indices[used]] = (visits / np.maximum(totals, 1))[used]
+    return targets
+
+
+def values(records):
+    # Game outcome of each record for its side to move
+    black = (records["flags"] & FLAG_BLACK_TO_MOVE).astype(bool)
+    return np.where(black, -records["result"], records["result"]).astype(np.float32)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pack self-play games into record shards or inspect shards.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    pack = commands.add_parser("pack", help="append the games of JSON-lines files to a shard")
+    pack.add_argument("shard", help="shard file to append to")
+    pack.add_argument("games", nargs="+", help="self-play JSON-lines files")
+    pack.add_argument("--top-k", type=int, default=DEFAULT_TOP_K,
+                      help=f"moves kept per policy for a new shard (default: {DEFAULT_TOP_K})")
+    stats = commands.add_parser("stats", help="memory-map shards and time minibatch sampling")
+    stats.add_argument("shards", nargs="+", help="shard files or glob patterns, oldest first")
+    stats.add_argument("--window", type=int, help="keep only the newest WINDOW positions")
+    stats.add_argument("--batch-size", type=int, default=1024, help="minibatch size (default: 1024)")
+    args = parser.parse_args(argv)
+
+    if args.command == "pack":
+        with ShardWriter(args.shard, args.top_k) as writer:
+            for path in args.games:
+                with open(path) as games:
+                    for line in games:
+                        writer.add_game(json.loads(line))
+            positions = writer.written + writer.count
+        print(f"{positions} positions appended to {args.shard}")
+        return 0
+
+    paths = [path for pattern in args.shards for path in sorted(glob.glob(pattern)) or [pattern]]
+    start = time.perf_counter()
+    buffer = ReplayBuffer(paths, args.window)
+    opened = time.perf_counter() - start
+    print(f"{len(buffer)} positions in {len(buffer.shards)} shards, opened in {opened:.3f}s")
+    if len(buffer):
+        rng = np.random.default_rng(0)
+        start = time.perf_counter()
+        for _ in range(10):
+            batch = buffer.sample(args.batch_size, rng)
+            policy_targets(batch)
+        seconds = (time.perf_counter() - start) / 10
+        print(f"minibatch of {args.batch_size} with policy targets in {seconds * 1000:.1f}ms")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,345 @@
+import argparse
+import sys
+import time
+from collections import namedtuple
+
+from chess import (BACKENDS, MOVE_EN_PASSANT, MOVE_PROMOTION, PERFT_POSITIONS, PIECE_VALUES, SEE_PIECE_VALUES, START_FEN,
+                   unpack_move)
+from tablebase import Tablebase
+from transposition import BOUND_EXACT, BOUND_LOWER, BOUND_UPPER, TranspositionTable
+
+
+# Scores are centipawns for the side to move. A mate found n plies from the root scores
+# MATE_SCORE - n, so anything beyond MATE_BOUND is a forced mate.
+MATE_SCORE = 30000
+MATE_BOUND = MATE_SCORE - 1000
+INFINITY = 32000
+MAX_PLY = 128
+
+# Move ordering priorities: hash move, then captures that do not lose material (by MVV-LVA)
+# and promotions, then the two killer moves of the ply, then quiet moves by history score,
+# then captures that lose material by static exchange evaluation
+HASH_MOVE_ORDER = 1 << 30
+CAPTURE_ORDER = 1 << 24
+KILLER_ORDER = 1 << 22
+
+# Quiescence skips captures that cannot bring the score back up to alpha even with this margin
+DELTA_MARGIN = 200
+
+# One line of search output per completed iteration; pv is a list of packed move codes
+SearchInfo = namedtuple("SearchInfo", ["depth", "score", "nodes", "seconds", "nps", "pv"])
+
+
+class SearchAborted(Exception):
+    # Raised inside the search when the time or node budget runs out
+    pass
+
+
+def score_to_table(score, ply):
+    # Mate scores are stored relative to the node, not the root
+    if score >= MATE_BOUND:
+        return score + ply
+    if score <= -MATE_BOUND:
+        return score - ply
+    return score
+
+
+def score_from_table(score, ply):
+    if score >= MATE_BOUND:
+        return score - ply
+    if score <= -MATE_BOUND:
+        return score + ply
+    return score
+
+
+def format_score(score):
+    # UCI score string: "cp 35" or "mate 3" (negative when the side to move gets mated)
+    if abs(score) >= MATE_BOUND:
+        plies = MATE_SCORE - abs(score)
+        return f"mate {(plies + 1) // 2 if score > 0 else -(plies // 2)}"
+    return f"cp {score}"
+
+
+class AlphaBetaSearch:
+    # Negamax alpha-beta with iterative deepening, principal variation search, late move
+    # reductions, a transposition table and quiescence search over captures. Leaves are
+    # scored with ChessGame.evaluate, which make_move and unmake_move keep up to date.
+    def __init__(self, game, table=None, hash_mb=16, tablebase=None):
+        self.game = game
+        self.table = table if table is not None else TranspositionTable(hash_mb)
+        # Endgame tables (see tablebase.py) that end the search in the positions they cover
+        self.tablebase = tablebase
+        self.root_in_tablebase = False
+        self.nodes = 0
+        self.deadline = None
+        self.node_limit = None
+        self.stopped = False
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        # Indexed by color (0 white, 1 black) and the from / to bits of a move code
+        self.history = [[0] * 4096, [0] * 4096]
+        self.pv = [[] for _ in range(MAX_PLY + 1)]
+
+    def stop(self):
+        # Ask a running search (on another thread) to return as soon as possible
+        self.stopped = True
+
+    def search(self, max_depth=64, time_limit=None, node_limit=None, report=None):
+        # Search the game's position to max_depth plies or until time_limit seconds or
+        # node_limit nodes are used, calling report with a SearchInfo after every completed
+        # iteration. Returns the SearchInfo of the deepest one (depth 1 always completes).
+        # The game is left in the position it was searched from, also after an abort.
+        game = self.game
+        entry_plies = len(game.undo_stack)
+        self.table.new_search()
+        self.nodes = 0
+        self.stopped = False
+        self.killers = [[0, 0] for _ in range(MAX_PLY)]
+        self.history = [[0] * 4096, [0] * 4096]
+        start = time.perf_counter()
+        self.deadline = None
+        self.node_limit = None
+        self.root_in_tablebase = self.tablebase is not None and self.tablebase.probe(game) is not None
+
+        best = None
+        for depth in range(1, min(max_depth, MAX_PLY - 1) + 1):
+            try:
+                score = self.negamax(depth, -INFINITY, INFINITY, 0)
+            except SearchAborted:
+                # The abort unwinds the recursion with the moves of the line being searched
+                # still made, so take them back
+                while len(game.undo_stack) > entry_plies:
+                    game.unmake_move()
+                break
+            seconds = time.perf_counter() - start
+            best = SearchInfo(depth, score, self.nodes, seconds, int(self.nodes / seconds) if seconds > 0 else 0,
+                              list(self.pv[0]))
+            if report is not None:
+                report(best)
+            # Budgets only apply once there is a move to return
+            self.deadline = start + time_limit if time_limit is not None else None
+            self.node_limit = node_limit
+            if not game.get_status().legal_moves or abs(score) >= MATE_BOUND:
+                break
+            if (self.deadline is not None and time.perf_counter() - start > time_limit / 2) or \
+                    (node_limit is not None and self.nodes >= node_limit) or self.stopped:
+                break
+        return best
+
+    def check_limits(self):
+        if self.stopped or (self.deadline is not None and time.perf_counter() > self.deadline) or \
+                (self.node_limit is not None and self.nodes >= self.node_limit):
+            raise SearchAborted
+
+    def order_moves(self, status, tt_move, ply):
+        # Indices of status.legal_moves, best candidates first
+        board = self.game.board
+        killers = self.killers[ply]
+        history = self.history[self.game.turn == "black"]
+        scores = []
+        for index, code in enumerate(status.move_codes):
+            if code == tt_move:
+                scores.append(HASH_MOVE_ORDER)
+                continue
+            victim = board[code >> 9 & 7][code >> 6 & 7]
+            flag = code >> 14
+            if victim != "  " or flag == MOVE_EN_PASSANT or flag == MOVE_PROMOTION:
+                attacker = board[code >> 3 & 7][code & 7]
+                gain = PIECE_VALUES[victim[1]] if victim != "  " else (100 if flag == MOVE_EN_PASSANT else 0)
+                if flag == MOVE_PROMOTION:
+                    gain += PIECE_VALUES["nbrq"[code >> 12 & 3]]
+                elif SEE_PIECE_VALUES[attacker[1]] > gain:
+                    exchange = self.game.see(status.legal_moves[index])
+                    if exchange < 0:
+                        scores.append(exchange)
+                        continue
+                scores.append(CAPTURE_ORDER + gain * 16 - PIECE_VALUES[attacker[1]] // 16)
+            elif code == killers[0]:
+                scores.append(KILLER_ORDER + 1)
+            elif code == killers[1]:
+                scores.append(KILLER_ORDER)
+            else:
+                scores.append(history[code & 4095])
+        return sorted(range(len(scores)), key=scores.__getitem__, reverse=True)
+
+    def negamax(self, depth, alpha, beta, ply):
+        game = self.game
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_limits()
+        self.pv[ply] = []
+
+        # Repetitions within the search are scored as draws
+        key = game.zobrist_key
+        if ply and game.position_counts[key] >= 2:
+            return 0
+
+        # Table positions are scored exactly. Only a capture or pawn move can bring the
+        # material down to a table, unless the search started inside one.
+        if self.tablebase is not None and ply and (game.halfmove_clock == 0 or self.root_in_tablebase):
+            result = self.tablebase.probe(game)
+            if result is not None:
+                return result.wdl * (MATE_SCORE - ply - result.plies) if result.wdl else 0
+
+        # Checks are extended by a ply; other horizon nodes go to quiescence before any
+        # move generation
+        if (depth <= 0 and not game.is_king_in_check()) or ply >= MAX_PLY - 1:
+            return self.quiesce(alpha, beta, ply)
+
+        # A deep enough table entry saves generating the moves at all
+        tt_move = 0
+        entry = self.table.probe(key)
+        if entry is not None:
+            tt_move = entry.move
+            if ply and entry.depth >= depth:
+                score = score_from_table(entry.score, ply)
+                if entry.bound == BOUND_EXACT or \
+                        (entry.bound == BOUND_LOWER and score >= beta) or \
+                        (entry.bound == BOUND_UPPER and score <= alpha):
+                    return score
+
+        status = game.get_status()
+        if not status.legal_moves:
+            return -MATE_SCORE + ply if status.in_check else 0
+        if status.in_check:
+            depth += 1
+
+        original_alpha = alpha
+        best_score, best_move = -INFINITY, 0
+        moves, codes = status.legal_moves, status.move_codes
+        board = game.board
+        for searched, index in enumerate(self.order_moves(status, tt_move, ply)):
+            move, code = moves[index], codes[index]
+            quiet = board[move.dest[0]][move.dest[1]] == "  " and code >> 14 not in (MOVE_EN_PASSANT, MOVE_PROMOTION)
+            game.make_move(move)
+            if searched == 0:
+                score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            else:
+                # Late quiet moves are searched shallower first, and every move after the
+                # first with a null window; either is redone in full if it beats alpha
+                reduction = 1 if depth >= 3 and searched >= 4 and quiet and not status.in_check else 0
+                score = -self.negamax(depth - 1 - reduction, -alpha - 1, -alpha, ply + 1)
+                if reduction and score > alpha:
+                    score = -self.negamax(depth - 1, -alpha - 1, -alpha, ply + 1)
+                if alpha < score < beta:
+                    score = -self.negamax(depth - 1, -beta, -alpha, ply + 1)
+            game.unmake_move()
+
+            if score > best_score:
+                best_score, best_move = score, code
+                if score > alpha:
+                    alpha = score
+                    self.pv[ply] = [code] + self.pv[ply + 1]
+                    if alpha >= beta:
+                        if quiet:
+                            killers = self.killers[ply]
+                            if killers[0] != code:
+                                killers[1], killers[0] = killers[0], code
+                            self.history[game.turn == "black"][code & 4095] += depth * depth
+                        break
+
+        if best_score <= original_alpha:
+            bound = BOUND_UPPER
+        elif best_score >= beta:
+            bound = BOUND_LOWER
+        else:
+            bound = BOUND_EXACT
+        self.table.store(key, best_move, score_to_table(best_score, ply), depth, bound)
+        return best_score
+
+    def quiesce(self, alpha, beta, ply):
+        # Search captures and queen promotions only, letting the side to move stand pat on
+        # the static evaluation
+        game = self.game
+        self.nodes += 1
+        if not self.nodes & 1023:
+            self.check_limits()
+        self.pv[ply] = []
+
+        # Standing pat needs no move generation, so it is tried first; mates and
+        # stalemates are only noticed when it fails
+        stand_pat = game.evaluate()
+        if stand_pat >= beta or ply >= MAX_PLY - 1:
+            return stand_pat
+        status = game.get_status()
+        if not status.legal_moves:
+            return -MATE_SCORE + ply if status.in_check else 0
+        if stand_pat > alpha:
+            alpha = stand_pat
+
+        board = game.board
+        captures = []
+        for index, code in enumerate(status.move_codes):
+            victim = board[code >> 9 & 7][code >> 6 & 7]
+            flag = code >> 14
+            if victim != "  " or flag == MOVE_EN_PASSANT or (flag == MOVE_PROMOTION and code >> 12 & 3 == 3):
+                gain = PIECE_VALUES[victim[1]] if victim != "  " else (100 if flag == MOVE_EN_PASSANT else 0)
+                if flag == MOVE_PROMOTION:
+                    gain += PIECE_VALUES["q"] - PIECE_VALUES["p"]
+                if stand_pat + gain + DELTA_MARGIN <= alpha:
+                    continue
+                attacker = board[code >> 3 & 7][code & 7]
+                # Captures that lose material in the exchange are not worth searching
+                if flag != MOVE_PROMOTION and SEE_PIECE_VALUES[attacker[1]] > gain and \
+                        game.see(status.legal_moves[index]) < 0:
+                    continue
+                captures.append((gain * 16 - PIECE_VALUES[attacker[1]] // 16, index))
+        captures.sort(reverse=True)
+
+        for _, index in captures:
+            game.make_move(status.legal_moves[index])
+            score = -self.quiesce(-beta, -alpha, ply + 1)
+            game.unmake_move()
+            if score >= beta:
+                return score
+            if score > alpha:
+                alpha = score
+                self.pv[ply] = [status.move_codes[index]] + self.pv[ply + 1]
+        return alpha
+
+
+def format_info(info):
+    # UCI style "info" line of a SearchInfo
+    pv = " ".join(unpack_move(code).uci() for code in info.pv)
+    return (f"info depth {info.depth} score {format_score(info.score)} nodes {info.nodes} "
+            f"nps {info.nps} time {int(info.seconds * 1000)} pv {pv}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Search a position with iterative-deepening alpha-beta.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--fen", default=START_FEN, help="position to search (default: start position)")
+    parser.add_argument("--depth", type=int, default=64, help="maximum depth in plies (default: 64)")
+    parser.add_argument("--movetime", type=float, default=1.0, help="time limit in seconds (default: 1)")
+    parser.add_argument("--nodes", type=int, help="node limit")
+    parser.add_argument("--hash", type=int, default=16, help="transposition table size in MB (default: 16)")
+    parser.add_argument("--tablebase", metavar="DIRECTORY", help="endgame tables to use (see tablebase.py)")
+    parser.add_argument("--check-aborts", action="store_true",
+                        help="check that node-limited searches of the perft positions leave the game unchanged")
+    args = parser.parse_args(argv)
+
+    if args.check_aborts:
+        passed = True
+        for name, fen, _ in PERFT_POSITIONS:
+            game = BACKENDS[args.backend]()
+            game.load_fen(fen)
+            ok = True
+            for node_limit in (500, 3000, 20000):
+                AlphaBetaSearch(game, hash_mb=args.hash).search(args.depth, node_limit=node_limit)
+                ok = ok and game.to_fen() == fen and not game.undo_stack and game.zobrist_key == game.compute_zobrist_key()
+            passed = passed and ok
+            print(f"{name:<10} {'ok' if ok else 'MISMATCH'}")
+        return 0 if passed else 1
+
+    game = BACKENDS[args.backend]()
+    game.load_fen(args.fen)
+    tablebase = Tablebase(args.tablebase) if args.tablebase else None
+    result = AlphaBetaSearch(game, hash_mb=args.hash, tablebase=tablebase).search(
+        args.depth, args.movetime, args.nodes, report=lambda info: print(format_info(info)))
+    if result is not None and result.pv:
+        print(f"bestmove {unpack_move(result.pv[0]).uci()}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
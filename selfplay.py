@@ -0,0 +1,272 @@
+import argparse
+import json
+import multiprocessing
+import queue
+import random
+import signal
+import sys
+import time
+import traceback
+
+from book import OpeningBook
+from chess import BACKENDS, move_to_uci
+from mcts import MCTS, RolloutEvaluator, UniformEvaluator
+from replay import ShardWriter
+from search import AlphaBetaSearch
+from tablebase import Tablebase
+from transposition import TranspositionTable
+
+
+# Move policies pick the next move of a headless game as a packed move code. Each game
+# gets a fresh policy built from its own random.Random, so a game depends only on the
+# base seed and its game number, not on which worker happened to play it.
+
+class RandomPolicy:
+    def __init__(self, rng, options):
+        self.random = rng
+
+    def choose(self, game):
+        return self.random.choice(game.legal_move_codes())
+
+    def moved(self, game):
+        pass
+
+
+class MCTSPolicy:
+    # MCTS with a CPU evaluator, sampling by visit counts for the first temperature_plies
+    # plies and playing the most visited move after that. The tree is reused between moves.
+    def __init__(self, rng, options):
+        evaluator = RolloutEvaluator(seed=rng.getrandbits(32)) if options.evaluator == "rollout" else UniformEvaluator()
+        self.search = MCTS(evaluator, seed=rng.getrandbits(32))
+        self.simulations = options.simulations
+        self.temperature_plies = options.temperature_plies
+        self.visits = []
+
+    def choose(self, game):
+        self.search.search(game, self.simulations)
+        codes, visits = self.search.root_visits()
+        self.visits.append([[int(code), int(count)] for code, count in zip(codes, visits) if count])
+        temperature = 1.0 if len(game.undo_stack) < self.temperature_plies else 0
+        return self.search.choose_move(temperature)
+
+    def moved(self, game):
+        self.search.advance(game)
+
+
+class EnginePolicy:
+    # Alpha-beta search to engine_depth plies (or engine_nodes nodes), after engine_random_plies
+    # random opening moves so that games differ
+    def __init__(self, rng, options):
+        self.random = rng
+        self.depth = options.engine_depth
+        self.nodes = options.engine_nodes
+        self.random_plies = options.engine_random_plies
+        self.table = TranspositionTable(options.hash)
+
+    def choose(self, game):
+        if len(game.undo_stack) < self.random_plies:
+            return self.random.choice(game.legal_move_codes())
+        return AlphaBetaSearch(game, self.table).search(self.depth, node_limit=self.nodes).pv[0]
+
+    def moved(self, game):
+        pass
+
+
+MOVE_POLICIES = {"random": RandomPolicy, "mcts": MCTSPolicy, "engine": EnginePolicy}
+
+
+def open_resources(options):
+    # (Tablebase, OpeningBook) of the options, None for those not asked for. Both memory-map
+    # their files, so a worker opens them once and shares them between its games.
+    tablebase = Tablebase(options.tablebase) if options.tablebase else None
+    book = OpeningBook(options.book) if options.book else None
+    return tablebase, book
+
+
+def play_game(game_number, options, tablebase=None, book=None):
+    # Play one game headlessly and return it as a JSON-ready dict. Games still going after
+    # max_plies plies are stopped with result "*", and with endgame tables games that reach
+    # a table position are given its result. With an opening book, book moves are played
+    # without asking the policy until the game leaves the book.
+    rng = random.Random(f"{options.seed}:{game_number}")
+    game = BACKENDS[options.backend]()
+    policy = MOVE_POLICIES[options.policy](rng, options)
+    moves = []
+    result = None
+    while result is None and len(moves) < options.max_plies:
+        book_move = book.choose(game, rng) if book is not None else None
+        if book_move is None:
+            book = None
+            move = game.push(policy.choose(game))
+        else:
+            # Book positions still get a policy target: the move played
+            if isinstance(policy, MCTSPolicy):
+                policy.visits.append([[game.encode_move(book_move), 1]])
+            move = game.push(book_move)
+        policy.moved(game)
+        moves.append(move_to_uci(move))
+        result = game.result()
+        probe = tablebase.probe(game) if tablebase is not None and result is None else None
+        if probe is not None:
+            winner = "1-0" if (probe.wdl > 0) == (game.turn == "white") else "0-1"
+            result = winner if probe.wdl else "1/2-1/2"
+
+    record = {"game": game_number, "result": result or "*", "plies": len(moves), "moves": moves}
+    if isinstance(policy, MCTSPolicy):
+        record["visits"] = policy.visits
+    return record
+
+
+def worker(options, games_started, stop, output):
+    # Claim game numbers from the shared counter until the budget is used up or the parent
+    # asks to stop, sending every finished game to the parent right away. An exception is
+    # sent to the parent as its traceback string before the worker ends. The parent
+    # handles Ctrl-C for the whole process group.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    try:
+        tablebase, book = open_resources(options)
+        while not stop.is_set():
+            with games_started.get_lock():
+                game_number = games_started.value
+                if game_number >= options.games:
+                    break
+                games_started.value += 1
+            output.put(play_game(game_number, options, tablebase, book))
+    except Exception:
+        output.put(traceback.format_exc())
+    finally:
+        output.put(None)
+
+
+def run_selfplay(options, write):
+    # Run options.workers worker processes and pass every finished game to write as it comes
+    # in. Returns a summary dict; its errors list holds the traceback of every worker that
+    # failed, and the other workers are stopped after the first failure.
+    games_started = multiprocessing.Value("i", 0)
+    stop = multiprocessing.Event()
+    output = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker, args=(options, games_started, stop, output), daemon=True)
+        for _ in range(options.workers)
+    ]
+
+    def interrupt(signum, frame):
+        # Let every worker finish the game it is playing, then stop. Handled as a flag
+        # rather than KeyboardInterrupt, so that Ctrl-C never cuts a write short.
+        if not stop.is_set():
+            print("Interrupted: finishing the games in progress...", file=sys.stderr)
+        stop.set()
+
+    start = time.perf_counter()
+    for process in workers:
+        process.start()
+    previous_handler = signal.signal(signal.SIGINT, interrupt)
+
+    games = positions = 0
+    results = {}
+    errors = []
+    running = len(workers)
+    try:
+        while running:
+            try:
+                record = output.get(timeout=0.5)
+            except queue.Empty:
+                if not any(process.is_alive() for process in workers):
+                    break
+                continue
+            if record is None:
+                running -= 1
+                continue
+            if isinstance(record, str):
+                errors.append(record)
+                stop.set()
+                continue
+            write(record)
+            games += 1
+            positions += record["plies"]
+            results[record["result"]] = results.get(record["result"], 0) + 1
+
+        for process in workers:
+            process.join()
+    finally:
+        signal.signal(signal.SIGINT, previous_handler)
+    interrupted = stop.is_set() and not errors
+    seconds = time.perf_counter() - start
+    return {
+        "games": games,
+        "positions": positions,
+        "seconds": round(seconds, 3),
+        "games_per_second": round(games / seconds, 3) if seconds > 0 else 0.0,
+        "positions_per_second": round(positions / seconds, 1) if seconds > 0 else 0.0,
+        "results": results,
+        "interrupted": interrupted,
+        "errors": errors,
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate self-play games on several worker processes.")
+    parser.add_argument("--games", type=int, default=100, help="total number of games to play (default: 100)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes (default: one per core)")
+    parser.add_argument("--policy", choices=sorted(MOVE_POLICIES), default="random",
+                        help="how moves are chosen (default: random)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--max-plies", type=int, default=512,
+                        help="stop unfinished games after this many plies (default: 512)")
+    parser.add_argument("--simulations", type=int, default=100, help="MCTS simulations per move (default: 100)")
+    parser.add_argument("--evaluator", choices=("uniform", "rollout"), default="uniform",
+                        help="MCTS leaf evaluator (default: uniform)")
+    parser.add_argument("--temperature-plies", type=int, default=30,
+                        help="plies sampled by visit count before MCTS plays its best move (default: 30)")
+    parser.add_argument("--engine-depth", type=int, default=3, help="alpha-beta search depth (default: 3)")
+    parser.add_argument("--engine-nodes", type=int, help="alpha-beta node limit per move")
+    parser.add_argument("--engine-random-plies", type=int, default=8,
+                        help="random opening plies before the engine takes over (default: 8)")
+    parser.add_argument("--hash", type=int, default=8,
+                        help="engine transposition table size in MB per worker (default: 8)")
+    parser.add_argument("--book", help="opening book to play the first moves from (see book.py)")
+    parser.add_argument("--tablebase", metavar="DIRECTORY",
+                        help="end games as soon as they reach a position of these endgame tables")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="base seed; game N is always played the same way for a given seed (default: 0)")
+    parser.add_argument("--output", default="selfplay.jsonl",
+                        help="file finished games are appended to, - for stdout with --format jsonl "
+                             "(default: selfplay.jsonl)")
+    parser.add_argument("--format", choices=("jsonl", "shard"), default="jsonl",
+                        help="JSON lines of moves, or binary position records (see replay.py) (default: jsonl)")
+    args = parser.parse_args(argv)
+
+    if args.format == "shard":
+        output = ShardWriter(args.output)
+
+        def write(record):
+            output.add_game(record, args.backend)
+            output.flush()
+    else:
+        output = sys.stdout if args.output == "-" else open(args.output, "a")
+
+        def write(record):
+            output.write(json.dumps(record, separators=(",", ":")) + "\n")
+            output.flush()
+
+    try:
+        summary = run_selfplay(args, write)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    print(f"{summary['games']} games, {summary['positions']} positions in {summary['seconds']:.3f}s "
+          f"({summary['games_per_second']:.2f} games/s, {summary['positions_per_second']:.0f} positions/s); "
+          f"results {summary['results']}" + (" (interrupted)" if summary["interrupted"] else ""),
+          file=sys.stderr)
+    for error in summary["errors"]:
+        print(f"Worker failed:\n{error}", file=sys.stderr, end="")
+    if summary["errors"]:
+        return 1
+    return 130 if summary["interrupted"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
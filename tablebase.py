@@ -0,0 +1,419 @@
+import argparse
+import mmap
+import multiprocessing
+import os
+import struct
+import sys
+import time
+from array import array
+from collections import namedtuple
+
+import numpy as np
+
+from chess import BACKENDS
+
+
+# Endgame tables hold one signed byte per position of a material set such as KQvK (white's
+# pieces, then black's), for the side to move: 0 for a draw, +(n + 1) for a win and -(n + 1)
+# for a loss with mate n plies away (so a checkmated side to move stores -1), ILLEGAL for
+# index values that are not legal positions. A table file is a 32-byte header followed by
+# the values, and is probed through mmap. Castling and en passant are not part of any
+# table, so pawns are only supported for one side.
+TABLE_MAGIC = b"AZTB"
+TABLE_VERSION = 1
+TABLE_HEADER = struct.Struct("<4sHH16sQ")
+TABLE_SUFFIX = ".aztb"
+ILLEGAL = -128
+MAX_PLIES = 126
+
+# Non-king pieces in the order material names list them
+MATERIAL_ORDER = "QRBNP"
+
+# Symmetry reduction: the white king is moved into the a1-d1-d4 triangle by flipping files,
+# ranks and the a1-h8 diagonal, or only into files a-d once there are pawns
+KING_REGION = tuple((row, col) for row in range(8) for col in range(4) if 7 - row <= col)
+PAWN_KING_REGION = tuple((row, col) for row in range(8) for col in range(4))
+
+# Positions handed to a worker process at a time while generating a table
+SLICE_SIZE = 4096
+
+# Probe result for the side to move: wdl is 1, 0 or -1 and plies the distance to mate
+# (None for draws)
+TBResult = namedtuple("TBResult", ["wdl", "plies"])
+
+
+def parse_material(name):
+    # (white, black) piece letters of a material name, e.g. "KQvK" -> ("KQ", "K")
+    sides = name.upper().split("V")
+    if len(sides) != 2 or any(side[:1] != "K" or any(letter not in MATERIAL_ORDER for letter in side[1:])
+                              for side in sides):
+        raise ValueError(f"Invalid material {name!r}: expected e.g. KQvK or KPvK")
+    white, black = ("K" + "".join(sorted(side[1:], key=MATERIAL_ORDER.index)) for side in sides)
+    if "P" in white and "P" in black:
+        raise ValueError(f"{name}: pawns are only supported for one side")
+    return white, black
+
+
+def material_of(pieces):
+    # (white, black) piece letters of a list of (piece, row, col)
+    sides = {"w": [], "b": []}
+    for piece, _, _ in pieces:
+        if piece[1] != "k":
+            sides[piece[0]].append(piece[1].upper())
+    return tuple("K" + "".join(sorted(letters, key=MATERIAL_ORDER.index)) for letters in (sides["w"], sides["b"]))
+
+
+def is_insufficient(white, black):
+    # Kings alone, or with one minor piece, can never mate
+    return white[1:] + black[1:] in ("", "B", "N")
+
+
+def board_pieces(board):
+    return [(piece, row, col) for row, pieces in enumerate(board) for col, piece in enumerate(pieces) if piece != "  "]
+
+
+def canonical_transform(row, col, pawns):
+    # (flip_file, flip_rank, swap_diagonal) taking the square (row, col) into the king region
+    flip_file = col > 3
+    if flip_file:
+        col = 7 - col
+    flip_rank = not pawns and row < 4
+    if flip_rank:
+        row = 7 - row
+    return flip_file, flip_rank, not pawns and 7 - row > col
+
+
+def transform_square(row, col, transform):
+    flip_file, flip_rank, swap = transform
+    if flip_file:
+        col = 7 - col
+    if flip_rank:
+        row = 7 - row
+    if swap:
+        row, col = 7 - col, 7 - row
+    return row, col
+
+
+class TableLayout:
+    # Indexing of a material set: side to move, then the white king's slot in its symmetry
+    # region, then the square of the black king and of every other piece in material order
+    def __init__(self, name):
+        self.white, self.black = parse_material(name)
+        self.name = f"{self.white}v{self.black}"
+        self.pieces = ["wk", "bk"] + ["w" + letter.lower() for letter in self.white[1:]] + \
+                      ["b" + letter.lower() for letter in self.black[1:]]
+        self.pawns = "P" in self.white + self.black
+        self.region = PAWN_KING_REGION if self.pawns else KING_REGION
+        self.region_slots = {square: slot for slot, square in enumerate(self.region)}
+        self.size = 2 * len(self.region) * 64 ** (len(self.pieces) - 1)
+
+    def index(self, pieces, black_to_move):
+        # Index of a position given as (piece, row, col) of exactly this material
+        squares = {}
+        for piece, row, col in pieces:
+            squares.setdefault(piece, []).append((row, col))
+        transform = canonical_transform(*squares["wk"][0], self.pawns)
+        index = black_to_move * len(self.region) + self.region_slots[transform_square(*squares["wk"][0], transform)]
+        for piece in self.pieces[1:]:
+            row, col = transform_square(*squares[piece].pop(), transform)
+            index = index * 64 + row * 8 + col
+        return index
+
+    def decode(self, index):
+        # (black_to_move, [(piece, row, col)]) of an index; squares may collide
+        pieces = []
+        for piece in reversed(self.pieces[1:]):
+            index, square = divmod(index, 64)
+            pieces.append((piece, square >> 3, square & 7))
+        black_to_move, slot = divmod(index, len(self.region))
+        pieces.append(("wk",) + self.region[slot])
+        return black_to_move, pieces[::-1]
+
+
+class TableFile:
+    # One memory-mapped table
+    def __init__(self, path):
+        with open(path, "rb") as table:
+            self.data = mmap.mmap(table.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, name, size = TABLE_HEADER.unpack_from(self.data)
+        if magic != TABLE_MAGIC or version != TABLE_VERSION:
+            raise ValueError(f"{path}: not a version {TABLE_VERSION} endgame table")
+        self.layout = TableLayout(name.rstrip(b"\0").decode("ascii"))
+        if size != self.layout.size or len(self.data) != TABLE_HEADER.size + size:
+            raise ValueError(f"{path}: size does not match {self.layout.name}")
+
+    def value(self, index):
+        value = self.data[TABLE_HEADER.size + index]
+        return value - 256 if value > 127 else value
+
+
+class Tablebase:
+    # The tables in one directory, opened on first use
+    def __init__(self, directory):
+        self.directory = directory
+        self.tables = {}
+        # Most pieces of any table in the directory, so that larger positions (beyond the
+        # three pieces of an insufficient-material draw) are turned away at once
+        names = [name[:-len(TABLE_SUFFIX)] for name in os.listdir(directory) if name.endswith(TABLE_SUFFIX)] \
+            if os.path.isdir(directory) else []
+        self.max_pieces = max((len(name) - 1 for name in names), default=0)
+
+    def table(self, name):
+        # TableFile of a material name, or None if the directory has no such table
+        if name not in self.tables:
+            path = os.path.join(self.directory, name + TABLE_SUFFIX)
+            self.tables[name] = TableFile(path) if os.path.exists(path) else None
+        return self.tables[name]
+
+    def probe_pieces(self, pieces, black_to_move):
+        # Stored value of a position given as (piece, row, col), None without a table for it.
+        # Positions with the colors reversed are looked up with the board mirrored.
+        if len(pieces) > max(self.max_pieces, 3):
+            return None
+        white, black = material_of(pieces)
+        if is_insufficient(white, black):
+            return 0
+        table = self.table(f"{white}v{black}")
+        if table is not None:
+            return table.value(table.layout.index(pieces, black_to_move))
+        table = self.table(f"{black}v{white}")
+        if table is not None:
+            mirrored = [(("b" if piece[0] == "w" else "w") + piece[1], 7 - row, col) for piece, row, col in pieces]
+            return table.value(table.layout.index(mirrored, not black_to_move))
+        return None
+
+    def probe(self, game):
+        # TBResult of the game's position, or None if no table covers it. Castling rights
+        # and en passant squares are ignored.
+        value = self.probe_pieces(board_pieces(game.board), game.turn == "black")
+        if value is None or value == ILLEGAL:
+            return None
+        if value == 0:
+            return TBResult(0, None)
+        return TBResult(1 if value > 0 else -1, abs(value) - 1)
+
+    def best_move(self, game):
+        # Legal Move keeping the best table result: the fastest win, else a draw, else the
+        # slowest loss. None if the position is not covered.
+        if self.probe(game) is None:
+            return None
+        best, best_rank = None, None
+        pieces = board_pieces(game.board)
+        for move in game.legal_moves():
+            value = self.probe_pieces(child_pieces(pieces, move), game.turn == "white")
+            # Rank moves by the child's value for the opponent: losses soonest, then draws, then
+            # wins latest
+            rank = (0, -value) if value < 0 else (1, 0) if value == 0 else (2, -value)
+            if best_rank is None or rank < best_rank:
+                best, best_rank = move, rank
+        return best
+
+
+def child_pieces(pieces, move):
+    # Pieces after a move (castling and en passant excluded), captures dropped
+    child = []
+    for piece, row, col in pieces:
+        if (row, col) == move.dest:
+            continue
+        if (row, col) == move.src:
+            if move.promotion:
+                piece = piece[0] + move.promotion
+            row, col = move.dest
+        child.append((piece, row, col))
+    return child
+
+
+def dependencies(name):
+    # Material sets reachable by one capture or promotion that need tables of their own
+    white, black = parse_material(name)
+    reachable = set()
+    for side, other, swap in ((white, black, False), (black, white, True)):
+        for position, letter in enumerate(side[1:], 1):
+            rest = side[:position] + side[position + 1:]
+            changes = [rest] + ([rest + promoted for promoted in "QRBN"] if letter == "P" else [])
+            for changed in changes:
+                changed = "K" + "".join(sorted(changed[1:], key=MATERIAL_ORDER.index))
+                pair = (other, changed) if swap else (changed, other)
+                if not is_insufficient(*pair):
+                    reachable.add(f"{pair[0]}v{pair[1]}")
+    return sorted(reachable)
+
+
+# Worker process state, set up once per process by init_worker
+_worker_layout = None
+_worker_game = None
+_worker_tablebase = None
+
+
+def init_worker(name, directory, backend):
+    global _worker_layout, _worker_game, _worker_tablebase
+    _worker_layout = TableLayout(name)
+    _worker_game = BACKENDS[backend]()
+    # Any legal position will do; generate_slice clears it before placing every position
+    _worker_game.load_fen("4k3/8/8/8/8/8/8/4K3 w - - 0 1")
+    _worker_tablebase = Tablebase(directory)
+
+
+def generate_slice(bounds):
+    # Move graph of the positions index range(*bounds), as byte strings of arrays:
+    # initial values (ILLEGAL, -1 when checkmated, else 0), child counts, and for every
+    # child either its index in this table (external value unused) or -1 and its value
+    # from another table or an insufficient-material draw
+    layout, game, tablebase = _worker_layout, _worker_game, _worker_tablebase
+    initial, counts = array("b"), array("i")
+    child_indices, child_values = array("q"), array("b")
+    placed = [(row, col) for _, row, col in board_pieces(game.board)]
+    for index in range(*bounds):
+        black_to_move, pieces = layout.decode(index)
+        squares = {(row, col) for _, row, col in pieces}
+        if len(squares) < len(pieces) or any(piece[1] == "p" and row in (0, 7) for piece, row, _ in pieces):
+            initial.append(ILLEGAL)
+            counts.append(0)
+            continue
+
+        for row, col in placed:
+            game.set_piece(row, col, "  ")
+        for piece, row, col in pieces:
+            game.set_piece(row, col, piece)
+            if piece == "wk":
+                game.white_king_position = (row, col)
+            elif piece == "bk":
+                game.black_king_position = (row, col)
+        placed = squares
+        game.turn = "black" if black_to_move else "white"
+        game.status = None
+
+        # The side that just moved may not be in check
+        if game.is_king_in_check("white" if black_to_move else "black"):
+            initial.append(ILLEGAL)
+            counts.append(0)
+            continue
+
+        status = game.get_status()
+        initial.append(-1 if status.in_check and not status.legal_moves else 0)
+        counts.append(len(status.legal_moves))
+        for move in status.legal_moves:
+            child = child_pieces(pieces, move)
+            if material_of(child) == (layout.white, layout.black):
+                child_indices.append(layout.index(child, not black_to_move))
+                child_values.append(0)
+                continue
+            value = tablebase.probe_pieces(child, not black_to_move)
+            if value is None:
+                raise ValueError(f"{layout.name}: no table for {'v'.join(material_of(child))}")
+            child_indices.append(-1)
+            child_values.append(value)
+    return initial.tobytes(), counts.tobytes(), child_indices.tobytes(), child_values.tobytes()
+
+
+def solve(initial, counts, child_indices, child_values):
+    # Table values by retrograde analysis over the move graph, one ply of distance per
+    # pass: a position is won in n plies when some move reaches a position lost in n - 1,
+    # and lost in n when every move reaches a position won in at most n - 1 (exactly n - 1
+    # for at least one). Whatever is left undecided is a draw.
+    values = initial.copy()
+    resolved = (values != 0) | (counts == 0)
+    has_moves = counts > 0
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])[has_moves]
+    internal = child_indices >= 0
+    longest_external = int(np.abs(child_values.astype(np.int16)).max(initial=0))
+
+    plies, idle = 1, 0
+    while plies <= MAX_PLIES and (idle < 2 or plies <= longest_external + 1):
+        child = child_values.copy()
+        child[internal] = values[child_indices[internal]]
+        known = np.ones(len(child), dtype=bool)
+        known[internal] = resolved[child_indices[internal]]
+        open_positions = has_moves & ~resolved
+        new = np.zeros(len(values), dtype=bool)
+        if len(starts):
+            if plies % 2:
+                found = np.logical_or.reduceat(known & (child == -plies), starts)
+            else:
+                wins = known & (child > 0)
+                found = np.logical_and.reduceat(wins, starts) & \
+                    (np.maximum.reduceat(np.where(wins, child, 0), starts) == plies)
+            new[has_moves] = found
+        new &= open_positions
+        values[new] = plies + 1 if plies % 2 else -(plies + 1)
+        resolved |= new
+        idle = 0 if new.any() else idle + 1
+        plies += 1
+    return values
+
+
+def build_table(name, directory, workers=1, backend="bitboard", report=None):
+    # Generate the table of a material set, and first those it depends on, into directory.
+    # Tables already there are kept. Returns the path of the table.
+    layout = TableLayout(name)
+    path = os.path.join(directory, layout.name + TABLE_SUFFIX)
+    if os.path.exists(path):
+        return path
+    for dependency in dependencies(layout.name):
+        if not os.path.exists(os.path.join(directory, dependency + TABLE_SUFFIX)) and \
+                not os.path.exists(os.path.join(directory, "v".join(reversed(parse_material(dependency))) + TABLE_SUFFIX)):
+            build_table(dependency, directory, workers, backend, report)
+
+    start = time.perf_counter()
+    slices = [(low, min(low + SLICE_SIZE, layout.size)) for low in range(0, layout.size, SLICE_SIZE)]
+    parts = ([], [], [], [])
+    with multiprocessing.Pool(workers, init_worker, (layout.name, directory, backend)) as pool:
+        for part in pool.imap(generate_slice, slices):
+            for chunks, chunk in zip(parts, part):
+                chunks.append(chunk)
+    initial, counts, child_indices, child_values = (
+        np.frombuffer(b"".join(chunks), dtype=dtype) for chunks, dtype in zip(parts, (np.int8, np.int32, np.int64, np.int8)))
+    values = solve(initial, counts, child_indices, child_values)
+
+    os.makedirs(directory, exist_ok=True)
+    with open(path + ".tmp", "wb") as table:
+        table.write(TABLE_HEADER.pack(TABLE_MAGIC, TABLE_VERSION, 0, layout.name.encode("ascii"), layout.size))
+        table.write(values.tobytes())
+    os.replace(path + ".tmp", path)
+    if report is not None:
+        legal = values != ILLEGAL
+        report({
+            "table": layout.name, "positions": int(legal.sum()), "wins": int((values[legal] > 0).sum()),
+            "draws": int((values[legal] == 0).sum()), "losses": int((values[legal] < 0).sum()),
+            "longest_mate": int(np.abs(values[legal].astype(np.int16)).max(initial=1)) - 1,
+            "seconds": round(time.perf_counter() - start, 3),
+        })
+    return path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate endgame tables by retrograde analysis, or probe them.")
+    parser.add_argument("materials", nargs="*", help="material sets to generate, e.g. KQvK KRvK KPvK")
+    parser.add_argument("--directory", default="tablebases", help="table directory (default: tablebases)")
+    parser.add_argument("--workers", type=int, default=multiprocessing.cpu_count(),
+                        help="worker processes generating the move graph (default: one per core)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--probe", metavar="FEN", help="print the table result and best move of a position")
+    args = parser.parse_args(argv)
+
+    for name in args.materials:
+        build_table(name, args.directory, args.workers, args.backend, report=lambda summary: print(
+            f"{summary['table']}: {summary['positions']} positions, {summary['wins']} won, {summary['draws']} drawn, "
+            f"{summary['losses']} lost, longest mate {summary['longest_mate']} plies ({summary['seconds']:.1f}s)"))
+
+    if args.probe:
+        game = BACKENDS[args.backend]()
+        game.load_fen(args.probe)
+        tablebase = Tablebase(args.directory)
+        start = time.perf_counter()
+        result = tablebase.probe(game)
+        microseconds = (time.perf_counter() - start) * 1e6
+        if result is None:
+            print("not in the tablebase")
+            return 1
+        outcome = {1: "win", 0: "draw", -1: "loss"}[result.wdl]
+        mate = f", mate in {result.plies} plies" if result.plies is not None else ""
+        move = tablebase.best_move(game)
+        print(f"{outcome} for the side to move{mate}; best move {move.uci() if move else 'none'} "
+              f"(probe {microseconds:.0f} us)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
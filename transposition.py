@@ -0,0 +1,137 @@
+import argparse
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+from chess import BACKENDS, PERFT_POSITIONS
+
+
+# Bound types of a stored alpha-beta score
+BOUND_NONE, BOUND_EXACT, BOUND_LOWER, BOUND_UPPER = range(4)
+
+# One table slot. key is the full Zobrist key (0 marks an empty slot); move, score, depth and
+# bound describe an alpha-beta result, visits and value MCTS statistics (or a perft count
+# in visits). generation tells entries of old searches from current ones.
+ENTRY_DTYPE = np.dtype([
+    ("key", np.uint64),
+    ("visits", np.uint64),
+    ("value", np.float32),
+    ("score", np.int16),
+    ("move", np.uint16),
+    ("depth", np.int8),
+    ("bound", np.uint8),
+    ("generation", np.uint8),
+], align=True)
+
+TTEntry = namedtuple("TTEntry", ["move", "score", "depth", "bound", "visits", "value"])
+
+
+class TranspositionTable:
+    # Fixed-size hash table of position results in one preallocated structured array. Keys
+    # map to buckets of two slots: the first keeps the deepest result (or any result of an
+    # older search), the second always takes the newest one. Memory use is fixed at creation.
+    def __init__(self, size_mb=16):
+        bucket_bytes = 2 * ENTRY_DTYPE.itemsize
+        buckets = 1
+        while buckets * 2 * bucket_bytes <= size_mb * (1 << 20):
+            buckets *= 2
+        self.entries = np.zeros((buckets, 2), dtype=ENTRY_DTYPE)
+        self.mask = buckets - 1
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.collisions = 0
+
+    def clear(self):
+        self.entries[:] = 0
+        self.generation = 0
+        self.hits = self.misses = self.collisions = 0
+
+    def new_search(self):
+        # Age the entries of earlier searches so they are the first to be replaced
+        self.generation = (self.generation + 1) & 255
+
+    def probe(self, key):
+        # TTEntry stored for key, or None. A bucket full of other positions counts as a
+        # collision as well as a miss.
+        bucket = self.entries[key & self.mask]
+        for slot in (0, 1):
+            entry = bucket[slot]
+            if entry["key"] == key:
+                self.hits += 1
+                return TTEntry(int(entry["move"]), int(entry["score"]), int(entry["depth"]),
+                               int(entry["bound"]), int(entry["visits"]), float(entry["value"]))
+        self.misses += 1
+        if bucket[0]["key"] and bucket[1]["key"]:
+            self.collisions += 1
+        return None
+
+    def store(self, key, move=0, score=0, depth=0, bound=BOUND_NONE, visits=0, value=0.0):
+        bucket = self.entries[key & self.mask]
+        first = bucket[0]
+        if (first["key"] == key or first["key"] == 0 or depth >= first["depth"]
+                or first["generation"] != self.generation):
+            slot = 0
+        else:
+            slot = 1
+        bucket[slot] = (key, visits, value, score, move, depth, bound, self.generation)
+
+    def hashfull(self):
+        # Per mille of the first 1000 slots in use by the current search, as UCI reports it
+        sample = self.entries[:500]
+        return int(((sample["key"] != 0) & (sample["generation"] == self.generation)).sum() * 1000 // sample.size)
+
+    @property
+    def size_mb(self):
+        return self.entries.nbytes / (1 << 20)
+
+
+def hashed_perft(game, depth, table):
+    # perft that looks up the node count of every position already counted at the same depth
+    if depth == 0:
+        return 1
+    entry = table.probe(game.zobrist_key)
+    if entry is not None and entry.depth == depth:
+        return entry.visits
+    if depth == 1:
+        nodes = len(game.legal_moves())
+        table.store(game.zobrist_key, depth=depth, visits=nodes)
+        return nodes
+    nodes = 0
+    for move in game.legal_moves():
+        game.make_move(move)
+        nodes += hashed_perft(game, depth - 1, table)
+        game.unmake_move()
+    table.store(game.zobrist_key, depth=depth, visits=nodes)
+    return nodes
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run perft through a transposition table.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="bitboard",
+                        help="board representation to use (default: bitboard)")
+    parser.add_argument("--depth", type=int, default=4, help="maximum perft depth (default: 4)")
+    parser.add_argument("--hash", type=int, default=16, help="table size in MB (default: 16)")
+    args = parser.parse_args(argv)
+
+    passed = True
+    for name, fen, expected_counts in PERFT_POSITIONS:
+        game = BACKENDS[args.backend]()
+        game.load_fen(fen)
+        depth = min(args.depth, len(expected_counts))
+        table = TranspositionTable(args.hash)
+        start = time.perf_counter()
+        nodes = hashed_perft(game, depth, table)
+        seconds = time.perf_counter() - start
+        ok = nodes == expected_counts[depth - 1]
+        passed = passed and ok
+        print(f"{name:<10} depth {depth}  nodes {nodes:>9}  {'ok' if ok else 'MISMATCH':<8} {seconds:8.3f}s  "
+              f"hits {table.hits}  misses {table.misses}  collisions {table.collisions}  "
+              f"hashfull {table.hashfull()}")
+    return 0 if passed else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,185 @@
+import sys
+import threading
+
+from chess import BACKENDS, START_FEN, unpack_move
+from search import AlphaBetaSearch, format_info
+from transposition import TranspositionTable
+
+
+ENGINE_NAME = "AlphaZero-Chess"
+ENGINE_AUTHOR = "Mawtyn"
+
+# Options offered to the GUI as (name, type, default, min, max). The search runs on one
+# thread, so Threads is accepted for compatibility but always 1.
+UCI_OPTIONS = [
+    ("Hash", "spin", 16, 1, 4096),
+    ("Threads", "spin", 1, 1, 1),
+]
+
+# Time management for clock games: use a share of the remaining time (a movestogo-th of
+# it, or 1/DEFAULT_MOVES_TO_GO in sudden death) plus most of the increment, never more
+# than MAX_TIME_SHARE of the clock and always leaving MOVE_OVERHEAD seconds for I/O
+DEFAULT_MOVES_TO_GO = 30
+MAX_TIME_SHARE = 0.5
+MOVE_OVERHEAD = 0.05
+
+
+def allocate_time(remaining, increment=0.0, moves_to_go=None):
+    # Seconds to spend on the next move with remaining seconds on the clock
+    share = remaining / (moves_to_go or DEFAULT_MOVES_TO_GO) + increment * 0.75
+    return max(0.01, min(share, remaining * MAX_TIME_SHARE, remaining - MOVE_OVERHEAD))
+
+
+class UCIEngine:
+    # UCI protocol driver. Commands are read on the calling thread while go starts the search
+    # on a background thread, so stop, isready and quit are answered during a search.
+    def __init__(self, backend="bitboard", output=sys.stdout):
+        self.backend = backend
+        self.output = output
+        self.output_lock = threading.Lock()
+        self.game = BACKENDS[backend]()
+        self.table = TranspositionTable(UCI_OPTIONS[0][2])
+        self.searcher = None
+        self.search_thread = None
+        # Set by stop (or quit) so that an infinite search may print its bestmove
+        self.stop_requested = threading.Event()
+
+    def send(self, line):
+        with self.output_lock:
+            self.output.write(line + "\n")
+            self.output.flush()
+
+    def run(self, lines):
+        for line in lines:
+            if not self.handle(line):
+                break
+        self.stop_search()
+        return 0
+
+    def handle(self, line):
+        # Act on one command line; returns False after quit
+        tokens = line.split()
+        if not tokens:
+            return True
+        command, args = tokens[0], tokens[1:]
+        if command == "uci":
+            self.send(f"id name {ENGINE_NAME}")
+            self.send(f"id author {ENGINE_AUTHOR}")
+            for name, kind, default, low, high in UCI_OPTIONS:
+                self.send(f"option name {name} type {kind} default {default} min {low} max {high}")
+            self.send("uciok")
+        elif command == "isready":
+            self.send("readyok")
+        elif command == "setoption":
+            self.stop_search()
+            self.set_option(args)
+        elif command == "ucinewgame":
+            self.stop_search()
+            self.table.clear()
+        elif command == "position":
+            self.stop_search()
+            self.set_position(args)
+        elif command == "go":
+            self.stop_search()
+            self.go(args)
+        elif command == "stop":
+            self.stop_search()
+        elif command == "quit":
+            return False
+        elif command != "debug":
+            self.send(f"info string unknown command {command}")
+        return True
+
+    def set_option(self, args):
+        # setoption name <name> [value <value>]; names may contain spaces
+        if "name" not in args:
+            return
+        start = args.index("name") + 1
+        end = args.index("value") if "value" in args else len(args)
+        name = " ".join(args[start:end]).lower()
+        value = " ".join(args[end + 1:])
+        for option, kind, default, low, high in UCI_OPTIONS:
+            if option.lower() != name:
+                continue
+            try:
+                number = min(max(int(value), low), high)
+            except ValueError:
+                self.send(f"info string invalid value {value!r} for option {option}")
+                return
+            if option == "Hash":
+                self.table = TranspositionTable(number)
+            return
+        self.send(f"info string unknown option {name}")
+
+    def set_position(self, args):
+        # position (startpos | fen <fen>) [moves <move> ...]
+        moves_at = args.index("moves") if "moves" in args else len(args)
+        if args and args[0] == "fen":
+            fen = " ".join(args[1:moves_at])
+        else:
+            fen = START_FEN
+        try:
+            self.game.load_fen(fen)
+            for move in args[moves_at + 1:]:
+                self.game.push(move)
+        except ValueError as error:
+            self.send(f"info string invalid position: {error}")
+            self.game.load_fen(START_FEN)
+
+    def go(self, args):
+        # go [wtime|btime|winc|binc|movestogo|movetime|depth|nodes <n>] [infinite]; times are
+        # in milliseconds
+        limits = {}
+        for index, token in enumerate(args[:-1]):
+            if token in ("wtime", "btime", "winc", "binc", "movestogo", "movetime", "depth", "nodes"):
+                try:
+                    limits[token] = int(args[index + 1])
+                except ValueError:
+                    pass
+        infinite = "infinite" in args or "ponder" in args
+
+        time_limit = None
+        if "movetime" in limits:
+            time_limit = max(0.01, limits["movetime"] / 1000 - MOVE_OVERHEAD)
+        else:
+            side = "w" if self.game.turn == "white" else "b"
+            if f"{side}time" in limits:
+                time_limit = allocate_time(limits[f"{side}time"] / 1000, limits.get(f"{side}inc", 0) / 1000,
+                                           limits.get("movestogo"))
+        if infinite:
+            time_limit = None
+
+        # The search thread works on its own copy, so that the game only ever changes
+        # through position commands
+        self.stop_requested.clear()
+        self.searcher = AlphaBetaSearch(self.game.clone(), self.table)
+        self.search_thread = threading.Thread(
+            target=self.search, args=(limits.get("depth", 64), time_limit, limits.get("nodes"), infinite),
+            daemon=True)
+        self.search_thread.start()
+
+    def search(self, depth, time_limit, node_limit, infinite):
+        result = self.searcher.search(depth, time_limit, node_limit,
+                                      report=lambda info: self.send(format_info(info)))
+        # In infinite mode the GUI expects the bestmove only after it sends stop
+        if infinite:
+            self.stop_requested.wait()
+        if result is not None and result.pv:
+            self.send(f"bestmove {unpack_move(result.pv[0]).uci()}")
+        else:
+            moves = self.searcher.game.legal_moves()
+            self.send(f"bestmove {moves[0].uci() if moves else '0000'}")
+
+    def stop_search(self):
+        # Stop a running search and wait for its bestmove. The search may not have started
+        # (and cleared its stop flag) yet, so keep asking until the thread ends.
+        self.stop_requested.set()
+        while self.search_thread is not None and self.search_thread.is_alive():
+            self.searcher.stop()
+            self.search_thread.join(0.05)
+        self.search_thread = None
+
+
+def run_uci(backend="bitboard"):
+    # Serve UCI on stdin / stdout until quit or end of input
+    return UCIEngine(backend).run(iter(sys.stdin.readline, ""))